@@ -1,22 +1,52 @@
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
 import uuid
 from datetime import datetime, timedelta
-from config.azure_config import get_azure_config
+from functools import lru_cache
+from config.config_utils import get_config
+from config.trace_utils import span
 from azure_services.cognitive_serivce import analyze_image_for_fire
 
+@lru_cache(maxsize=1)
+def get_blob_service_client():
+    """
+    Returns the BlobServiceClient shared by all requests in the worker.
+    """
+    from azure.storage.blob import BlobServiceClient
+    return BlobServiceClient.from_connection_string(get_config()["BLOB_STORAGE_CONNECTION_STRING"])
+
 class BlobStorageService:
     def __init__(self):
         # Get Blob Storage configuration from azure_config
-        config = get_azure_config()
-        self.blob_service_client = BlobServiceClient.from_connection_string(config["BLOB_STORAGE_CONNECTION_STRING"])
+        config = get_config()
+        self.blob_service_client = get_blob_service_client()
         self.container_name = config["BLOB_CONTAINER_NAME"]
         self.container_client = self.blob_service_client.get_container_client(self.container_name)
 
+    def upload_stream(self, chunks, blob_name: str, content_type: str, expiry_hours: int = 24) -> str:
+        """
+        Uploads an iterable of byte chunks as a block blob while it is being produced and
+        returns a read-only SAS URL for it.
+        """
+        from azure.storage.blob import generate_blob_sas, BlobSasPermissions, ContentSettings
+        blob_client = self.container_client.get_blob_client(blob_name)
+        with span("blob.upload_stream", container=self.container_name):
+            blob_client.upload_blob(chunks, overwrite=True, content_settings=ContentSettings(content_type=content_type))
+        sas_token = generate_blob_sas(
+            account_name=self.blob_service_client.account_name,
+            container_name=self.container_name,
+            blob_name=blob_name,
+            account_key=self.blob_service_client.credential.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.utcnow() + timedelta(hours=expiry_hours)
+        )
+        return f"{blob_client.url}?{sas_token}"
+
     def upload_image(self, image_bytes: bytes, filename: str = None) -> str:
+        from azure.storage.blob import generate_blob_sas, BlobSasPermissions
         if not filename:
             filename = f"{uuid.uuid4()}.jpg"  # Generate a random filename if not provided
         blob_client = self.container_client.get_blob_client(filename)
-        blob_client.upload_blob(image_bytes, overwrite=True)  # Upload the image
+        with span("blob.upload", container=self.container_name):
+            blob_client.upload_blob(image_bytes, overwrite=True)  # Upload the image
 
         # Generate SAS token for the uploaded blob
         sas_token = generate_blob_sas(
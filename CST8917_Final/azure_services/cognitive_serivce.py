@@ -1,25 +1,42 @@
 import logging
-from azure.cognitiveservices.vision.computervision import ComputerVisionClient
-from msrest.authentication import CognitiveServicesCredentials
-from config.azure_config import get_azure_config
+from functools import lru_cache
+from config.config_utils import get_config
+from config.log_utils import log_event
+from config.trace_utils import span
+from azure_services.resilience import VISION
+
+@lru_cache(maxsize=1)
+def get_vision_client():
+    """
+    Returns the Computer Vision client shared by all requests in the worker.
+    """
+    from azure.cognitiveservices.vision.computervision import ComputerVisionClient
+    from msrest.authentication import CognitiveServicesCredentials
 
-def analyze_image_for_fire(image_url: str) -> str:
     # Get Azure Cognitive Service configuration
-    config = get_azure_config()
+    config = get_config()
     endpoint = config["COGNITIVE_SERVICE_ENDPOINT"]
     subscription_key = config["COGNITIVE_SERVICE_KEY"]
+    return ComputerVisionClient(endpoint, CognitiveServicesCredentials(subscription_key))
 
-    # Create a Computer Vision Client
-    client = ComputerVisionClient(endpoint, CognitiveServicesCredentials(subscription_key))
+def analyze_image_for_fire(image_url: str) -> str:
+    client = get_vision_client()
 
-    # Analyze the image
-    analysis = client.analyze_image(
-        image_url,
-        visual_features=["Tags", "Description"]  # İkili analiz
-    )
+    # Analyze the image; the analysis is advisory, so it is skipped when the service fails,
+    # is slower than its budget or its circuit is open, instead of failing the upload
+    try:
+        with span("vision.analyze"):
+            analysis = VISION.call(
+                client.analyze_image,
+                image_url,
+                visual_features=["Tags", "Description"]  # İkili analiz
+            )
+    except Exception as e:
+        logging.warning(f"[analyze_image_for_fire] Skipping fire detection: {str(e)}")
+        return "Fire detection skipped."
 
     # Log the analysis result
-    logging.info(f"Analysis result: {analysis.as_dict()}")  # Log the full analysis result as a dictionary
+    log_event(logging.INFO, "Analysis result", route="analyze_image", analysis=analysis.as_dict)  # Evaluated only if emitted
 
     if hasattr(analysis, 'tags'):
         for tag in analysis.tags:
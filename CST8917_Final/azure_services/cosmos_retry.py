@@ -0,0 +1,104 @@
+import os
+import re
+import time
+import random
+import logging
+from config.metrics_utils import increment
+from config.trace_utils import request_elapsed_ms
+
+# Attempts per operation, including the first one
+COSMOS_RETRY_MAX_ATTEMPTS = int(os.environ.get("COSMOS_RETRY_MAX_ATTEMPTS", "6"))
+# Backoff before the first retry when Cosmos DB sends no hint; doubled on every further retry
+COSMOS_RETRY_BASE_MS = float(os.environ.get("COSMOS_RETRY_BASE_MS", "50"))
+# Upper bound of a single computed wait; waits asked for by the server are not capped
+COSMOS_RETRY_MAX_BACKOFF_MS = float(os.environ.get("COSMOS_RETRY_MAX_BACKOFF_MS", "2000"))
+# Time budget of one HTTP request (or of one operation outside a request) after which no
+# more retries are made, so a client is never held much longer than this by throttling
+COSMOS_RETRY_DEADLINE_MS = float(os.environ.get("COSMOS_RETRY_DEADLINE_MS", "5000"))
+
+# Cosmos DB's "request rate is large" error; 429 is returned by some server versions
+THROTTLED_CODES = {16500, 429}
+RETRY_AFTER_PATTERN = re.compile(r"RetryAfterMs=(\d+)")
+
+# Operations that can be repeated safely even if the first attempt may have been applied
+IDEMPOTENT_OPERATIONS = {"find_document", "find_documents", "aggregate", "aggregate_cursor", "delete_document"}
+# Update operators that give the same result when applied twice
+IDEMPOTENT_UPDATE_OPERATORS = {"$set", "$unset", "$pull", "$addToSet", "$min", "$max"}
+
+def is_throttled(error: Exception) -> bool:
+    if getattr(error, "code", None) in THROTTLED_CODES:
+        return True
+    message = str(error)
+    return "Request rate is large" in message or "TooManyRequests" in message
+
+def retry_after_ms(error: Exception):
+    """
+    Returns the wait Cosmos DB asks for (RetryAfterMs in the error message), or None.
+    """
+    details = getattr(error, "details", None) or {}
+    match = RETRY_AFTER_PATTERN.search(f"{details.get('errmsg', '')} {error}")
+    return float(match.group(1)) if match else None
+
+def is_transient(error: Exception) -> bool:
+    """
+    True for network errors after which the operation may or may not have been applied.
+    """
+    from pymongo.errors import AutoReconnect  # Includes NetworkTimeout
+    return isinstance(error, AutoReconnect)
+
+def is_idempotent(operation: str, update: dict = None) -> bool:
+    if operation in IDEMPOTENT_OPERATIONS:
+        return True
+    if operation == "update_document" and update:
+        return all(key in IDEMPOTENT_UPDATE_OPERATORS for key in update)
+    return False
+
+def backoff_ms(attempt: int, hint_ms: float = None) -> float:
+    """
+    Equal-jitter exponential backoff for the given retry (1 for the first): a random wait
+    between half the exponential ceiling and the ceiling, so a throttled request always backs
+    off noticeably while workers still spread out. The server's hint is used as the minimum
+    wait instead, with jitter added so throttled workers do not retry in lockstep. It is not
+    capped, since an earlier retry would be throttled again; a wait past the deadline ends the
+    retries instead.
+    """
+    if hint_ms is not None:
+        return hint_ms + random.uniform(0, COSMOS_RETRY_BASE_MS)
+    ceiling = min(COSMOS_RETRY_MAX_BACKOFF_MS, COSMOS_RETRY_BASE_MS * 2 ** (attempt - 1))
+    return random.uniform(ceiling / 2, ceiling)
+
+def run_with_retry(call, collection_name: str, operation: str, idempotent: bool):
+    """
+    Runs a database call, retrying throttled attempts (which Cosmos DB rejects before applying,
+    so every operation may be retried) and, for idempotent operations only, transient network
+    errors. Retries stop after COSMOS_RETRY_MAX_ATTEMPTS or when the wait would pass the deadline;
+    the last error is then raised.
+    """
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return call()
+        except Exception as error:
+            throttled = is_throttled(error)
+            if not throttled and not (idempotent and is_transient(error)):
+                raise
+            labels = {"collection": collection_name, "operation": operation}
+            reason = "throttled" if throttled else "transient"
+            if throttled:
+                increment("db_throttled_total", **labels)
+
+            wait_ms = backoff_ms(attempt, retry_after_ms(error) if throttled else None)
+            elapsed_ms = request_elapsed_ms()
+            if elapsed_ms is None:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+            if attempt >= COSMOS_RETRY_MAX_ATTEMPTS or elapsed_ms + wait_ms > COSMOS_RETRY_DEADLINE_MS:
+                increment("db_retries_exhausted_total", reason=reason, **labels)
+                logging.error(f"[CosmosDBService] {operation} on {collection_name} failed after {attempt} attempts: {str(error)}")
+                raise
+
+            increment("db_retries_total", reason=reason, **labels)
+            increment("db_retry_wait_seconds_total", wait_ms / 1000, **labels)
+            logging.warning(f"[CosmosDBService] {operation} on {collection_name} {reason}, retry {attempt} in {wait_ms:.0f} ms")
+            time.sleep(wait_ms / 1000)
@@ -1,38 +1,78 @@
 import logging
-from config.azure_config import get_azure_config
-from pymongo import MongoClient
+from functools import lru_cache
+from config.config_utils import get_config
+from config.trace_utils import span
+from azure_services.query_profiler import profiled
+from azure_services.cosmos_retry import run_with_retry, is_idempotent
+
+
+@lru_cache(maxsize=1)
+def get_mongo_client():
+    """
+    Returns the MongoClient shared by all requests in the worker.
+    pymongo is imported and the connection pool is created on first use.
+    Dates are returned as timezone-aware UTC datetimes.
+    """
+    from pymongo import MongoClient
+    return MongoClient(get_config()["COSMOS_DB_CONNECTION_STRING"], tz_aware=True)
 
 
 class CosmosDBService:
+    # (collection, keys) pairs whose index has already been ensured by this worker
+    _ensured_indexes = set()
+
     def __init__(self):
         """
         Initializes the CosmosDBService with the specified database.
         """
         try:
-            config = get_azure_config()
-            client = MongoClient(config["COSMOS_DB_CONNECTION_STRING"])
+            config = get_config()
+            client = get_mongo_client()
             self.db = client[config["COSMOS_DB_NAME"]]
             self.default_collection_name = config["COLLECTION_NAME"]  # Default collection name
-            logging.info("[CosmosDBService] MongoDB database initialized successfully.")
+            logging.debug("[CosmosDBService] MongoDB database initialized successfully.")
         except Exception as ex:
             logging.exception("[CosmosDBService] MongoDB database initialization failed.")
             raise ex
 
+    def _run(self, operation: str, collection_name: str, query, call, idempotent: bool = None):
+        """
+        Runs a database call with throttling retries; every attempt is timed and profiled.
+        """
+        if idempotent is None:
+            idempotent = is_idempotent(operation)
+
+        def attempt():
+            with profiled(self.db, collection_name, operation, query) as profile:
+                return profile.result(call())
+        return run_with_retry(attempt, collection_name, operation, idempotent)
+
     def insert_document(self, document: dict, collection_name: str = None):
         """
         Inserts a document into the specified collection.
         """
         collection_name = collection_name or self.default_collection_name
         collection = self.db[collection_name]
-        return collection.insert_one(document)
+        return self._run("insert_document", collection_name, None, lambda: collection.insert_one(document))
 
-    def find_document(self, query: dict, collection_name: str = None):
+    def find_document(self, query: dict, collection_name: str = None, projection: dict = None):
         """
         Finds a single document in the specified collection based on the query.
+        An optional projection limits the fields returned by the database.
         """
         collection_name = collection_name or self.default_collection_name
         collection = self.db[collection_name]
-        return collection.find_one(query)
+        return self._run("find_document", collection_name, query, lambda: collection.find_one(query, projection))
+
+    def find_version(self, query: dict, collection_name: str = None):
+        """
+        Returns the version field of the matching document (0 if unset), or None if nothing matches.
+        Only the version field is read from the database.
+        """
+        document = self.find_document(query, collection_name, projection={"version": 1})
+        if document is None:
+            return None
+        return document.get("version", 0)
 
     def update_document(self, query: dict, update: dict, collection_name: str = None):
         """
@@ -40,7 +80,8 @@ class CosmosDBService:
         """
         collection_name = collection_name or self.default_collection_name
         collection = self.db[collection_name]
-        return collection.update_one(query, update)
+        return self._run("update_document", collection_name, query, lambda: collection.update_one(query, update),
+                         idempotent=is_idempotent("update_document", update))
 
     def delete_document(self, query: dict, collection_name: str = None):
         """
@@ -48,7 +89,7 @@ class CosmosDBService:
         """
         collection_name = collection_name or self.default_collection_name
         collection = self.db[collection_name]
-        return collection.delete_one(query)
+        return self._run("delete_document", collection_name, query, lambda: collection.delete_one(query))
 
     def find_documents(self, query: dict, collection_name: str = None):
         """
@@ -56,4 +97,40 @@ class CosmosDBService:
         """
         collection_name = collection_name or self.default_collection_name
         collection = self.db[collection_name]
-        return list(collection.find(query))
\ No newline at end of file
+        return self._run("find_documents", collection_name, query, lambda: list(collection.find(query)))
+
+    def aggregate(self, pipeline: list, collection_name: str = None):
+        """
+        Runs an aggregation pipeline in the specified collection and returns the resulting documents.
+        """
+        collection_name = collection_name or self.default_collection_name
+        collection = self.db[collection_name]
+        return self._run("aggregate", collection_name, pipeline, lambda: list(collection.aggregate(pipeline)))
+
+    def aggregate_cursor(self, pipeline: list, collection_name: str = None, batch_size: int = None):
+        """
+        Runs an aggregation pipeline and returns the cursor, so large results are fetched in
+        batches while they are consumed instead of being loaded at once. Only the first batch
+        is retried when throttled.
+        """
+        collection_name = collection_name or self.default_collection_name
+        collection = self.db[collection_name]
+        options = {"batchSize": batch_size} if batch_size else {}
+        return self._run("aggregate_cursor", collection_name, pipeline,
+                         lambda: collection.aggregate(pipeline, allowDiskUse=True, **options))
+
+    def ensure_index(self, keys: list, collection_name: str = None):
+        """
+        Creates an index on the given (field, direction) keys once per worker.
+        Failures are logged so a missing index never fails the request.
+        """
+        collection_name = collection_name or self.default_collection_name
+        marker = (collection_name, tuple(keys))
+        if marker in CosmosDBService._ensured_indexes:
+            return
+        try:
+            with span("cosmos.create_index", collection=collection_name):
+                self.db[collection_name].create_index(keys)
+        except Exception as ex:
+            logging.warning(f"[CosmosDBService] Could not create index {keys} on {collection_name}: {str(ex)}")
+        CosmosDBService._ensured_indexes.add(marker)
@@ -1,29 +1,124 @@
+import os
+import uuid
 import logging
-from azure.eventgrid import EventGridPublisherClient, EventGridEvent
-from azure.core.credentials import AzureKeyCredential
-from config.azure_config import get_azure_config
+from functools import lru_cache
+from config.config_utils import get_config
+from config.trace_utils import span
+from config.metrics_utils import increment
+from config.time_utils import utc_now
+from azure_services.resilience import EVENT_GRID, DependencyUnavailable
 
-config = get_azure_config()
+# Events that could not be sent are kept here until the replay job delivers them
+DEFAULT_DEFERRED_EVENTS_COLLECTION = "DeferredEvents"
+# Deferred events sent per replay run
+REPLAY_BATCH_SIZE = 200
+# Failed sends after which a deferred event is parked as a poison event and no longer replayed
+MAX_REPLAY_ATTEMPTS = int(os.environ.get("DEFERRED_EVENT_MAX_ATTEMPTS", "10"))
 
-eventgrid_client = EventGridPublisherClient(
-    config["EVENTGRID_TOPIC_ENDPOINT"],
-    AzureKeyCredential(config["EVENTGRID_TOPIC_KEY"])
-)
+@lru_cache(maxsize=1)
+def get_eventgrid_client():
+    """
+    Returns the Event Grid publisher client, created on the first published event.
+    """
+    from azure.eventgrid import EventGridPublisherClient
+    from azure.core.credentials import AzureKeyCredential
+
+    config = get_config()
+    return EventGridPublisherClient(
+        config["EVENTGRID_TOPIC_ENDPOINT"],
+        AzureKeyCredential(config["EVENTGRID_TOPIC_KEY"])
+    )
+
+def deferred_events_collection() -> str:
+    return get_config().get("DEFERRED_EVENTS_COLLECTION_NAME", DEFAULT_DEFERRED_EVENTS_COLLECTION)
+
+def send_event(event_data: dict, event_id: str):
+    """
+    Sends the event to Event Grid within its circuit breaker and time budget. A send that
+    timed out may still be delivered, so retries reuse the event id and subscribers can drop
+    the duplicates.
+    """
+    from azure.eventgrid import EventGridEvent
+    event = EventGridEvent(
+        subject=f"Device/{event_data.get('device_id')}",
+        data=event_data,
+        event_type="IoT.DeviceTelemetry",
+        data_version="1.0",
+        id=event_id
+    )
+    with span("eventgrid.send"):
+        EVENT_GRID.call(get_eventgrid_client().send, [event])
+
+def defer_event(event_data: dict, event_id: str, reason: str):
+    """
+    Stores an event that could not be sent; replay_deferred_events sends it later with the
+    same event id.
+    """
+    from azure_services.cosmosdb_service import CosmosDBService
+    CosmosDBService().insert_document({
+        "_id": str(uuid.uuid4()),
+        "type": "deferredEvent",
+        "eventId": event_id,
+        "event": event_data,
+        "reason": reason,
+        "deferredAt": utc_now(),
+        "attempts": 0,
+    }, deferred_events_collection())
+    increment("events_deferred_total")
 
 def forward_event(event_data: dict):
     """
     Forwards the given event data to Azure Event Grid.
+    If Event Grid fails, is too slow or its circuit is open, the event is deferred instead,
+    so telemetry ingestion does not depend on Event Grid being available.
     """
+    event_id = str(uuid.uuid4())
     try:
         logging.info(f"[forward_event] Preparing to forward event for device_id: {event_data.get('device_id')}")
-        event = EventGridEvent(
-            subject=f"Device/{event_data.get('device_id')}",
-            data=event_data,
-            event_type="IoT.DeviceTelemetry",
-            data_version="1.0"
-        )
-        eventgrid_client.send([event])
+        send_event(event_data, event_id)
         logging.info(f"[forward_event] Successfully forwarded event for device: {event_data.get('device_id')}")
     except Exception as e:
-        logging.exception(f"[forward_event] Failed to forward event: {e}")
-        raise e
+        logging.warning(f"[forward_event] Deferring event for device {event_data.get('device_id')}: {e}")
+        try:
+            defer_event(event_data, event_id, str(e))
+        except Exception as defer_error:
+            logging.exception(f"[forward_event] Failed to forward or defer event: {defer_error}")
+            raise e
+
+def replay_deferred_events(limit: int = REPLAY_BATCH_SIZE) -> int:
+    """
+    Sends deferred events, oldest first, and returns how many were delivered. Stops early
+    while the Event Grid circuit is open. An event that failed MAX_REPLAY_ATTEMPTS times is
+    parked as a poisonEvent, so it no longer holds up the events behind it.
+    """
+    from azure_services.cosmosdb_service import CosmosDBService
+    cosmos_service = CosmosDBService()
+    collection_name = deferred_events_collection()
+    cosmos_service.ensure_index([("type", 1), ("deferredAt", 1)], collection_name)
+    documents = cosmos_service.aggregate(
+        [{"$match": {"type": "deferredEvent"}}, {"$sort": {"deferredAt": 1}}, {"$limit": limit}],
+        collection_name
+    )
+    delivered = 0
+    for document in documents:
+        # Events deferred before their id was stored get one now, kept for their later attempts
+        event_id = document.get("eventId") or document["_id"]
+        try:
+            send_event(document["event"], event_id)
+        except DependencyUnavailable as e:
+            logging.info(f"[replay_deferred_events] Event Grid unavailable ({e.reason}), stopping.")
+            break
+        except Exception as e:
+            update = {"$inc": {"attempts": 1}, "$set": {"reason": str(e), "eventId": event_id}}
+            if document.get("attempts", 0) + 1 >= MAX_REPLAY_ATTEMPTS:
+                logging.error(f"[replay_deferred_events] Parking deferred event {document['_id']} after {MAX_REPLAY_ATTEMPTS} failed attempts: {e}")
+                update["$set"].update({"type": "poisonEvent", "parkedAt": utc_now()})
+                increment("events_parked_total")
+            else:
+                logging.warning(f"[replay_deferred_events] Failed to send deferred event {document['_id']}: {e}")
+            cosmos_service.update_document({"_id": document["_id"]}, update, collection_name)
+            continue
+        cosmos_service.delete_document({"_id": document["_id"]}, collection_name)
+        delivered += 1
+    increment("events_replayed_total", delivered)
+    return delivered
@@ -1,7 +1,18 @@
 import logging
-from azure.iot.hub import IoTHubRegistryManager
-from config.azure_config import get_azure_config
+from functools import lru_cache
+from config.config_utils import get_config
+from config.trace_utils import traced
 from azure_services.eventtopic_service import forward_event
+from azure_services.resilience import IOT_HUB, DependencyUnavailable
+
+
+@lru_cache(maxsize=1)
+def get_registry_manager():
+    """
+    Returns the IoT Hub registry manager shared by all requests in the worker.
+    """
+    from azure.iot.hub import IoTHubRegistryManager
+    return IoTHubRegistryManager(get_config()["IOTHUB_CONNECTION_STRING"])
 
 
 class IoTHubService:
@@ -9,10 +20,9 @@ class IoTHubService:
         """
         Initializes the IoTHubService instance with a registry manager.
         """
-        config = get_azure_config()
-        connection_string = config["IOTHUB_CONNECTION_STRING"]
-        self.registry_manager = IoTHubRegistryManager(connection_string)
+        self.registry_manager = get_registry_manager()
 
+    @traced("iothub.register_device")
     def register_device_in_iot_hub(self, device_data: dict):
         """
         Registers a device in IoT Hub.
@@ -24,16 +34,19 @@ class IoTHubService:
             
             # Check if the device already exists in IoT Hub
             try:
-                existing_device = self.registry_manager.get_device(device_id)
+                existing_device = IOT_HUB.call(self.registry_manager.get_device, device_id)
                 if existing_device:
                     logging.info(f"Device {device_id} already exists in IoT Hub.")
                     return {"message": f"Device {device_id} already exists in IoT Hub."}
+            except DependencyUnavailable:
+                raise
             except Exception as e:
                 # If the device does not exist, proceed to create it
                 logging.info(f"Device {device_id} does not exist in IoT Hub. Proceeding to create it.")
 
-            # Create a new device in IoT Hub
-            device = self.registry_manager.create_device_with_sas(
+            # Create a new device in IoT Hub; not abandoned on timeout, as a retry would find it created
+            device = IOT_HUB.call_write(
+                self.registry_manager.create_device_with_sas,
                 device_id=device_id,
                 primary_key=None,
                 secondary_key=None,
@@ -45,6 +58,7 @@ class IoTHubService:
             logging.exception(f"Failed to register device in IoT Hub: {str(e)}")
             raise e
 
+    @traced("iothub.delete_device")
     def delete_device_from_iot_hub(self, device_id: str):
         """
         Deletes a device from IoT Hub.
@@ -54,7 +68,7 @@ class IoTHubService:
                 raise ValueError("Device ID is required for IoT Hub deletion.")
             
             # Delete the device from IoT Hub
-            self.registry_manager.delete_device(device_id)
+            IOT_HUB.call_write(self.registry_manager.delete_device, device_id)
             logging.info(f"Device {device_id} deleted from IoT Hub successfully.")
         except Exception as e:
             logging.exception(f"Failed to delete device from IoT Hub: {str(e)}")
@@ -1,14 +1,10 @@
 import json
-import requests
 import logging
-import json
 
-from config.azure_config import get_azure_config
-from config.azure_config import get_azure_config
+from config.config_utils import get_config
+from config.log_utils import log_event
 from config.sas_utils import generate_sas_token
-from azure.communication.email import EmailClient
-from azure.core.credentials import AzureKeyCredential
-from config.azure_config import get_azure_config
+from config.trace_utils import span
 
 class NotificationService:
 
@@ -26,8 +22,10 @@ class NotificationService:
                 logging.error("[Notification] Missing required message fields.")
                 return
 
+            from azure.communication.email import EmailClient
+
             # Azure Communication Service config
-            config = get_azure_config()
+            config = get_config()
             connection_string = config["COMMUNICATION_SERVICE_CONNECTION_STRING"]
             client = EmailClient.from_connection_string(connection_string)
 
@@ -53,8 +51,9 @@ class NotificationService:
             }
 
             # Send email
-            poller = client.begin_send(message)
-            result = poller.result()
+            with span("email.send"):
+                poller = client.begin_send(message)
+                result = poller.result()
 
             if hasattr(result, "message_id"):
                 logging.info(f"[Notification] Email sent to {recipient_email}, messageId: {result.message_id}")
@@ -66,7 +65,9 @@ class NotificationService:
             logging.exception(f"[Notification Error] {str(ex)}")
 
     def trigger_notification(user_id: str, message: str):
-        config = get_azure_config()
+        import requests
+
+        config = get_config()
         hub_namespace = "cst8922notificationhubns"
         hub_name = config["NOTIFICATION_HUB_NAME"]
         full_uri = f"https://{hub_namespace}.servicebus.windows.net/{hub_name}/messages/?api-version=2015-01"
@@ -92,9 +93,10 @@ class NotificationService:
             "priority": "high"
         }
 
-        logging.info(f"[trigger_notification] Sending payload to Notification Hub: {payload}")
+        log_event(logging.INFO, "Sending payload to Notification Hub", route="trigger_notification", payload=payload)
 
-        response = requests.post(full_uri, headers=headers, json=payload)
+        with span("notificationhub.send"):
+            response = requests.post(full_uri, headers=headers, json=payload)
         response.raise_for_status()
 
         logging.info(f"[trigger_notification] Notification sent successfully: {response.status_code}")
\ No newline at end of file
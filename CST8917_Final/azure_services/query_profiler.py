@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from pymongo.errors import OperationFailure
+from config.log_utils import log_event
+from config.trace_utils import span
+
+# Operations slower than this are logged and added to the slow-query summary
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+# Share of slow operations whose shape is explained (once per shape and worker); 0 disables explain
+EXPLAIN_SAMPLE_RATE = min(max(float(os.environ.get("EXPLAIN_SAMPLE_RATE", "0")), 0.0), 1.0)
+# Distinct shapes kept in the summary; the one with the least total time is evicted first
+SLOW_QUERY_MAX_SHAPES = int(os.environ.get("SLOW_QUERY_MAX_SHAPES", "200"))
+
+# (collection, operation, shape) -> {"count", "total_ms", "max_ms", "returned", "plan"}
+_summary = {}
+_summary_lock = threading.Lock()
+_explained = set()
+# Cleared when the server does not support getLastRequestStatistics (anything but Cosmos DB)
+_request_statistics_supported = True
+# "CommandNotFound", returned by servers without getLastRequestStatistics
+COMMAND_NOT_FOUND = 59
+
+def query_shape(value):
+    """
+    Returns the query or pipeline with every literal replaced by "?", so operations that only
+    differ in their values share one shape. Field names and operators are kept.
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(item, (dict, list, tuple)) for item in value):
+            return [query_shape(item) for item in value]
+        return ["?"] if value else []
+    return "?"
+
+def _shape_key(shape) -> str:
+    return json.dumps(shape, sort_keys=True, default=str)
+
+def returned_count(result):
+    """
+    Number of documents returned or written by a CosmosDBService operation, or None for cursors.
+    """
+    if result is None:
+        return 0
+    if isinstance(result, dict):
+        return 1
+    if isinstance(result, list):
+        return len(result)
+    for attribute in ("modified_count", "deleted_count"):
+        if hasattr(result, attribute):
+            return getattr(result, attribute)
+    if hasattr(result, "inserted_id"):
+        return 1
+    return None
+
+def request_statistics(db) -> dict:
+    """
+    Returns Cosmos DB's statistics (request charge, duration) for the last operation on the
+    connection, or None when the server does not support them. With pooled connections the
+    statistics may belong to another operation of this worker, so they are diagnostics only.
+    """
+    global _request_statistics_supported
+    if not _request_statistics_supported:
+        return None
+    try:
+        stats = db.command({"getLastRequestStatistics": 1})
+    except OperationFailure as e:
+        if e.code == COMMAND_NOT_FOUND:
+            _request_statistics_supported = False
+        return None
+    except Exception:
+        # e.g. a network error or throttling; the next slow operation tries again
+        return None
+    return {key: stats[key] for key in ("RequestCharge", "RequestDurationInMilliSeconds", "CommandName") if key in stats}
+
+def summarize_plan(plan: dict) -> dict:
+    """
+    Reduces an explain() result to its stages and whether any stage scans the whole collection.
+    Understands both the MongoDB and the Cosmos DB explain formats.
+    """
+    stages = []
+    counters = {}
+
+    def walk(node):
+        if isinstance(node, dict):
+            stage = node.get("stage") or node.get("stageName")
+            if stage:
+                stages.append(stage)
+            for key in ("totalDocsExamined", "totalKeysExamined", "nReturned",
+                        "retrievedDocumentCount", "outputDocumentCount"):
+                if isinstance(node.get(key), (int, float)):
+                    counters[key] = counters.get(key, 0) + node[key]
+            for item in node.values():
+                walk(item)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(plan)
+    return {"collectionScan": "COLLSCAN" in stages, "stages": stages, **counters}
+
+def _explain(db, collection_name: str, query, key: tuple):
+    try:
+        if isinstance(query, list):
+            plan = db.command("aggregate", collection_name, pipeline=query, explain=True)
+        else:
+            plan = db[collection_name].find(query or {}).explain()
+    except Exception as e:
+        logging.warning(f"[query_profiler] explain failed on {collection_name}: {str(e)}")
+        return
+    summary = summarize_plan(plan)
+    with _summary_lock:
+        if key in _summary:
+            _summary[key]["plan"] = summary
+    log_event(logging.WARNING if summary["collectionScan"] else logging.INFO, "Slow query plan",
+              route="query_profiler", collection=collection_name, operation=key[1], shape=key[2], plan=summary)
+
+def record_slow_operation(db, collection_name: str, operation: str, query, elapsed_ms: float, returned):
+    """
+    Logs a slow operation and adds it to the summary. A sample of new slow shapes is explained
+    on a background thread, so the request does not wait for the plan.
+    """
+    shape = _shape_key(query_shape(query))
+    key = (collection_name, operation, shape)
+    statistics = request_statistics(db)
+    log_event(logging.WARNING, "Slow database operation", route="query_profiler", collection=collection_name,
+              operation=operation, shape=shape, duration_ms=round(elapsed_ms, 2), returned=returned,
+              request_statistics=statistics)
+
+    with _summary_lock:
+        entry = _summary.get(key)
+        if entry is None:
+            if len(_summary) >= SLOW_QUERY_MAX_SHAPES:
+                del _summary[min(_summary, key=lambda item: _summary[item]["total_ms"])]
+            entry = _summary[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "returned": None, "plan": None}
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        entry["returned"] = returned
+        explain = (EXPLAIN_SAMPLE_RATE > 0 and query is not None and key not in _explained
+                   and random.random() < EXPLAIN_SAMPLE_RATE)
+        if explain:
+            _explained.add(key)
+    if explain:
+        threading.Thread(target=_explain, args=(db, collection_name, query, key), daemon=True).start()
+
+def slow_query_summary(limit: int = 20) -> list:
+    """
+    Returns the slow shapes of this worker ordered by their total time, worst first.
+    """
+    with _summary_lock:
+        items = [(key, dict(entry)) for key, entry in _summary.items()]
+    items.sort(key=lambda item: item[1]["total_ms"], reverse=True)
+    return [
+        {"collection": collection, "operation": operation, "shape": json.loads(shape),
+         "count": entry["count"], "totalMs": round(entry["total_ms"], 2), "maxMs": round(entry["max_ms"], 2),
+         "avgMs": round(entry["total_ms"] / entry["count"], 2), "lastReturned": entry["returned"],
+         "plan": entry["plan"]}
+        for (collection, operation, shape), entry in items[:limit]
+    ]
+
+class profiled(span):
+    """
+    A cosmos.<operation> span that also reports the operation to the slow-query profiler, e.g.
+        with profiled(self.db, collection_name, "find_document", query) as operation:
+            return operation.result(collection.find_one(query))
+    """
+    __slots__ = ("db", "collection_name", "operation", "query", "returned")
+
+    def __init__(self, db, collection_name: str, operation: str, query):
+        super().__init__(f"cosmos.{operation}", collection=collection_name)
+        self.db = db
+        self.collection_name = collection_name
+        self.operation = operation
+        self.query = query
+        self.returned = None
+
+    def result(self, value):
+        self.returned = returned_count(value)
+        return value
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        super().__exit__(exc_type, exc, tb)
+        if elapsed_ms >= SLOW_QUERY_MS and exc_type is None:
+            try:
+                record_slow_operation(self.db, self.collection_name, self.operation, self.query, elapsed_ms, self.returned)
+            except Exception as e:
+                logging.warning(f"[query_profiler] Could not record slow operation: {str(e)}")
+        return False
@@ -0,0 +1,159 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from config.metrics_utils import increment, register_gauge
+
+# Breaker states, exported as the dependency_circuit_state gauge
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+class DependencyUnavailable(Exception):
+    """
+    Raised instead of calling a dependency whose circuit is open or whose concurrency cap is
+    reached, and when a call exceeds its time budget. retry_after is a hint in seconds.
+    """
+
+    def __init__(self, dependency: str, reason: str, retry_after: int = 1):
+        super().__init__(f"{dependency} unavailable ({reason})")
+        self.dependency = dependency
+        self.reason = reason
+        self.retry_after = retry_after
+
+def is_dependency_failure(error: Exception) -> bool:
+    """
+    Client errors (4xx other than 408 and 429, e.g. a device that does not exist) are answers
+    from a healthy service and do not count towards opening the circuit.
+    """
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429):
+        return False
+    return True
+
+def _setting(dependency: str, name: str, default: float) -> float:
+    return float(os.environ.get(f"{dependency.upper()}_{name}", default))
+
+class Dependency:
+    """
+    Circuit breaker, time budget and bulkhead for one outbound dependency.
+
+    Calls run on a dedicated pool of max_concurrency threads, so a slow dependency can hold at
+    most that many threads and the request thread stops waiting after timeout_ms (except for
+    writes made with call_write). After
+    failure_threshold consecutive failures (timeouts included) the circuit opens and calls are
+    rejected for open_seconds; then a single probe call decides whether it closes again.
+    Settings can be overridden with <NAME>_TIMEOUT_MS, <NAME>_MAX_CONCURRENCY,
+    <NAME>_FAILURE_THRESHOLD and <NAME>_OPEN_SECONDS.
+    """
+
+    def __init__(self, name: str, timeout_ms: float, max_concurrency: int, failure_threshold: int = 5,
+                 open_seconds: float = 30):
+        self.name = name
+        self.timeout = _setting(name, "TIMEOUT_MS", timeout_ms) / 1000
+        self.max_concurrency = int(_setting(name, "MAX_CONCURRENCY", max_concurrency))
+        self.failure_threshold = int(_setting(name, "FAILURE_THRESHOLD", failure_threshold))
+        self.open_seconds = _setting(name, "OPEN_SECONDS", open_seconds)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=self.name)
+        return self.executor
+
+    def _reject(self, reason: str, retry_after: float = 1):
+        increment("dependency_rejected_total", dependency=self.name, reason=reason)
+        raise DependencyUnavailable(self.name, reason, max(1, int(retry_after + 0.999)))
+
+    def _admit(self) -> bool:
+        """
+        Returns True if the call is the half-open probe, raises if the circuit rejects it.
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return False
+            remaining = self.opened_at + self.open_seconds - time.monotonic()
+            if self.state == OPEN and remaining > 0:
+                self._reject("open", remaining)
+            if self.probing:
+                self._reject("open", 1)
+            self.state = HALF_OPEN
+            self.probing = True
+            return True
+
+    def _record(self, success: bool, probe: bool):
+        with self.lock:
+            if probe:
+                self.probing = False
+            if success:
+                if self.state != CLOSED:
+                    logging.info(f"[{self.name}] Circuit closed.")
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if probe or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logging.warning(f"[{self.name}] Circuit opened after {self.failures} consecutive failures.")
+                    increment("dependency_circuit_opened_total", dependency=self.name)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Calls fn within the breaker, budget and bulkhead. Exceptions raised by fn are re-raised
+        after being counted as failures.
+        """
+        return self._call(self.timeout, fn, args, kwargs)
+
+    def call_write(self, fn, *args, **kwargs):
+        """
+        Like call, but waits for fn to end instead of giving up after the time budget: a write
+        that is not idempotent keeps running after the caller stops waiting, so a retry could
+        apply it twice. Only the breaker and the bulkhead apply.
+        """
+        return self._call(None, fn, args, kwargs)
+
+    def _call(self, timeout, fn, args, kwargs):
+        probe = self._admit()
+        if not self.slots.acquire(blocking=False):
+            if probe:
+                with self.lock:
+                    self.probing = False
+            self._reject("bulkhead")
+
+        # The slot is held until the call really ends, even after the caller stopped waiting
+        context = contextvars.copy_context()
+        try:
+            future = self._get_executor().submit(context.run, fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeout:
+            self._record(False, probe)
+            self._reject("timeout")
+        except Exception as error:
+            self._record(not is_dependency_failure(error), probe)
+            raise
+        self._record(True, probe)
+        return result
+
+VISION = Dependency("vision", timeout_ms=3000, max_concurrency=4)
+EVENT_GRID = Dependency("eventgrid", timeout_ms=2000, max_concurrency=8)
+IOT_HUB = Dependency("iothub", timeout_ms=3000, max_concurrency=4)
+DEPENDENCIES = [VISION, EVENT_GRID, IOT_HUB]
+
+register_gauge("dependency_circuit_state", lambda: {
+    (("dependency", dependency.name),): dependency.state for dependency in DEPENDENCIES
+})
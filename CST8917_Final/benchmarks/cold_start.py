@@ -0,0 +1,72 @@
+"""
+Cold-start timing for the Function App.
+
+Each sample runs in a fresh interpreter, so module caches never carry over between runs.
+"app" is what the Functions host pays when it loads function_app.py; "eager" additionally
+imports every handler module and SDK, which is what loading the app used to cost.
+
+Usage (from the CST8917_Final directory):
+    python benchmarks/cold_start.py --runs 10
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "app": "import function_app",
+    "eager": (
+        "import function_app\n"
+        "from functions import user_functions, device_functions, telemetry_functions, conditions\n"
+        "from scheduled import trigger_functions"
+    ),
+}
+
+TIMER = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "{code}\n"
+    "print((time.perf_counter() - start) * 1000)"
+)
+
+def run_once(code: str) -> float:
+    output = subprocess.check_output(
+        [sys.executable, "-c", TIMER.format(code=code)],
+        cwd=APP_DIR,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="0"),
+    )
+    return float(output.decode().strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure Function App cold-start import time.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh interpreters per scenario")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    # One untimed run so .pyc files exist and only import work is measured
+    for code in SCENARIOS.values():
+        run_once(code)
+
+    results = {}
+    for name, code in SCENARIOS.items():
+        samples = [run_once(code) for _ in range(args.runs)]
+        results[name] = {
+            "median_ms": round(statistics.median(samples), 2),
+            "min_ms": round(min(samples), 2),
+            "max_ms": round(max(samples), 2),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, stats in results.items():
+        print(f"{name:>6}: median {stats['median_ms']:8.2f} ms  (min {stats['min_ms']:.2f}, max {stats['max_ms']:.2f})")
+    saved = results["eager"]["median_ms"] - results["app"]["median_ms"]
+    print(f"Deferred by lazy loading: {saved:.2f} ms")
+
+if __name__ == "__main__":
+    main()
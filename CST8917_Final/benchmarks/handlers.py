@@ -0,0 +1,211 @@
+"""
+Offline micro-benchmarks for the handler hot paths.
+
+Drives post_telemetry, get_telemetry, get_devices, get_users, check_conditions and login_user
+in process against the stand-ins in standins.py, on synthetic data from json_encoding.py.
+Results can be saved as a baseline; later runs at the same scale fail (exit code 1) when a
+scenario's median is slower than the baseline by more than --tolerance.
+
+Baselines depend on the machine, so save one per machine or CI runner:
+    python benchmarks/handlers.py --users 20 --devices 4 --readings 500 --save-baseline
+    python benchmarks/handlers.py --users 20 --devices 4 --readings 500
+
+Requires mongomock (pip install mongomock).
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standins
+
+STANDINS = standins.install()
+
+import azure.functions as func
+from config.jwt_utils import create_token
+from config.password_utils import hash_password
+from functions import user_functions, device_functions, telemetry_functions
+from json_encoding import build_users, VALUE_TYPES
+from load_generator import multipart
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+PASSWORD = "Benchmark-Password-1"
+SCENARIOS = [
+    "post_telemetry", "post_telemetry_image", "get_telemetry", "get_devices", "get_devices_summary",
+    "get_device_states", "get_users", "get_users_filtered", "check_conditions", "login_user",
+]
+
+def seed(users: int, devices: int, readings: int) -> dict:
+    """
+    Loads synthetic users into the stand-in database. The first user is an admin.
+    Returns the ids and tokens the scenarios need.
+    """
+    documents = build_users(users, devices, readings, native_dates=True)
+    password = hash_password(PASSWORD)
+    for document in documents:
+        document["password"] = password
+        document["version"] = 1
+    documents[0]["type"] = "admin"
+    STANDINS.users().delete_many({})
+    STANDINS.users().insert_many(documents)
+
+    # One range condition per value type, shared by all devices
+    STANDINS.conditions().delete_many({})
+    STANDINS.conditions().insert_many([
+        {"_id": str(uuid.uuid4()), "type": "condition", "valueType": value_type, "deviceId": None,
+         "minValue": 0, "maxValue": 80}
+        for value_type in VALUE_TYPES
+    ])
+
+    user = documents[-1]
+    device = user["Devices"][0]
+    telemetry = device["telemetryData"]
+    return {
+        "user_id": user["_id"],
+        "email": user["email"],
+        "token": create_token(user["_id"]),
+        "admin_token": create_token(documents[0]["_id"]),
+        "device_id": device["deviceId"],
+        "start": telemetry[len(telemetry) // 4]["event_date"].isoformat() if telemetry else None,
+        "end": telemetry[len(telemetry) // 2]["event_date"].isoformat() if telemetry else None,
+    }
+
+def request(method: str, route: str, token: str = None, params: dict = None, body: bytes = b"",
+            content_type: str = "application/json") -> func.HttpRequest:
+    headers = {"Content-Type": content_type, "Accept-Encoding": "gzip"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    return func.HttpRequest(method=method, url=f"http://localhost/api/{route}", headers=headers,
+                            params=params or {}, body=body)
+
+def build_scenarios(context: dict) -> dict:
+    """
+    Returns name -> callable performing one request and returning its status code.
+    """
+    values = json.dumps([{"valueType": value_type, "value": 21.5} for value_type in VALUE_TYPES[:3]])
+    telemetry_body, telemetry_type = multipart({"deviceId": context["device_id"], "values": values})
+    image_body, image_type = multipart(
+        {"deviceId": context["device_id"], "values": values}, {"image": ("sensor.jpg", os.urandom(64 * 1024))}
+    )
+    login_body = json.dumps({"email": context["email"], "password": PASSWORD}).encode()
+    range_params = {"deviceId": context["device_id"]}
+    if context["start"]:
+        range_params.update(startDate=context["start"], endDate=context["end"])
+
+    return {
+        "post_telemetry": lambda: telemetry_functions.post_telemetry(
+            request("POST", "telemetry", body=telemetry_body, content_type=telemetry_type)).status_code,
+        "post_telemetry_image": lambda: telemetry_functions.post_telemetry(
+            request("POST", "telemetry", body=image_body, content_type=image_type)).status_code,
+        "get_telemetry": lambda: telemetry_functions.get_telemetry(
+            request("GET", "telemetry", context["token"], params=range_params)).status_code,
+        "get_devices": lambda: device_functions.get_devices(
+            request("GET", "devices", context["token"])).status_code,
+        "get_devices_summary": lambda: device_functions.get_devices(
+            request("GET", "devices", context["token"], params={"view": "summary"})).status_code,
+        "get_device_states": lambda: device_functions.get_device_states(
+            request("GET", "devices/state", context["token"])).status_code,
+        "get_users": lambda: user_functions.get_users(
+            request("GET", "users", context["admin_token"])).status_code,
+        "get_users_filtered": lambda: user_functions.get_users(
+            request("GET", "users", context["admin_token"], params={"valueType": VALUE_TYPES[0], "valueMin": "50"})).status_code,
+        "check_conditions": lambda: telemetry_functions.check_conditions(
+            context["device_id"], json.loads(values), context["user_id"]) or 200,
+        "login_user": lambda: user_functions.login_user(
+            request("POST", "user/login", body=login_body)).status_code,
+    }
+
+def measure(scenario, iterations: int) -> dict:
+    scenario()  # Untimed call so lazy imports and caches are excluded
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        status = scenario()
+        samples.append((time.perf_counter() - start) * 1000)
+        if status >= 400:
+            raise RuntimeError(f"Scenario returned HTTP {status}")
+    samples.sort()
+    return {
+        "median_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "min_ms": round(samples[0], 3),
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns the scenarios whose median regressed beyond the tolerance.
+    """
+    regressions = []
+    for name, stats in results.items():
+        expected = baseline.get(name)
+        if expected and stats["median_ms"] > expected["median_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: {stats['median_ms']:.3f} ms vs baseline {expected['median_ms']:.3f} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handler hot paths against in-process stand-ins.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--readings", type=int, default=500, help="Readings per device")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--scenario", action="append", help="Run only these scenarios (repeatable)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the baseline for this scale")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a run fails (0.25 = 25%%)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    selected = args.scenario or SCENARIOS
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in selected:
+        # Every scenario starts from the same data; post_telemetry grows the documents
+        context = seed(args.users, args.devices, args.readings)
+        results[name] = measure(build_scenarios(context)[name], args.iterations)
+
+    scale = f"{args.users}x{args.devices}x{args.readings}"
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baselines = json.load(file)
+
+    if args.json:
+        print(json.dumps({"scale": scale, "results": results}, indent=2))
+    else:
+        print(f"scale {scale} (users x devices x readings), {args.iterations} iterations")
+        for name, stats in results.items():
+            print(f"{name:>22}: median {stats['median_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms  min {stats['min_ms']:9.3f} ms")
+
+    if args.save_baseline:
+        baselines[scale] = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {**baselines.get(scale, {}).get("results", {}), **results},
+        }
+        with open(args.baseline, "w") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        print(f"Baseline for {scale} saved to {args.baseline}")
+        return
+
+    if scale not in baselines:
+        print(f"No baseline for {scale} in {args.baseline}; run with --save-baseline to create one.")
+        return
+    regressions = compare(results, baselines[scale]["results"], args.tolerance)
+    if regressions:
+        print("Performance regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"No regressions beyond {args.tolerance:.0%} of the baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Encode-time micro-benchmark for config.json_utils on a get_users style payload.
+
+Compares the shared encoder (orjson when installed) with the stdlib json.dumps call
+the handlers used before.
+
+Usage (from the CST8917_Final directory):
+    python benchmarks/json_encoding.py --users 50 --devices 4 --readings 200
+"""
+import os
+import sys
+import json
+import uuid
+import random
+import argparse
+import datetime
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import json_utils
+
+VALUE_TYPES = ["temperature", "humidity", "light", "uv", "air pressure"]
+
+def build_users(users: int, devices: int, readings: int, native_dates: bool = False) -> list:
+    """
+    Builds user documents shaped like the ones get_users returns.
+    With native_dates, dates are datetimes as stored in the database instead of ISO strings.
+    """
+    date = (lambda value: value) if native_dates else (lambda value: value.isoformat())
+    rng = random.Random(42)
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    result = []
+    for u in range(users):
+        user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        user_devices = []
+        for d in range(devices):
+            device_id = f"device-{u}-{d}"
+            telemetry = []
+            for r in range(readings):
+                telemetry.append({
+                    "deviceId": device_id,
+                    "eventId": str(uuid.UUID(int=rng.getrandbits(128))),
+                    "event_date": date(start + datetime.timedelta(minutes=r)),
+                    "values": [
+                        {"valueType": value_type, "value": round(rng.uniform(-10, 100), 2)}
+                        for value_type in VALUE_TYPES[:3]
+                    ],
+                })
+            user_devices.append({
+                "deviceId": device_id,
+                "deviceName": f"Sensor {d}",
+                "sensorType": "multi",
+                "location": {"name": "Lab", "longitude": "-75.69", "latitude": "45.42"},
+                "registrationDate": date(start),
+                "telemetryData": telemetry,
+            })
+        result.append({
+            "_id": user_id,
+            "userId": user_id,
+            "firstName": "Test",
+            "lastName": f"User {u}",
+            "email": f"user{u}@example.com",
+            "phone": None,
+            "Devices": user_devices,
+            "type": "user",
+        })
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON encoding of a get_users payload.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--readings", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = build_users(args.users, args.devices, args.readings)
+    size = len(json_utils.dumps(payload))
+
+    stdlib = min(timeit.repeat(lambda: json.dumps(payload), number=1, repeat=args.repeat))
+    shared = min(timeit.repeat(lambda: json_utils.dumps(payload), number=1, repeat=args.repeat))
+
+    print(f"Payload: {args.users} users x {args.devices} devices x {args.readings} readings, {size / 1024:.0f} KiB")
+    print(f"json.dumps          : {stdlib * 1000:8.2f} ms")
+    print(f"json_utils ({json_utils.BACKEND:>7}): {shared * 1000:8.2f} ms  ({stdlib / shared:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+Load generator replaying the Karate flows (karate-tests/scenarios and use-cases) over HTTP.
+
+Flows are started at --rate per second (Poisson arrivals, open loop) or back to back by every
+worker when --rate is 0 (closed loop), on --concurrency worker threads for --duration seconds.
+Each flow runs its Karate steps in order; a step with an unexpected status ends the flow.
+The report gives p50/p95/p99 latency per route and the sustained request and flow throughput.
+
+Without --base-url the routes are served in process by the Functions host emulation in
+standins.py, backed by the local service stand-ins (requires mongomock). With --base-url the
+flows run against a running host, e.g. `func start` with its own local resources.
+
+Usage (from the CST8917_Final directory):
+    python benchmarks/load_generator.py --concurrency 8 --rate 20 --duration 60 --image-ratio 0.1
+    python benchmarks/load_generator.py --base-url http://localhost:7071/api --flow telemetry_operations
+    python benchmarks/load_generator.py --serve-only --port 7071
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = "Load-Test-Password-1"
+VALUE_TYPES = ["temperature", "humidity", "pressure"]
+# Relative frequency of each flow in the default mix
+FLOW_WEIGHTS = {
+    "user_operations": 1,
+    "device_operations": 2,
+    "telemetry_operations": 6,
+    "add_device_to_existing_user": 1,
+    "conditions": 2,
+}
+
+class FlowError(Exception):
+    """
+    A step returned an unexpected status; the rest of the flow is skipped.
+    """
+
+class Recorder:
+    """
+    Thread-safe latency samples and error counts per route.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.flows = {}
+        self.failed_flows = {}
+        self.failures = set()
+        self.lag = []
+
+    def request(self, route: str, elapsed_ms: float, ok: bool):
+        with self.lock:
+            self.samples.setdefault(route, []).append(elapsed_ms)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def flow(self, name: str, ok: bool, lag_ms: float = None, failure: str = None):
+        with self.lock:
+            if failure and failure not in self.failures:
+                # Each distinct failure is printed once
+                self.failures.add(failure)
+                print(f"  flow {name} failed: {failure}", file=sys.stderr)
+            self.flows[name] = self.flows.get(name, 0) + 1
+            if not ok:
+                self.failed_flows[name] = self.failed_flows.get(name, 0) + 1
+            if lag_ms is not None:
+                self.lag.append(lag_ms)
+
+class Client:
+    """
+    Minimal HTTP client for the API; every call is timed under its route label.
+    """
+
+    def __init__(self, base_url: str, recorder: Recorder, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def call(self, method: str, route: str, expected: int = 200, token: str = None, params: dict = None,
+             json_body=None, body: bytes = None, content_type: str = "application/json", label: str = None):
+        url = f"{self.base_url}/{route}"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        if json_body is not None:
+            body = json.dumps(json_body).encode("utf-8")
+        headers = {"Content-Type": content_type}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        request = urllib.request.Request(url, data=body, headers=headers, method=method)
+
+        label = label or f"{method} /{route}"
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                status, payload = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        except OSError as e:
+            self.recorder.request(label, (time.perf_counter() - start) * 1000, False)
+            raise FlowError(f"{label}: {e}")
+        self.recorder.request(label, (time.perf_counter() - start) * 1000, status == expected)
+
+        if status != expected:
+            raise FlowError(f"{label}: expected HTTP {expected}, got {status}")
+        try:
+            return json.loads(payload) if payload else None
+        except ValueError:
+            return payload
+
+def multipart(fields: dict, files: dict = None):
+    """
+    Encodes form fields and (filename, bytes) files as multipart/form-data.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in (files or {}).items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode() + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def new_email() -> str:
+    return f"load-{uuid.uuid4().hex[:12]}@example.com"
+
+def new_device(device_id: str = None) -> dict:
+    return {
+        "deviceId": device_id or f"load-{uuid.uuid4().hex[:12]}",
+        "deviceName": "Load Test Sensor",
+        "sensorType": "Temperature Sensor",
+        "location": {"name": "Lab", "latitude": "45.42", "longitude": "-75.69"},
+    }
+
+class Flows:
+    """
+    The Karate flows. Each one takes a pre-created account {email, deviceId} and a random
+    generator, and raises FlowError when a step fails.
+    """
+
+    def __init__(self, client: Client, image_ratio: float, image_bytes: int, readings: int):
+        self.client = client
+        self.image_ratio = image_ratio
+        self.image_bytes = image_bytes
+        self.readings = readings
+
+    def login(self, email: str) -> str:
+        return self.client.call("POST", "user/login", json_body={"email": email, "password": PASSWORD})["token"]
+
+    def post_telemetry(self, device_id: str, rng: random.Random):
+        values = json.dumps([
+            {"valueType": value_type, "value": round(rng.uniform(10, 30), 1)} for value_type in VALUE_TYPES
+        ])
+        files = None
+        label = "POST /telemetry"
+        if rng.random() < self.image_ratio:
+            files = {"image": ("sensor.jpg", os.urandom(self.image_bytes))}
+            label = "POST /telemetry (image)"
+        body, content_type = multipart({"deviceId": device_id, "values": values}, files)
+        self.client.call("POST", "telemetry", 201, body=body, content_type=content_type, label=label)
+
+    def user_operations(self, account: dict, rng: random.Random):
+        # scenarios/user-operations.feature: create, login, get, update and delete a user
+        email = new_email()
+        self.client.call("POST", "user", 201, json_body={
+            "firstName": "Load", "lastName": "Test", "email": email, "password": PASSWORD, "phone": "1234567890",
+        })
+        token = self.login(email)
+        self.client.call("GET", "user", token=token)
+        self.client.call("PUT", "user", token=token, json_body={"firstName": "Updated", "phone": "0987654321"})
+        self.client.call("DELETE", "user", token=token)
+
+    def device_operations(self, account: dict, rng: random.Random):
+        # scenarios/device-operations.feature: login, then create, get, update and delete a device
+        token = self.login(account["email"])
+        device = new_device()
+        self.client.call("POST", "device", 201, token=token, json_body=device)
+        self.client.call("GET", "devices", token=token, params={"deviceId": device["deviceId"]})
+        self.client.call("PUT", "device", token=token, json_body={
+            "deviceId": device["deviceId"], "update": {"deviceName": "Updated Sensor"},
+        })
+        self.client.call("DELETE", "device", token=token, json_body={"deviceId": device["deviceId"]})
+
+    def telemetry_operations(self, account: dict, rng: random.Random):
+        # scenarios/telemetry-operations.feature: login, get the user, post, read back and delete telemetry
+        token = self.login(account["email"])
+        self.client.call("GET", "user", token=token)
+        for _ in range(self.readings):
+            self.post_telemetry(account["deviceId"], rng)
+        telemetry = self.client.call("GET", "telemetry", token=token, params={"deviceId": account["deviceId"]})
+        if telemetry:
+            self.client.call("DELETE", "telemetry", token=token, json_body={"eventId": telemetry[-1]["eventId"]})
+
+    def add_device_to_existing_user(self, account: dict, rng: random.Random):
+        # use-cases/add-device-to-exist-user.feature: login, add a device and send its first telemetry.
+        # The device is deleted afterwards so the account does not grow for the whole run.
+        token = self.login(account["email"])
+        device = new_device()
+        self.client.call("POST", "device", 201, token=token, json_body=device)
+        self.post_telemetry(device["deviceId"], rng)
+        self.client.call("DELETE", "device", token=token, json_body={"deviceId": device["deviceId"]})
+
+    def conditions(self, account: dict, rng: random.Random):
+        # scenarios/conditions.feature: create, list, update and delete a condition
+        token = self.login(account["email"])
+        created = self.client.call("POST", "conditions", 201, token=token, json_body={
+            "deviceId": account["deviceId"], "valueType": rng.choice(VALUE_TYPES),
+            "minValue": 0, "maxValue": 80, "unit": "C",
+        })
+        condition_id = created["created_conditions"][0]["_id"]
+        self.client.call("GET", "conditions", token=token, params={"deviceId": account["deviceId"]})
+        self.client.call("PUT", "conditions", token=token, json_body={"conditionId": condition_id, "maxValue": 90})
+        self.client.call("DELETE", "conditions", token=token, json_body={"conditionId": condition_id})
+
+def create_accounts(client: Client, count: int) -> list:
+    """
+    Creates the accounts (each with one device) the flows log in with, like the fixed Karate
+    test users. Setup requests are not part of the report.
+    """
+    accounts = []
+    for _ in range(count):
+        email = new_email()
+        token = client.call("POST", "user", 201, json_body={
+            "firstName": "Load", "lastName": "Account", "email": email, "password": PASSWORD,
+        })["token"]
+        device = new_device()
+        client.call("POST", "device", 201, token=token, json_body=device)
+        accounts.append({"email": email, "token": token, "deviceId": device["deviceId"]})
+    return accounts
+
+def delete_accounts(client: Client, accounts: list):
+    for account in accounts:
+        try:
+            client.call("DELETE", "user", token=account["token"])
+        except FlowError:
+            pass
+
+def percentile(samples: list, fraction: float) -> float:
+    """
+    Nearest-rank percentile of sorted samples.
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))]
+
+def run(flows: Flows, accounts: list, recorder: Recorder, selected: list, concurrency: int, rate: float,
+        duration: float, seed: int) -> float:
+    """
+    Runs the flow mix for duration seconds and returns the elapsed time, including the flows
+    still in progress at the end.
+    """
+    rng = random.Random(seed)
+    weights = [FLOW_WEIGHTS[name] for name in selected]
+    local = threading.local()
+
+    def run_flow(name: str, scheduled: float = None):
+        if not hasattr(local, "rng"):
+            local.rng = random.Random(rng.random())
+        lag_ms = (time.perf_counter() - scheduled) * 1000 if scheduled is not None else None
+        try:
+            getattr(flows, name)(local.rng.choice(accounts), local.rng)
+            recorder.flow(name, True, lag_ms)
+        except FlowError as e:
+            recorder.flow(name, False, lag_ms, str(e))
+
+    start = time.perf_counter()
+    deadline = start + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if rate > 0:
+            # Open loop: arrivals do not wait for earlier flows, so queueing shows up as start lag
+            futures = []
+            next_arrival = start
+            while True:
+                next_arrival += rng.expovariate(rate)
+                if next_arrival >= deadline:
+                    break
+                time.sleep(max(0.0, next_arrival - time.perf_counter()))
+                futures.append(executor.submit(run_flow, rng.choices(selected, weights)[0], next_arrival))
+            wait(futures)
+        else:
+            # Closed loop: every worker starts its next flow as soon as the previous one ends
+            def worker(worker_seed: int):
+                worker_rng = random.Random(worker_seed)
+                while time.perf_counter() < deadline:
+                    run_flow(worker_rng.choices(selected, weights)[0])
+            wait([executor.submit(worker, rng.random()) for _ in range(concurrency)])
+    return time.perf_counter() - start
+
+def report(recorder: Recorder, elapsed: float) -> dict:
+    routes = {}
+    for route, samples in sorted(recorder.samples.items()):
+        samples = sorted(samples)
+        routes[route] = {
+            "requests": len(samples),
+            "errors": recorder.errors.get(route, 0),
+            "p50_ms": round(percentile(samples, 0.50), 2),
+            "p95_ms": round(percentile(samples, 0.95), 2),
+            "p99_ms": round(percentile(samples, 0.99), 2),
+            "max_ms": round(samples[-1], 2),
+            "per_second": round(len(samples) / elapsed, 2),
+        }
+    requests = sum(stats["requests"] for stats in routes.values())
+    lag = sorted(recorder.lag)
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "requests": requests,
+        "errors": sum(recorder.errors.values()),
+        "requests_per_second": round(requests / elapsed, 2),
+        "flows": dict(recorder.flows),
+        "failed_flows": dict(recorder.failed_flows),
+        "flows_per_second": round(sum(recorder.flows.values()) / elapsed, 2),
+        "start_lag_p95_ms": round(percentile(lag, 0.95), 2) if lag else None,
+        "routes": routes,
+    }
+
+def print_report(results: dict):
+    print(f"{results['requests']} requests in {results['elapsed_s']} s: "
+          f"{results['requests_per_second']} requests/s, {results['flows_per_second']} flows/s, {results['errors']} errors")
+    if results["start_lag_p95_ms"] is not None:
+        print(f"flow start lag p95: {results['start_lag_p95_ms']} ms (grows when the arrival rate exceeds capacity)")
+    for name, count in sorted(results["flows"].items()):
+        print(f"  {name:>28}: {count} flows, {results['failed_flows'].get(name, 0)} failed")
+    print(f"{'route':>26} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    for route, stats in results["routes"].items():
+        print(f"{route:>26} {stats['requests']:>9} {stats['errors']:>7} {stats['p50_ms']:>9.2f} "
+              f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['per_second']:>8.2f}")
+
+def start_local_host(port: int):
+    """
+    Serves the function_app routes in a background thread, backed by the stand-ins.
+    """
+    import standins
+    standins.install()
+    server = standins.serve(port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api"
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the Karate flows as load and report latency per route.")
+    parser.add_argument("--base-url", help="API base URL of a running host (default: serve locally on the stand-ins)")
+    parser.add_argument("--port", type=int, default=0, help="Port for the local host (default: any free port)")
+    parser.add_argument("--serve-only", action="store_true", help="Only run the local host, e.g. for the Karate suite")
+    parser.add_argument("--flow", action="append", choices=list(FLOW_WEIGHTS), help="Run only these flows (repeatable)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Worker threads")
+    parser.add_argument("--rate", type=float, default=0, help="Flow arrivals per second; 0 runs the workers back to back")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to start new flows for")
+    parser.add_argument("--image-ratio", type=float, default=0.1, help="Share of telemetry posts that carry an image")
+    parser.add_argument("--image-kb", type=int, default=64, help="Size of the uploaded images")
+    parser.add_argument("--readings", type=int, default=3, help="Telemetry posts per telemetry_operations flow")
+    parser.add_argument("--accounts", type=int, help="Pre-created accounts the flows log in with (default: --concurrency)")
+    parser.add_argument("--timeout", type=float, default=30, help="Request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+    if not 0 <= args.image_ratio <= 1:
+        parser.error("--image-ratio must be between 0 and 1")
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        server, base_url = start_local_host(args.port)
+        print(f"Serving the function_app routes on the stand-ins at {base_url}", file=sys.stderr)
+        if args.serve_only:
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                return
+    elif args.serve_only:
+        parser.error("--serve-only cannot be combined with --base-url")
+
+    recorder = Recorder()
+    setup_client = Client(base_url, Recorder(), args.timeout)
+    accounts = create_accounts(setup_client, args.accounts or args.concurrency)
+    flows = Flows(Client(base_url, recorder, args.timeout), args.image_ratio, args.image_kb * 1024, args.readings)
+    try:
+        elapsed = run(flows, accounts, recorder, args.flow or list(FLOW_WEIGHTS), args.concurrency, args.rate,
+                      args.duration, args.seed)
+    finally:
+        delete_accounts(setup_client, accounts)
+        if server:
+            server.shutdown()
+
+    results = report(recorder, elapsed)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+In-process stand-ins for the Azure services used by the handlers.
+
+install() must run before any handler module is imported. It replaces the configuration and
+the shared client getters, so the handler code itself runs unchanged:
+
+    Cosmos DB (Mongo API)  mongomock client (pip install mongomock)
+    Blob Storage           InMemoryBlobServiceClient
+    Event Grid             RecordingEventGridClient
+    IoT Hub                InMemoryRegistryManager
+    Computer Vision        StaticVisionClient
+    Notification Hub       calls are recorded in Standins.notifications
+
+Only the network round trips are removed; request parsing, queries, serialization,
+compression and hashing all run as in the Function App.
+
+serve() additionally exposes the function_app routes over HTTP, as `func start` would, so
+HTTP clients (load_generator.py, the Karate suite) can run against the stand-ins.
+"""
+import os
+import sys
+import types
+import base64
+import asyncio
+import threading
+import inspect
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCHMARK_CONFIG = {
+    "COSMOS_DB_CONNECTION_STRING": "mongodb://standin",
+    "COSMOS_DB_NAME": "benchmark",
+    "COLLECTION_NAME": "Users",
+    "CONDITION_COLLECTION_NAME": "Conditions",
+    "BLOB_STORAGE_CONNECTION_STRING": "UseDevelopmentStorage=true",
+    "BLOB_CONTAINER_NAME": "images",
+    "EVENTGRID_TOPIC_ENDPOINT": "https://standin.eventgrid.azure.net/api/events",
+    "EVENTGRID_TOPIC_KEY": "standin",
+    "IOTHUB_CONNECTION_STRING": "HostName=standin.azure-devices.net;SharedAccessKeyName=standin;SharedAccessKey=c3RhbmRpbg==",
+    "COGNITIVE_SERVICE_ENDPOINT": "https://standin.cognitiveservices.azure.com/",
+    "COGNITIVE_SERVICE_KEY": "standin",
+    "COMMUNICATION_SERVICE_CONNECTION_STRING": "endpoint=https://standin.communication.azure.com/;accesskey=c3RhbmRpbg==",
+    "NOTIFICATION_HUB_NAME": "standin",
+    "JWT_SECRET": "benchmark-only-secret-not-used-by-any-deployment",
+    "JWT_ALGORITHM": "HS256",
+}
+
+class InMemoryBlobClient:
+    def __init__(self, container, name: str):
+        self.container = container
+        self.name = name
+        self.url = f"https://{container.service.account_name}.blob.core.windows.net/{container.name}/{name}"
+
+    def upload_blob(self, data, overwrite: bool = False, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not isinstance(data, (bytes, bytearray)):
+            data = b"".join(data)
+        self.container.blobs[self.name] = bytes(data)
+
+class InMemoryContainerClient:
+    def __init__(self, service, name: str):
+        self.service = service
+        self.name = name
+        self.blobs = service.containers.setdefault(name, {})
+
+    def get_blob_client(self, name: str) -> InMemoryBlobClient:
+        return InMemoryBlobClient(self, name)
+
+    def delete_blob(self, name: str):
+        self.blobs.pop(name, None)
+
+class InMemoryBlobServiceClient:
+    account_name = "standin"
+    credential = types.SimpleNamespace(account_key=base64.b64encode(b"standin-account-key").decode())
+
+    def __init__(self):
+        self.containers = {}
+
+    def get_container_client(self, name: str) -> InMemoryContainerClient:
+        return InMemoryContainerClient(self, name)
+
+class RecordingEventGridClient:
+    def __init__(self):
+        self.events = 0
+
+    def send(self, events):
+        self.events += len(events)
+
+class DeviceNotFound(LookupError):
+    # Like the SDK's HttpOperationError for a 404, a client error that does not trip the breaker
+    status_code = 404
+
+class InMemoryRegistryManager:
+    def __init__(self):
+        self.devices = {}
+
+    def get_device(self, device_id: str):
+        if device_id not in self.devices:
+            raise DeviceNotFound(f"Device {device_id} not found")
+        return self.devices[device_id]
+
+    def create_device_with_sas(self, device_id: str, primary_key=None, secondary_key=None, status="enabled"):
+        self.devices[device_id] = {"deviceId": device_id, "status": status}
+        return self.devices[device_id]
+
+    def delete_device(self, device_id: str):
+        self.devices.pop(device_id, None)
+
+class StaticVisionClient:
+    """
+    Returns the same analysis (no fire) for every image.
+    """
+
+    def analyze_image(self, image_url: str, visual_features=None):
+        caption = types.SimpleNamespace(text="a room with a sensor", confidence=0.9)
+        return types.SimpleNamespace(
+            tags=[types.SimpleNamespace(name="indoor", confidence=0.95)],
+            description=types.SimpleNamespace(captions=[caption]),
+            as_dict=lambda: {"tags": [{"name": "indoor", "confidence": 0.95}]},
+        )
+
+def _positional_element(array: list, spec: dict, array_path: str):
+    """
+    The first element of the array matched by the query, which is the one $ refers to.
+    """
+    from mongomock.filtering import filter_applies
+    condition = spec.get(array_path)
+    if isinstance(condition, dict) and "$elemMatch" in condition:
+        subspec = condition["$elemMatch"]
+    else:
+        prefix = array_path + "."
+        subspec = {key[len(prefix):]: value for key, value in spec.items() if key.startswith(prefix)}
+    return next((item for item in array if filter_applies(subspec, item)), None)
+
+def _patch_mongomock():
+    """
+    mongomock does not implement $mergeObjects, which the get_users pipeline uses. Its positional
+    updates fail on fields that do not exist yet and its $max cannot compare documents, both of
+    which the last device states written by post_telemetry need. Its positional $pull only
+    compares fields for equality, while the compaction pulls readings with $in, and it resolves
+    $ again for every field, while deletes update fields their query matched on.
+    """
+    import operator
+    import mongomock.aggregate
+    import mongomock.collection
+    from mongomock.filtering import bson_compare
+    parser = mongomock.aggregate._Parser
+    if getattr(parser, "_standin_merge_objects", False):
+        return
+    parse = parser.parse
+    collection = mongomock.collection.Collection
+    update_positional = collection._update_document_fields_positional
+    apply_update = collection._apply_update_document
+
+    # Elements matched by $ in the update being applied on this thread: MongoDB resolves $ once,
+    # before the update, while mongomock would resolve it again for every field
+    resolved = threading.local()
+
+    def positional_element(array, spec, array_path):
+        cache = getattr(resolved, "elements", None)
+        if cache is None:
+            return _positional_element(array, spec, array_path)
+        key = (id(array), array_path)
+        if key not in cache:
+            cache[key] = _positional_element(array, spec, array_path)
+        return cache[key]
+
+    def update_positional_creating_fields(self, doc, fields, spec, updater, subdocument=None):
+        for key, value in fields.items():
+            parts = key.split(".")
+            if "$" not in parts[:-1]:
+                update_positional(self, doc, {key: value}, spec, updater)
+                continue
+            target = doc
+            for index, part in enumerate(parts[:-1]):
+                target = positional_element(target, spec, ".".join(parts[:index])) if part == "$" else target.setdefault(part, {})
+            updater(target, parts[-1], value)
+        return None
+
+    def max_updater(doc, field_name, value):
+        if isinstance(doc, dict) and (field_name not in doc or bson_compare(operator.gt, value, doc[field_name])):
+            doc[field_name] = value
+
+    def apply_update_resolving_positional_once(self, existing_document, spec, document, was_insert):
+        resolved.elements = {}
+        try:
+            return apply_update_with_positional_pull(self, existing_document, spec, document, was_insert)
+        finally:
+            resolved.elements = None
+
+    def apply_update_with_positional_pull(self, existing_document, spec, document, was_insert):
+        from mongomock.filtering import filter_applies
+        pulls = document.get("$pull") or {}
+        positional = {key: value for key, value in pulls.items() if "$" in key.split(".")}
+        if not positional:
+            return apply_update(self, existing_document, spec, document, was_insert)
+        # $ refers to the element matched before the update, so the arrays are found first
+        targets = []
+        for key, condition in positional.items():
+            parts = key.split(".")
+            target = existing_document
+            for index, part in enumerate(parts[:-1]):
+                target = positional_element(target, spec, ".".join(parts[:index])) if part == "$" else target.get(part, {})
+            targets.append((target, parts[-1], condition))
+        rest = {key: value for key, value in pulls.items() if key not in positional}
+        document = {operator: fields for operator, fields in document.items() if operator != "$pull"}
+        if rest:
+            document["$pull"] = rest
+        # mongomock detects changes by comparing the document, so the pulls can be made in place
+        result = apply_update(self, existing_document, spec, document, was_insert) if document else None
+        for target, field, condition in targets:
+            if isinstance(target, dict) and isinstance(target.get(field), list):
+                target[field] = [item for item in target[field] if not filter_applies(condition, item)]
+        return result
+
+    collection._update_document_fields_positional = update_positional_creating_fields
+    collection._apply_update_document = apply_update_resolving_positional_once
+    mongomock.collection._updaters["$max"] = max_updater
+
+    def parse_with_merge_objects(self, expression):
+        if isinstance(expression, dict) and list(expression) == ["$mergeObjects"]:
+            merged = {}
+            for part in expression["$mergeObjects"]:
+                merged.update(self.parse(part) or {})
+            return merged
+        return parse(self, expression)
+
+    parser.parse = parse_with_merge_objects
+    parser._standin_merge_objects = True
+
+class Standins:
+    """
+    The installed stand-ins, for seeding data and inspecting side effects.
+    """
+
+    def __init__(self):
+        import mongomock
+        _patch_mongomock()
+        self.mongo = mongomock.MongoClient(tz_aware=True)
+        self.blob = InMemoryBlobServiceClient()
+        self.eventgrid = RecordingEventGridClient()
+        self.registry = InMemoryRegistryManager()
+        self.vision = StaticVisionClient()
+        self.notifications = []
+
+    @property
+    def db(self):
+        return self.mongo[BENCHMARK_CONFIG["COSMOS_DB_NAME"]]
+
+    def users(self):
+        return self.db[BENCHMARK_CONFIG["COLLECTION_NAME"]]
+
+    def conditions(self):
+        return self.db[BENCHMARK_CONFIG["CONDITION_COLLECTION_NAME"]]
+
+def install() -> Standins:
+    """
+    Installs the benchmark configuration and the service stand-ins. Must be called before the
+    handler modules are imported, since they import get_config by name.
+    """
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+
+    # The benchmark never reads the real configuration, so no live resource can be reached
+    azure_config = types.ModuleType("config.azure_config")
+    azure_config.get_azure_config = lambda: dict(BENCHMARK_CONFIG)
+    sys.modules["config.azure_config"] = azure_config
+    from config import config_utils
+    config_utils.get_azure_config = azure_config.get_azure_config
+    config_utils.get_config.cache_clear()
+
+    standins = Standins()
+    from azure_services import cosmosdb_service, blob_storage_service, eventtopic_service, iot_hub_service, cognitive_serivce
+    from azure_services.notification_service import NotificationService
+    cosmosdb_service.get_mongo_client = lambda: standins.mongo
+    blob_storage_service.get_blob_service_client = lambda: standins.blob
+    eventtopic_service.get_eventgrid_client = lambda: standins.eventgrid
+    iot_hub_service.get_registry_manager = lambda: standins.registry
+    cognitive_serivce.get_vision_client = lambda: standins.vision
+    NotificationService.trigger_notification = lambda user_id, message: standins.notifications.append((user_id, message))
+    return standins
+
+class _FunctionsHostHandler(BaseHTTPRequestHandler):
+    """
+    Dispatches /api/<route> to the matching function_app HTTP function, like the Functions host.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def _dispatch(self):
+        import azure.functions as func
+        url = urlsplit(self.path)
+        route = url.path[len("/api/"):].strip("/") if url.path.startswith("/api/") else None
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        function = self.server.routes.get((route, self.command))
+        if function is None:
+            allowed = any(key[0] == route for key in self.server.routes)
+            response = func.HttpResponse(status_code=405 if allowed else 404)
+        else:
+            req = func.HttpRequest(
+                method=self.command, url=f"http://{self.headers.get('Host', 'localhost')}{self.path}",
+                headers=dict(self.headers.items()), params=dict(parse_qsl(url.query)), body=body,
+            )
+            try:
+                response = function(req)
+                if inspect.iscoroutine(response):
+                    # async functions run on the worker's event loop instead of its thread pool
+                    response = asyncio.run(response)
+            except Exception:
+                # The Functions host answers unhandled exceptions with an empty 500
+                self.server.errors += 1
+                response = func.HttpResponse(status_code=500)
+
+        payload = response.get_body() or b""
+        self.send_response(response.status_code)
+        headers = dict(response.headers.items())
+        if response.mimetype and "content-type" not in {name.lower() for name in headers}:
+            headers["Content-Type"] = f"{response.mimetype}; charset={response.charset}"
+        for name, value in headers.items():
+            if name.lower() not in ("content-length", "transfer-encoding"):
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host: str = "127.0.0.1", port: int = 7071) -> ThreadingHTTPServer:
+    """
+    Returns an HTTP server for the function_app routes; call serve_forever() on it, usually in
+    a thread. install() must have been called first. Requests are handled on one thread each,
+    like the sync functions in the Python worker's thread pool (async functions get an event
+    loop each).
+    """
+    import function_app
+    server = ThreadingHTTPServer((host, port), _FunctionsHostHandler)
+    server.daemon_threads = True
+    server.errors = 0
+    server.routes = {}
+    for function in function_app.app.get_functions():
+        trigger = function.get_trigger()
+        if getattr(trigger, "route", None) is None:
+            continue
+        for method in trigger.methods:
+            server.routes[(trigger.route, getattr(method, "value", method))] = function.get_user_function()
+    return server
@@ -0,0 +1,63 @@
+"""
+Storage size and encode/decode time of the compact telemetry buckets (functions/telemetry_codec.py).
+
+Compares the BSON size of a device document holding plain telemetryData with the same device
+after every reading has been compacted, using the get_users style payload from json_encoding.py.
+Readings follow a slow random walk like real sensor values.
+
+Usage (from the CST8917_Final directory):
+    python benchmarks/telemetry_storage.py --readings 5000
+"""
+import os
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bson
+from functions import telemetry_codec
+from json_encoding import build_users
+
+def build_device(readings: int) -> dict:
+    """
+    Returns one device with native dates and values that drift in 0.1 steps.
+    """
+    device = build_users(1, 1, readings, native_dates=True)[0]["Devices"][0]
+    rng = random.Random(7)
+    current = {}
+    for telemetry in device["telemetryData"]:
+        for value in telemetry["values"]:
+            current[value["valueType"]] = round(current.get(value["valueType"], 20.0) + rng.choice((-0.1, 0, 0.1)), 1)
+            value["value"] = current[value["valueType"]]
+    return device
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compact telemetry storage.")
+    parser.add_argument("--readings", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    device = build_device(args.readings)
+    telemetry_codec.TELEMETRY_HOT_READINGS = 0
+    remaining, buckets = telemetry_codec.compact_device(device)
+    compacted = dict(device, telemetryData=remaining, telemetryBuckets=buckets)
+
+    plain_size = len(bson.encode(device))
+    compact_size = len(bson.encode(compacted))
+    readings = device["telemetryData"][:telemetry_codec.TELEMETRY_BUCKET_SIZE]
+    encode = min(timeit.repeat(lambda: telemetry_codec.encode_bucket(readings), number=1, repeat=args.repeat))
+    decode = min(timeit.repeat(lambda: telemetry_codec.decode_bucket(buckets[0], device["deviceId"]), number=1, repeat=args.repeat))
+    assert telemetry_codec.read_telemetry(compacted) == device["telemetryData"], "decoded telemetry differs"
+
+    print(f"readings: {args.readings} ({len(buckets)} buckets, {len(remaining)} left uncompressed)")
+    print(f"plain:     {plain_size / 1024:10.1f} KiB  ({plain_size / args.readings:.1f} bytes/reading)")
+    print(f"compacted: {compact_size / 1024:10.1f} KiB  ({compact_size / args.readings:.1f} bytes/reading)")
+    print(f"ratio:     {plain_size / compact_size:10.1f}x")
+    print(f"encode:    {encode * 1000:10.2f} ms per bucket of {len(readings)}")
+    print(f"decode:    {decode * 1000:10.2f} ms per bucket of {len(readings)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+from functools import lru_cache
+from types import MappingProxyType
+from .azure_config import get_azure_config
+
+@lru_cache(maxsize=1)
+def get_config():
+    """
+    Returns an immutable snapshot of the Azure configuration.
+    The configuration is read once per worker instead of on every request.
+    """
+    return MappingProxyType(dict(get_azure_config()))
@@ -0,0 +1,50 @@
+import os
+import atexit
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Threads shared by all requests for steps that run alongside the request thread
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+# A step only goes to the pool when a worker is free, so it never waits behind other requests
+_free_workers = threading.BoundedSemaphore(FANOUT_WORKERS)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+                atexit.register(_executor.shutdown, wait=False)
+    return _executor
+
+
+def _run_inline(fn, *args, **kwargs) -> Future:
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def submit(fn, *args, **kwargs) -> Future:
+    """
+    Starts fn on the shared pool and returns its future, so the caller can run the steps that do
+    not depend on it meanwhile. fn runs in a copy of the caller's context, so its spans are part
+    of the current request. When every worker is busy, fn runs on the calling thread instead.
+    """
+    if not _free_workers.acquire(blocking=False):
+        return _run_inline(fn, *args, **kwargs)
+    context = contextvars.copy_context()
+    try:
+        future = _get_executor().submit(context.run, fn, *args, **kwargs)
+    except Exception:
+        _free_workers.release()
+        raise
+    future.add_done_callback(lambda _: _free_workers.release())
+    return future
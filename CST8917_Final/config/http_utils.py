@@ -0,0 +1,211 @@
+import os
+import gzip
+import zlib
+import hashlib
+import logging
+from itertools import chain
+import azure.functions as func
+from config import json_utils
+from config.metrics_utils import record_cache
+
+try:
+    import brotli  # Optional: brotli variants are only produced when the package is installed
+except ImportError:
+    brotli = None
+
+# Static assets are compressed once, so they use the highest levels
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# Versioned API responses must be revalidated with If-None-Match on every poll
+VERSIONED_CACHE_CONTROL = "private, no-cache"
+
+# Dynamic responses are compressed per request; smaller bodies are sent as is
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_RESPONSE_LEVEL = int(os.environ.get("GZIP_RESPONSE_LEVEL", "6"))
+BROTLI_RESPONSE_QUALITY = int(os.environ.get("BROTLI_RESPONSE_QUALITY", "4"))
+
+def accepted_encodings(req: func.HttpRequest) -> list:
+    """
+    Returns the content codings accepted by the client, most preferred first.
+    Codings with q=0 are left out.
+    """
+    header = req.headers.get("Accept-Encoding") or ""
+    encodings = []
+    for position, item in enumerate(header.split(",")):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            encodings.append((-quality, position, name))
+    return [name for _, _, name in sorted(encodings)]
+
+def negotiate_encoding(req: func.HttpRequest):
+    """
+    Returns "br", "gzip" or None (no compression) for the client's Accept-Encoding.
+    """
+    for encoding in accepted_encodings(req):
+        if encoding == "br" and brotli is not None:
+            return "br"
+        if encoding == "gzip":
+            return "gzip"
+        if encoding == "identity":
+            return None
+    return None
+
+def compress_stream(chunks, encoding: str):
+    """
+    Compresses an iterable of byte chunks incrementally, yielding compressed chunks.
+    """
+    if encoding == "gzip":
+        compressor = zlib.compressobj(GZIP_RESPONSE_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = compressor.compress, compressor.flush
+    else:
+        compressor = brotli.Compressor(quality=BROTLI_RESPONSE_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+def compressed_response(req: func.HttpRequest, body, status_code: int = 200,
+                        mimetype: str = "application/json", headers: dict = None) -> func.HttpResponse:
+    """
+    Builds an HttpResponse compressed according to Accept-Encoding.
+    The body may be a str, bytes or an iterable of str/bytes chunks (a streamed body). Bodies
+    smaller than COMPRESSION_MIN_BYTES are sent uncompressed; a streamed body is compressed
+    chunk by chunk once the threshold is reached, so the uncompressed body is never joined in
+    one piece. Function responses cannot be streamed, so the whole (compressed) payload is still
+    held in memory; a streamed body does not bound the memory of the response.
+    """
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    chunks = iter((body,)) if isinstance(body, (bytes, bytearray)) else (
+        chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in body
+    )
+
+    encoding = negotiate_encoding(req)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= COMPRESSION_MIN_BYTES:
+            break
+
+    if encoding is None or size < COMPRESSION_MIN_BYTES:
+        payload = b"".join(chain(head, chunks))
+    else:
+        headers["Content-Encoding"] = encoding
+        payload = b"".join(compress_stream(chain(head, chunks), encoding))
+    return func.HttpResponse(payload, status_code=status_code, headers=headers, mimetype=mimetype)
+
+def service_unavailable_response(message: str, retry_after: int = 1) -> func.HttpResponse:
+    """
+    503 telling the client when to retry, for overloaded or unavailable dependencies.
+    """
+    return func.HttpResponse(
+        json_utils.dumps({"message": message}),
+        status_code=503,
+        headers={"Retry-After": str(retry_after)},
+        mimetype="application/json"
+    )
+
+def etag_matches(req: func.HttpRequest, *etags: str) -> bool:
+    """
+    Returns True if the If-None-Match header matches one of the given ETags.
+    """
+    header = req.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as for every If-None-Match
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return any(etag.removeprefix("W/") in candidates for etag in etags)
+
+def version_etag(req: func.HttpRequest, version) -> str:
+    """
+    ETag for a response derived from a document version and the request's query parameters.
+    It is weak because it is the same for the gzip, brotli and identity encodings of the
+    response, which are not byte-for-byte identical.
+    """
+    params = "&".join(f"{key}={value}" for key, value in sorted(req.params.items()))
+    digest = hashlib.sha1(f"{req.url.split('?')[0]}?{params}".encode("utf-8")).hexdigest()[:16]
+    return f'W/"v{version or 0}-{digest}"'
+
+def not_modified_for_version(req: func.HttpRequest, fetch_version):
+    """
+    Answers a conditional GET from the document version alone.
+    fetch_version is only called when the request carries If-None-Match; it should read just the
+    version field. Returns a 304 response if the client's copy is current, otherwise None.
+    """
+    if not req.headers.get("If-None-Match"):
+        return None
+    version = fetch_version()
+    if version is None:
+        return None
+    etag = version_etag(req, version)
+    if etag_matches(req, etag):
+        record_cache("etag", True)
+        return not_modified_response(etag, {"Cache-Control": VERSIONED_CACHE_CONTROL})
+    record_cache("etag", False)
+    return None
+
+def versioned_headers(req: func.HttpRequest, version) -> dict:
+    """
+    Headers for a full response to a versioned GET.
+    """
+    return {"ETag": version_etag(req, version), "Cache-Control": VERSIONED_CACHE_CONTROL}
+
+def not_modified_response(etag: str, headers: dict = None) -> func.HttpResponse:
+    response_headers = dict(headers or {})
+    response_headers["ETag"] = etag
+    return func.HttpResponse(status_code=304, headers=response_headers)
+
+class StaticAsset:
+    """
+    A file loaded once with its gzip and brotli variants precomputed and a strong ETag per variant.
+    """
+
+    def __init__(self, path: str, mimetype: str, max_age: int = 86400):
+        with open(path, "rb") as file:
+            body = file.read()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.mimetype = mimetype
+        self.cache_control = f"public, max-age={max_age}"
+        self.variants = {"identity": (body, f'"{digest}"')}
+        self.variants["gzip"] = (gzip.compress(body, GZIP_LEVEL, mtime=0), f'"{digest}-gz"')
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(body, quality=BROTLI_QUALITY), f'"{digest}-br"')
+        logging.info(f"[StaticAsset] Loaded {path} ({len(body)} bytes, variants: {', '.join(self.variants)}).")
+
+    def select(self, req: func.HttpRequest):
+        """
+        Returns the (encoding, body, etag) variant that best matches Accept-Encoding.
+        """
+        for encoding in accepted_encodings(req):
+            if encoding in self.variants:
+                return (encoding,) + self.variants[encoding]
+        return ("identity",) + self.variants["identity"]
+
+    def response(self, req: func.HttpRequest) -> func.HttpResponse:
+        encoding, body, etag = self.select(req)
+        headers = {"Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if etag_matches(req, *(tag for _, tag in self.variants.values())):
+            return not_modified_response(etag, headers)
+        headers["ETag"] = etag
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return func.HttpResponse(body, status_code=200, headers=headers, mimetype=self.mimetype)
@@ -0,0 +1,57 @@
+import json
+import datetime
+import decimal
+
+try:
+    import orjson  # Optional: used for encoding and decoding when installed
+except ImportError:
+    orjson = None
+
+try:
+    from bson import ObjectId, Decimal128
+except ImportError:
+    ObjectId = Decimal128 = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+def _default(obj):
+    """
+    Converts the BSON and Python types stored in our documents to JSON values.
+    Decimal values are written as strings so no precision is lost.
+    """
+    if ObjectId is not None and isinstance(obj, ObjectId):
+        return str(obj)
+    if Decimal128 is not None and isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        """
+        Serializes obj to UTF-8 encoded JSON.
+        """
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data):
+        """
+        Parses JSON from str or bytes.
+        """
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(obj) -> bytes:
+        """
+        Serializes obj to UTF-8 encoded JSON.
+        """
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data):
+        """
+        Parses JSON from str or bytes.
+        """
+        return json.loads(data)
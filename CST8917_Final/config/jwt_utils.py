@@ -1,30 +1,110 @@
+import os
 import jwt
+import time
+import hashlib
 import datetime
 import logging
+import threading
+from collections import OrderedDict
 from azure.functions import HttpRequest, HttpResponse
-from .azure_config import get_azure_config
+from .config_utils import get_config
+from . import json_utils
+from .trace_utils import span, traced
+from .metrics_utils import record_cache
 
-config = get_azure_config()
-JWT_SECRET = config["JWT_SECRET"]
-JWT_ALGORITHM = config["JWT_ALGORITHM"]
+# Access tokens are short lived; refresh tokens are only accepted by the refresh route
+ACCESS_TOKEN_TTL = datetime.timedelta(seconds=int(os.environ.get("ACCESS_TOKEN_TTL_SECONDS", "3600")))
+REFRESH_TOKEN_TTL = datetime.timedelta(seconds=int(os.environ.get("REFRESH_TOKEN_TTL_SECONDS", str(7 * 24 * 3600))))
+ACCESS_TOKEN_TYPE = "access"
+REFRESH_TOKEN_TYPE = "refresh"
 
-def create_token(user_id: str) -> str:
+# Verified tokens are cached by hash until their "exp" claim passes
+TOKEN_CACHE_SIZE = 1024
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+@traced("jwt.encode")
+def create_token(user_id: str, token_type: str = ACCESS_TOKEN_TYPE) -> str:
+    ttl = REFRESH_TOKEN_TTL if token_type == REFRESH_TOKEN_TYPE else ACCESS_TOKEN_TTL
     payload = {
         "user_id": user_id,
-        "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        "type": token_type,
+        "exp": datetime.datetime.utcnow() + ttl
     }
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    config = get_config()
+    token = jwt.encode(payload, config["JWT_SECRET"], algorithm=config["JWT_ALGORITHM"])
     return token
 
+def create_refresh_token(user_id: str) -> str:
+    return create_token(user_id, REFRESH_TOKEN_TYPE)
+
+def get_token_user_id(token: str, token_type: str = ACCESS_TOKEN_TYPE):
+    """
+    Returns the user_id of a valid token of the given type, or None.
+    Tokens issued before the "type" claim existed are treated as access tokens.
+    """
+    payload = decode_token(token)
+    if not payload or payload.get("type", ACCESS_TOKEN_TYPE) != token_type:
+        return None
+    return payload.get("user_id")
+
+def _token_key(token: str) -> str:
+    """
+    Returns the cache key for a token. The raw token is never kept in memory as a key.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def _get_cached_payload(key: str):
+    """
+    Returns the cached payload for a token key, dropping the entry if the token has expired.
+    """
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+        if entry is None:
+            return None
+        payload, expires_at = entry
+        if expires_at <= time.time():
+            del _token_cache[key]
+            return None
+        _token_cache.move_to_end(key)
+        return payload
+
+def _cache_payload(key: str, payload: dict):
+    """
+    Stores a verified payload, evicting the least recently used entries beyond TOKEN_CACHE_SIZE.
+    """
+    expires_at = payload.get("exp")
+    if not isinstance(expires_at, (int, float)):
+        return  # Tokens without an expiry are always verified again
+    with _token_cache_lock:
+        _token_cache[key] = (payload, expires_at)
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+def clear_token_cache():
+    """
+    Removes all verified tokens from the cache.
+    """
+    with _token_cache_lock:
+        _token_cache.clear()
+
 def decode_token(token: str):
     """
     Decode a JWT token and return its payload.
+    Verified payloads are served from the cache until the token expires. Callers get their own
+    copy, so changing it cannot alter the cached claims seen by later requests.
     """
-    logging.info("Starting token decoding.")
+    key = _token_key(token)
+    payload = _get_cached_payload(key)
+    record_cache("jwt_token", payload is not None)
+    if payload is not None:
+        return dict(payload)
+
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        logging.debug(f"Token decoded successfully: {payload}")
-        return payload
+        config = get_config()
+        with span("jwt.decode"):
+            payload = jwt.decode(token, config["JWT_SECRET"], algorithms=[config["JWT_ALGORITHM"]])
     except jwt.ExpiredSignatureError:
         logging.error("Token decoding failed: Token has expired.")
         return None
@@ -32,43 +112,46 @@ def decode_token(token: str):
         logging.error(f"Token decoding failed: Invalid token. Error: {str(e)}")
         return None
 
+    _cache_payload(key, payload)
+    return dict(payload)
+
+def get_bearer_token(req: HttpRequest):
+    """
+    Extract the token from the "Bearer" Authorization header, or None if it is missing or invalid.
+    """
+    auth_header = req.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return None
+    return auth_header[len("Bearer "):].strip() or None
+
+def unauthorized_response(message: str = "Unauthorized") -> HttpResponse:
+    return HttpResponse(
+        json_utils.dumps({"message": message}),
+        status_code=401,
+        mimetype="application/json"
+    )
+
 def authenticate_user(req: HttpRequest):
     """
     Authenticate the user using the Authorization header.
+    Returns the user_id on success, or a 401 HttpResponse that the handler should return as is.
     """
-    logging.info("Starting user authentication.")
     try:
-        # Get the Authorization header
-        token = req.headers.get("Authorization")
+        token = get_bearer_token(req)
         if not token:
-            logging.error("Authorization header is missing.")
-            return None
-        logging.debug(f"Authorization header received: {token}")
-
-        # Extract the token from the "Bearer" scheme
-        if token.startswith("Bearer "):
-            token = token.split(" ")[1]
-        else:
-            logging.error("Authorization header is invalid. Missing 'Bearer' prefix.")
-            return None
-        logging.debug(f"Extracted token: {token}")
+            logging.error("Authorization header is missing or invalid.")
+            return unauthorized_response()
 
-        # Decode the token and extract user_id
-        logging.info("Decoding the token.")
         decoded_token = decode_token(token)
-        if not decoded_token:
-            logging.error("Token decoding failed or token is invalid.")
-            return None
-        logging.debug(f"Decoded token: {decoded_token}")
+        if not decoded_token or decoded_token.get("type", ACCESS_TOKEN_TYPE) != ACCESS_TOKEN_TYPE:
+            return unauthorized_response("Invalid token")
 
         user_id = decoded_token.get("user_id")
         if not user_id:
             logging.error("Invalid token: user_id is missing.")
-            return None
-        logging.info(f"Authentication successful for user_id={user_id}.")
+            return unauthorized_response("Invalid token payload: user_id missing")
 
         return user_id
     except Exception as e:
         logging.error(f"Authentication failed due to an exception: {str(e)}")
-        return None
-
+        return unauthorized_response()
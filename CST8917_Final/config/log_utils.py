@@ -0,0 +1,100 @@
+import os
+import json
+import random
+import logging
+from itertools import islice
+
+# Size caps for logged payload summaries
+MAX_FIELD_CHARS = 200
+MAX_SUMMARY_KEYS = 8
+
+# Per-route sampling rates for INFO/DEBUG events, e.g. LOG_SAMPLE_RATES="get_user=0.1,get_conditions=0.05"
+# Warnings and errors are never sampled out.
+DEFAULT_SAMPLE_RATE = 1.0
+
+def _parse_sample_rates(value: str) -> dict:
+    """
+    Parses "route=rate,route=rate" into a dictionary. Invalid entries are ignored.
+    """
+    rates = {}
+    for item in (value or "").split(","):
+        route, _, rate = item.partition("=")
+        try:
+            rates[route.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+_sample_rates = _parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))
+
+def set_sample_rate(route: str, rate: float):
+    """
+    Sets the sampling rate (0.0 - 1.0) for INFO/DEBUG events of a route.
+    """
+    _sample_rates[route] = min(max(float(rate), 0.0), 1.0)
+
+def get_sample_rate(route: str) -> float:
+    return _sample_rates.get(route, DEFAULT_SAMPLE_RATE)
+
+def summarize(value):
+    """
+    Returns a size-capped summary of a value. Containers are described by their size and
+    first keys instead of being formatted, so the cost does not depend on the document size.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        if len(value) <= MAX_FIELD_CHARS:
+            return value
+        return f"{value[:MAX_FIELD_CHARS]}...(+{len(value) - MAX_FIELD_CHARS} chars)"
+    if isinstance(value, dict):
+        return {
+            "type": "dict",
+            "size": len(value),
+            "keys": [str(key) for key in islice(value.keys(), MAX_SUMMARY_KEYS)]
+        }
+    if isinstance(value, (list, tuple, set)):
+        return {"type": type(value).__name__, "size": len(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {"type": "bytes", "size": len(value)}
+    return summarize(str(value))
+
+class StructuredMessage:
+    """
+    Log message whose fields are only evaluated and summarized when the record is emitted.
+    Field values may be callables, which are called at that point.
+    """
+    __slots__ = ("message", "fields")
+
+    def __init__(self, message: str, fields: dict):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        rendered = {}
+        for key, value in self.fields.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    value = f"<error: {e}>"
+            rendered[key] = summarize(value)
+        if not rendered:
+            return self.message
+        return f"{self.message} | {json.dumps(rendered, default=str)}"
+
+def log_event(level: int, message: str, route: str = None, logger: logging.Logger = None, **fields):
+    """
+    Logs a structured event. Nothing is formatted when the level is disabled or the event is
+    sampled out for its route.
+    """
+    logger = logger or logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    if route is not None:
+        if level < logging.WARNING:
+            rate = _sample_rates.get(route, DEFAULT_SAMPLE_RATE)
+            if rate < 1.0 and random.random() >= rate:
+                return
+        fields["route"] = route
+    logger.log(level, "%s", StructuredMessage(message, fields))
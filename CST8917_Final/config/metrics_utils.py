@@ -0,0 +1,215 @@
+import os
+import bisect
+import socket
+import threading
+
+# Histogram bucket upper bounds in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Span name prefix -> dependency label for outbound calls; "cosmos" spans are database operations
+DEPENDENCY_SPANS = {
+    "blob": "blob",
+    "vision": "vision",
+    "eventgrid": "eventgrid",
+    "iothub": "iothub",
+    "email": "email",
+    "notificationhub": "notificationhub",
+}
+
+# Host instance (the App Service instance in Azure) added to every series, with the worker's pid,
+# since each worker process only reports its own metrics. Not named "instance", which
+# Prometheus sets to the scrape target.
+WEBSITE_INSTANCE_ID = os.environ.get("WEBSITE_INSTANCE_ID") or socket.gethostname()
+
+# name -> (type, help)
+METRICS = {
+    "http_request_duration_seconds": ("histogram", "HTTP request latency by route and method."),
+    "http_requests_total": ("counter", "HTTP requests by route, method and status code."),
+    "http_request_errors_total": ("counter", "HTTP requests that failed with a 5xx status or an unhandled exception."),
+    "db_operation_duration_seconds": ("histogram", "Database operation latency by collection and operation."),
+    "db_operation_errors_total": ("counter", "Database operations that raised an exception."),
+    "db_throttled_total": ("counter", "Database attempts rejected by Cosmos DB for exceeding the provisioned throughput."),
+    "db_retries_total": ("counter", "Database attempts retried, by reason (throttled or transient)."),
+    "db_retry_wait_seconds_total": ("counter", "Time spent waiting before database retries."),
+    "db_retries_exhausted_total": ("counter", "Database operations that failed after their last allowed retry."),
+    "dependency_call_duration_seconds": ("histogram", "Outbound call latency by dependency and operation."),
+    "dependency_call_errors_total": ("counter", "Outbound calls that raised an exception."),
+    "dependency_rejected_total": ("counter", "Outbound calls not made or abandoned, by reason (open, bulkhead, timeout)."),
+    "dependency_circuit_opened_total": ("counter", "Times a dependency's circuit breaker opened."),
+    "dependency_circuit_state": ("gauge", "Circuit breaker state per dependency (0 closed, 1 half-open, 2 open)."),
+    "events_deferred_total": ("counter", "Events stored for a later retry because Event Grid was unavailable."),
+    "events_replayed_total": ("counter", "Deferred events sent to Event Grid by the replay job."),
+    "events_parked_total": ("counter", "Deferred events parked as poison events after too many failed sends."),
+    "live_subscribers": ("gauge", "Live telemetry requests waiting for readings."),
+    "live_subscribers_rejected_total": ("counter", "Live telemetry requests rejected because all subscriber slots were in use."),
+    "live_readings_published_total": ("counter", "Readings handed to live telemetry subscribers, by source."),
+    "live_resets_total": ("counter", "Live telemetry responses telling the client to reload because readings were missed."),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result (hit or miss)."),
+    "cache_hit_ratio": ("gauge", "Share of cache lookups that were hits since the worker started."),
+}
+
+# Every thread records into its own shard, so the hot path takes no lock. Shards are only
+# merged when the metrics are rendered; shards of finished threads are folded into _retired.
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+_retired = {"histograms": {}, "counters": {}}
+# cache -> callable returning an object with hits and misses, e.g. an lru_cache's cache_info
+_cache_info = {}
+# gauge -> callable returning {labels: value}, read when the metrics are rendered
+_gauges = {}
+
+def _new_shard() -> dict:
+    shard = {"histograms": {}, "counters": {}}
+    with _shards_lock:
+        _retire_finished_threads()
+        _shards.append((threading.current_thread(), shard))
+    _local.shard = shard
+    return shard
+
+def _merge(target: dict, shard: dict):
+    for key, (counts, total) in list(shard["histograms"].items()):
+        merged = target["histograms"].setdefault(key, [[0] * (len(DURATION_BUCKETS) + 1), 0.0])
+        merged[0] = [a + b for a, b in zip(merged[0], counts)]
+        merged[1] += total
+    for key, value in list(shard["counters"].items()):
+        target["counters"][key] = target["counters"].get(key, 0) + value
+
+def _retire_finished_threads():
+    """
+    Folds the shards of finished threads into _retired. Must be called with _shards_lock held.
+    """
+    alive = []
+    for thread, shard in _shards:
+        if thread.is_alive():
+            alive.append((thread, shard))
+        else:
+            _merge(_retired, shard)
+    _shards[:] = alive
+
+def observe(name: str, seconds: float, **labels):
+    """
+    Records one observation in a histogram.
+    """
+    shard = getattr(_local, "shard", None) or _new_shard()
+    key = (name, tuple(sorted(labels.items())))
+    histogram = shard["histograms"].get(key)
+    if histogram is None:
+        histogram = shard["histograms"][key] = [[0] * (len(DURATION_BUCKETS) + 1), 0.0]
+    histogram[0][bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+    histogram[1] += seconds
+
+def increment(name: str, amount: int = 1, **labels):
+    """
+    Adds to a counter.
+    """
+    shard = getattr(_local, "shard", None) or _new_shard()
+    key = (name, tuple(sorted(labels.items())))
+    counters = shard["counters"]
+    counters[key] = counters.get(key, 0) + amount
+
+def record_cache(cache: str, hit: bool):
+    increment("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+def register_cache_info(cache: str, cache_info):
+    """
+    Reports a cache that keeps its own hit and miss counts, such as an lru_cache.
+    """
+    _cache_info[cache] = cache_info
+
+def register_gauge(name: str, read):
+    """
+    Reports a gauge whose current values are read from read() at render time, as a dict of
+    ((label, value), ...) tuples to numbers.
+    """
+    _gauges[name] = read
+
+def record_span(name: str, seconds: float, attributes: dict, failed: bool):
+    """
+    Records a finished trace span as a database or outbound call metric. Other spans
+    (bcrypt, JWT, condition checks) only appear in the traces.
+    """
+    prefix, _, operation = name.partition(".")
+    if prefix == "cosmos":
+        labels = {"collection": attributes.get("collection") or "", "operation": operation}
+        observe("db_operation_duration_seconds", seconds, **labels)
+        if failed:
+            increment("db_operation_errors_total", **labels)
+    elif prefix in DEPENDENCY_SPANS:
+        labels = {"dependency": DEPENDENCY_SPANS[prefix], "operation": operation}
+        observe("dependency_call_duration_seconds", seconds, **labels)
+        if failed:
+            increment("dependency_call_errors_total", **labels)
+
+def record_request(route: str, method: str, status_code: int, seconds: float):
+    observe("http_request_duration_seconds", seconds, route=route, method=method)
+    increment("http_requests_total", route=route, method=method, status=str(status_code))
+    if status_code >= 500:
+        increment("http_request_errors_total", route=route, method=method)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(labels, extra: tuple = ()) -> str:
+    pairs = (("website_instance_id", WEBSITE_INSTANCE_ID), ("pid", os.getpid())) + tuple(labels) + extra
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def snapshot() -> dict:
+    """
+    Returns the merged {"histograms": ..., "counters": ...} of all threads.
+    """
+    merged = {"histograms": {}, "counters": {}}
+    with _shards_lock:
+        _retire_finished_threads()
+        _merge(merged, _retired)
+        for _, shard in _shards:
+            _merge(merged, shard)
+    for cache, cache_info in list(_cache_info.items()):
+        info = cache_info()
+        for result, value in (("hit", info.hits), ("miss", info.misses)):
+            key = ("cache_requests_total", (("cache", cache), ("result", result)))
+            merged["counters"][key] = merged["counters"].get(key, 0) + value
+    return merged
+
+def render() -> str:
+    """
+    Renders the metrics of this worker in the Prometheus text exposition format (0.0.4).
+    Every series is labelled with the instance and pid of the worker.
+    """
+    data = snapshot()
+    series = {}
+    for (name, labels), (counts, total) in sorted(data["histograms"].items()):
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _format(bound)
+            lines.append(f"{name}_bucket{_labels(labels, (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {_format(total)}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+    lookups = {}
+    for (name, labels), value in sorted(data["counters"].items()):
+        series.setdefault(name, []).append(f"{name}{_labels(labels)} {_format(value)}")
+        if name == "cache_requests_total":
+            label_map = dict(labels)
+            hits, count = lookups.get(label_map["cache"], (0, 0))
+            lookups[label_map["cache"]] = (hits + (value if label_map["result"] == "hit" else 0), count + value)
+    for cache, (hits, count) in sorted(lookups.items()):
+        if count:
+            series.setdefault("cache_hit_ratio", []).append(
+                f"cache_hit_ratio{_labels((('cache', cache),))} {_format(hits / count)}")
+    for name, read in list(_gauges.items()):
+        for labels, value in sorted(read().items()):
+            series.setdefault(name, []).append(f"{name}{_labels(labels)} {_format(value)}")
+
+    output = []
+    for name, (metric_type, help_text) in METRICS.items():
+        if name in series:
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(series[name])
+    return "\n".join(output) + "\n"
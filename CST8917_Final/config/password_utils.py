@@ -1,8 +1,89 @@
+import os
+import atexit
+import logging
+import threading
 import bcrypt
+from concurrent.futures import ProcessPoolExecutor
+from .trace_utils import traced
 
+# bcrypt cost factor; existing hashes with a different cost are rehashed on the next login
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+# Number of worker processes used for hashing and verification
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+# Maximum number of password operations queued or running before new ones are rejected
+PASSWORD_MAX_PENDING = int(os.environ.get("PASSWORD_MAX_PENDING", str(PASSWORD_WORKERS * 4)))
+# Seconds a request waits for a free slot before it is rejected
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_QUEUE_TIMEOUT", "2"))
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(PASSWORD_MAX_PENDING)
+
+
+class PasswordPoolBusy(Exception):
+    """
+    Raised when too many password operations are already queued.
+    Handlers should answer with 503 so clients back off and retry.
+    """
+
+
+def _hash(plain_password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(plain_password, bcrypt.gensalt(rounds=rounds))
+
+
+def _verify(plain_password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(plain_password, hashed_password)
+
+
+def _get_executor():
+    """
+    Creates the process pool on first use. Returns None if processes cannot be started,
+    in which case the work runs on the calling thread.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                try:
+                    _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+                    atexit.register(_executor.shutdown, wait=False)
+                except (OSError, NotImplementedError) as e:
+                    logging.warning(f"[password_utils] Process pool unavailable, hashing inline: {str(e)}")
+                    _executor = False
+    return _executor or None
+
+
+def _run(fn, *args):
+    """
+    Runs a password operation on the pool, rejecting it if the queue is full.
+    """
+    if not _pending.acquire(timeout=PASSWORD_QUEUE_TIMEOUT):
+        raise PasswordPoolBusy("Too many password operations in progress")
+    try:
+        executor = _get_executor()
+        if executor is None:
+            return fn(*args)
+        return executor.submit(fn, *args).result()
+    finally:
+        _pending.release()
+
+
+@traced("bcrypt.hash")
 def hash_password(plain_password: str) -> str:
-    hashed = bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt())
+    hashed = _run(_hash, plain_password.encode("utf-8"), BCRYPT_ROUNDS)
     return hashed.decode("utf-8")
 
+
+@traced("bcrypt.verify")
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+    return _run(_verify, plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Returns True if the hash was created with a cost factor other than BCRYPT_ROUNDS.
+    """
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (AttributeError, IndexError, ValueError):
+        return True
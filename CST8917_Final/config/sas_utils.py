@@ -1,6 +1,4 @@
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
 from datetime import datetime, timedelta
-from .azure_config import get_azure_config
 
 import os
 import urllib.parse
@@ -10,7 +8,8 @@ import base64
 import time
 
 def generate_sas_url(container_name, blob_name):
-    config = get_azure_config()
+    from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+
     blob_service_client = BlobServiceClient.from_connection_string(os.environ["AzureWebJobsStorage"])
 
     sas_token = generate_blob_sas(
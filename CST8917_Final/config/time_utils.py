@@ -0,0 +1,40 @@
+import datetime
+from bisect import bisect_left, bisect_right
+
+def utc_now() -> datetime.datetime:
+    """
+    Current UTC time truncated to milliseconds, the precision of a BSON date.
+    Values stored in the database compare equal to the value that was written.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def parse_datetime(value) -> datetime.datetime:
+    """
+    Returns a timezone-aware UTC datetime for an ISO 8601 string or a datetime.
+    Naive values are treated as UTC. Raises ValueError for anything else.
+    """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    elif not isinstance(value, datetime.datetime):
+        raise ValueError(f"Invalid datetime: {value!r}")
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+def event_time(telemetry: dict) -> datetime.datetime:
+    """
+    Sort key of a telemetry entry. Entries written before the native date migration still
+    hold ISO strings, which are parsed here.
+    """
+    return parse_datetime(telemetry["event_date"])
+
+def time_range(series: list, start: datetime.datetime = None, end: datetime.datetime = None,
+               key=event_time) -> list:
+    """
+    Returns the entries of a series ordered by key whose time lies within [start, end].
+    The bounds are found by binary search, so only O(log n) keys are read.
+    """
+    low = bisect_left(series, start, key=key) if start is not None else 0
+    high = bisect_right(series, end, key=key) if end is not None else len(series)
+    return series[low:high]
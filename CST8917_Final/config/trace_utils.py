@@ -0,0 +1,141 @@
+import os
+import time
+import logging
+import functools
+from contextvars import ContextVar
+import azure.functions as func
+from config.log_utils import log_event
+from config.metrics_utils import record_span, record_request
+
+try:
+    from opentelemetry import trace as otel_trace  # Optional: spans are also exported when the API is installed
+except ImportError:
+    otel_trace = None
+
+# Adds the Server-Timing header with one entry per recorded span
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "true").lower() in ("1", "true")
+# Entries beyond this are folded into a single "other" entry to keep the header small
+SERVER_TIMING_MAX_SPANS = int(os.environ.get("SERVER_TIMING_MAX_SPANS", "20"))
+# Requests slower than this log their span breakdown
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+# Spans are exported through the OpenTelemetry API; the exporter is configured by the SDK or distro
+OTEL_TRACING_ENABLED = otel_trace is not None and os.environ.get("OTEL_TRACING_ENABLED", "false").lower() in ("1", "true")
+
+# Spans and start time of the current request, or None outside a traced request
+_request_spans = ContextVar("request_spans", default=None)
+_request_start = ContextVar("request_start", default=None)
+
+def request_elapsed_ms():
+    """
+    Milliseconds since the current request started, or None outside a traced request.
+    """
+    start = _request_start.get()
+    return None if start is None else (time.perf_counter() - start) * 1000
+
+def _tracer():
+    return otel_trace.get_tracer("iot-functions")
+
+class span:
+    """
+    Times a block as a named span of the current request, e.g.
+        with span("cosmos.find_document", collection="Users"):
+    Database and outbound call spans are also recorded as metrics, inside a request or not.
+    """
+    __slots__ = ("name", "attributes", "start", "otel")
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.otel = None
+
+    def __enter__(self):
+        if OTEL_TRACING_ENABLED:
+            self.otel = _tracer().start_as_current_span(self.name, attributes={
+                key: str(value) for key, value in self.attributes.items() if value is not None
+            })
+            self.otel.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        record_span(self.name, elapsed, self.attributes, exc_type is not None)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((self.name, elapsed * 1000, self.attributes, exc_type is not None))
+        if self.otel is not None:
+            self.otel.__exit__(exc_type, exc, tb)
+        return False
+
+def traced(name: str):
+    """
+    Decorator recording every call of the function as a span.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _description(attributes: dict) -> str:
+    return " ".join(str(value) for value in attributes.values() if value is not None).replace('"', "'")
+
+def server_timing(spans: list, total_ms: float) -> str:
+    """
+    Formats the spans as a Server-Timing header value, in the order they finished.
+    """
+    entries = []
+    for name, elapsed_ms, attributes, failed in spans[:SERVER_TIMING_MAX_SPANS]:
+        entry = f"{name};dur={elapsed_ms:.2f}"
+        description = _description(attributes)
+        if failed:
+            description = f"{description} failed".strip()
+        if description:
+            entry += f';desc="{description}"'
+        entries.append(entry)
+    if len(spans) > SERVER_TIMING_MAX_SPANS:
+        rest = spans[SERVER_TIMING_MAX_SPANS:]
+        entries.append(f'other;dur={sum(item[1] for item in rest):.2f};desc="{len(rest)} more spans"')
+    entries.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(entries)
+
+def trace_request(route: str):
+    """
+    Decorator for HTTP functions. Collects the spans recorded while the request runs and
+    adds them to the response as a Server-Timing header. The request latency and status are
+    recorded as metrics.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(req: func.HttpRequest) -> func.HttpResponse:
+            spans = []
+            start = time.perf_counter()
+            token = _request_spans.set(spans)
+            start_token = _request_start.set(start)
+            try:
+                if OTEL_TRACING_ENABLED:
+                    with _tracer().start_as_current_span(f"{req.method} /{route}", kind=otel_trace.SpanKind.SERVER) as root:
+                        response = fn(req)
+                        root.set_attribute("http.status_code", response.status_code)
+                else:
+                    response = fn(req)
+            except Exception:
+                # The host answers unhandled exceptions with a 500
+                record_request(route, req.method, 500, time.perf_counter() - start)
+                raise
+            finally:
+                _request_spans.reset(token)
+                _request_start.reset(start_token)
+            total_ms = (time.perf_counter() - start) * 1000
+            record_request(route, req.method, response.status_code, total_ms / 1000)
+
+            if total_ms >= SLOW_REQUEST_MS:
+                log_event(logging.WARNING, "Slow request", route=route, method=req.method, total_ms=round(total_ms, 2),
+                          spans=lambda: server_timing(spans, total_ms))
+            if SERVER_TIMING_ENABLED:
+                response.headers["Server-Timing"] = server_timing(spans, total_ms)
+            return response
+        return wrapper
+    return decorator
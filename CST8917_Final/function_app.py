@@ -1,83 +1,179 @@
 import os
 import logging
 import azure.functions as func
-from functions import user_functions, device_functions, telemetry_functions, conditions
-from scheduled.trigger_functions import scheduled_cleanup
+from config import json_utils
+from functools import lru_cache
+from config.http_utils import StaticAsset
+from config.trace_utils import trace_request
+from config.metrics_utils import register_cache_info
+
+# Handler modules and Azure SDKs are imported inside each route, so a cold start only
+# pays for the modules the first request actually needs.
+# trace_request times each HTTP request and returns its span breakdown as Server-Timing.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 @app.function_name(name="Ping")
 @app.route(route="ping", methods=["GET"])
+@trace_request("ping")
 def Ping(req: func.HttpRequest) -> func.HttpResponse:
+    # ?warmup=true imports the handlers and creates the shared clients ahead of real traffic
+    if req.params.get("warmup", "").lower() in ("1", "true"):
+        from functions.warmup import warm_up
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Function App is running", "warmup": warm_up()}),
+            status_code=200,
+            mimetype="application/json"
+        )
     return func.HttpResponse("Function App is running", status_code=200)
 
 
+@lru_cache(maxsize=None)
+def get_static_asset(*path_parts: str, mimetype: str) -> StaticAsset:
+    # Static files are read and compressed once per worker
+    return StaticAsset(os.path.join(APP_DIR, *path_parts), mimetype)
+
+register_cache_info("static_asset", get_static_asset.cache_info)
+
+@app.function_name(name="Metrics")
+@app.route(route="metrics", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def Metrics(req: func.HttpRequest) -> func.HttpResponse:
+    # Prometheus scrape target for this worker; not traced so scrapes do not show up in the metrics
+    from config.metrics_utils import render
+    return func.HttpResponse(
+        render(),
+        status_code=200,
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8", "Cache-Control": "no-store"}
+    )
+
+@app.function_name(name="SlowQueries")
+@app.route(route="metrics/slow-queries", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def SlowQueries(req: func.HttpRequest) -> func.HttpResponse:
+    # Database operation shapes slower than SLOW_QUERY_MS on this worker, worst total time first
+    from azure_services.query_profiler import slow_query_summary, SLOW_QUERY_MS
+    try:
+        limit = int(req.params.get("limit", "20"))
+    except ValueError:
+        return func.HttpResponse(json_utils.dumps({"message": "limit must be an integer"}), status_code=400, mimetype="application/json")
+    return func.HttpResponse(
+        json_utils.dumps({"thresholdMs": SLOW_QUERY_MS, "shapes": slow_query_summary(limit)}),
+        status_code=200,
+        mimetype="application/json"
+    )
+
 @app.function_name(name="SwaggerYaml")
 @app.route(route="swagger", methods=["GET"])
+@trace_request("swagger")
 def SwaggerYaml(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        yaml_path = os.path.join(os.getcwd(), 'swagger', 'swagger.yaml')
-        with open(yaml_path, 'r') as file:
-            return func.HttpResponse(file.read(), mimetype='application/x-yaml', status_code=200)
+        return get_static_asset('swagger', 'swagger.yaml', mimetype='application/x-yaml').response(req)
     except Exception as ex:
         return func.HttpResponse(f"Error loading YAML: {str(ex)}", status_code=500)
 
 @app.function_name(name="SwaggerUI")
 @app.route(route="swagger-ui", methods=["GET"])
+@trace_request("swagger-ui")
 def SwaggerUI(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        html_path = os.path.join(os.getcwd(), 'static', 'index.html')
-        with open(html_path, 'r') as file:
-            return func.HttpResponse(file.read(), mimetype='text/html', status_code=200)
+        return get_static_asset('static', 'index.html', mimetype='text/html').response(req)
     except Exception as ex:
         return func.HttpResponse(f"Error loading Swagger UI: {str(ex)}", status_code=500)
 
 @app.function_name(name="UserFunctions")
 @app.route(route="user", methods=["POST", "GET", "PUT", "PATCH", "DELETE"])
+@trace_request("user")
 def UserManagement(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the main function in user_functions.py
+    from functions import user_functions
     return user_functions.main(req)
 
 @app.function_name(name="LoginUser")
 @app.route(route="user/login", methods=["POST"])
+@trace_request("user/login")
 def LoginUser(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the login_user function in user_functions.py
+    from functions import user_functions
     return user_functions.login_user(req)
 
+@app.function_name(name="RefreshToken")
+@app.route(route="user/refresh", methods=["POST"])
+@trace_request("user/refresh")
+def RefreshToken(req: func.HttpRequest) -> func.HttpResponse:
+    # Dispatch the request to the refresh_token function in user_functions.py
+    from functions import user_functions
+    return user_functions.refresh_token(req)
+
 
 @app.function_name(name="DeviceFunctions")
 @app.route(route="devices", methods=["GET"])
+@trace_request("devices")
 def DeviceManagement(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the main function in device_functions.py
+    from functions import device_functions
     return device_functions.main(req)
 
+@app.function_name(name="DeviceStates")
+@app.route(route="devices/state", methods=["GET"])
+@trace_request("devices/state")
+def DeviceStates(req: func.HttpRequest) -> func.HttpResponse:
+    # Dispatch the request to the get_device_states function in device_functions.py
+    from functions import device_functions
+    return device_functions.get_device_states(req)
+
 @app.function_name(name="DeviceFunction")
 @app.route(route="device", methods=["POST", "PUT", "PATCH", "DELETE"])
+@trace_request("device")
 def DeviceManagement(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the main function in device_functions.py
+    from functions import device_functions
     return device_functions.main(req)
 
 @app.function_name(name="TelemetryFunctions")
 @app.route(route="telemetry", methods=["POST", "GET", "DELETE"])
+@trace_request("telemetry")
 def TelemetryManagement(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the main function in telemetry_functions.py
+    from functions import telemetry_functions
     return telemetry_functions.main(req)
 
+@app.function_name(name="TelemetryExport")
+@app.route(route="telemetry/export", methods=["GET"])
+@trace_request("telemetry/export")
+def TelemetryExport(req: func.HttpRequest) -> func.HttpResponse:
+    from functions import export_functions
+    return export_functions.export_telemetry(req)
+
+# Not traced: the request waits for readings, so its duration is not a latency
+@app.function_name(name="TelemetryLive")
+@app.route(route="telemetry/live", methods=["GET"])
+async def TelemetryLive(req: func.HttpRequest) -> func.HttpResponse:
+    # Dispatch the request to the stream_telemetry function in live_telemetry.py
+    from functions import live_telemetry
+    return await live_telemetry.stream_telemetry(req)
+
 @app.function_name(name="CreateAdminUser")
 @app.route(route="user/admin", methods=["POST"])
+@trace_request("user/admin")
 def CreateAdminUser(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the create_admin_user function in user_functions.py
+    from functions import user_functions
     return user_functions.create_admin_user(req)
 
 @app.function_name(name="GetUsers")
 @app.route(route="users", methods=["GET"])
+@trace_request("users")
 def GetUsers(req: func.HttpRequest) -> func.HttpResponse:
     # Dispatch the request to the get_users function in user_functions.py
+    from functions import user_functions
     return user_functions.get_users(req)
 
 @app.function_name(name="ConditionsFunctions")
 @app.route(route="conditions", methods=["POST", "GET", "PUT", "DELETE"])
+@trace_request("conditions")
 def ConditionsManagement(req: func.HttpRequest) -> func.HttpResponse:
+    from functions import conditions
     return conditions.main(req)
 
 @app.function_name(name="ScheduledCleanup")
@@ -88,4 +184,25 @@ def ScheduledCleanup(mytimer: func.TimerRequest):
     It performs cleanup of old images from blob storage and updates MongoDB.
     """
     logging.info("Scheduled cleanup function triggered.")
-    scheduled_cleanup(mytimer)
\ No newline at end of file
+    from scheduled.trigger_functions import scheduled_cleanup
+    scheduled_cleanup(mytimer)
+
+@app.function_name(name="ScheduledCompaction")
+@app.schedule(schedule="0 30 1 * * *", arg_name="mytimer", run_on_startup=False, use_monitor=True)
+def ScheduledCompaction(mytimer: func.TimerRequest):
+    """
+    Runs daily at 01:30 UTC and moves older telemetry into compact encoded buckets.
+    """
+    logging.info("Scheduled telemetry compaction triggered.")
+    from scheduled.trigger_functions import scheduled_compaction
+    scheduled_compaction(mytimer)
+
+@app.function_name(name="ScheduledDeferredEvents")
+@app.schedule(schedule="0 */5 * * * *", arg_name="mytimer", run_on_startup=False, use_monitor=True)
+def ScheduledDeferredEvents(mytimer: func.TimerRequest):
+    """
+    Runs every 5 minutes and sends the events deferred while Event Grid was unavailable.
+    """
+    logging.info("Scheduled deferred event replay triggered.")
+    from scheduled.trigger_functions import scheduled_deferred_events
+    scheduled_deferred_events(mytimer)
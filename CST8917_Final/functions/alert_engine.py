@@ -0,0 +1,188 @@
+import time
+import logging
+import threading
+
+# Defaults applied when a condition document does not define its own values
+DEFAULT_HYSTERESIS = 0.0        # Distance a value must move back inside the limit to clear an alert
+DEFAULT_DWELL_SECONDS = 0.0     # How long a violation must persist before an alert is raised
+DEFAULT_COOLDOWN_SECONDS = 300.0  # Minimum time between two alerts for the same (device, condition)
+MAX_TRACKED_PAIRS = 10000       # Upper bound on the number of (device, condition) states kept in memory
+
+STATE_OK = 0
+STATE_PENDING = 1
+STATE_ALERTING = 2
+
+ALERT_RAISED = "ALERT"
+ALERT_RESOLVED = "RESOLVED"
+
+
+class AlertState:
+    """
+    Compact per (device, condition) state. Only the fields needed for a transition are kept.
+    """
+    __slots__ = ("state", "since", "last_alert", "cooldown")
+
+    def __init__(self):
+        self.state = STATE_OK
+        self.since = 0.0        # Time the current violation started (PENDING / ALERTING)
+        self.last_alert = None  # Time the last alert was raised, used for the cooldown
+        self.cooldown = 0.0     # Cooldown of the condition when the last alert was raised
+
+
+def _number(value, default):
+    """
+    Returns the value as a float, or the default if the value is missing or not numeric.
+    """
+    try:
+        return float(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+
+def _is_number(value) -> bool:
+    """
+    Returns True for int and float values; booleans, strings and documents are not compared.
+    """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_violation(value, min_value, max_value) -> bool:
+    """
+    Returns True if the value is outside the [min_value, max_value] range. Values and limits
+    that are not numbers are skipped.
+    """
+    if not _is_number(value):
+        return False
+    if _is_number(min_value) and value < min_value:
+        return True
+    if _is_number(max_value) and value > max_value:
+        return True
+    return False
+
+
+def is_cleared(value, min_value, max_value, hysteresis: float) -> bool:
+    """
+    Returns True if the value is back inside the range by at least the hysteresis margin.
+    A value that is not a number never clears an alert.
+    """
+    if not _is_number(value):
+        return False
+    if _is_number(min_value) and value < min_value + hysteresis:
+        return False
+    if _is_number(max_value) and value > max_value - hysteresis:
+        return False
+    return True
+
+
+class AlertEngine:
+    """
+    Stateful alert evaluation with enter/exit hysteresis, a minimum dwell time and a cooldown.
+    Each reading is evaluated in O(1) and a transition is returned only when the state changes.
+    The states are kept in memory by each worker process, so every scaled-out worker applies
+    its own dwell time and cooldown to the readings it receives.
+    """
+
+    def __init__(self, max_pairs: int = MAX_TRACKED_PAIRS, clock=time.monotonic):
+        self.max_pairs = max_pairs
+        self.clock = clock
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def evaluate(self, device_id: str, condition: dict, value, now: float = None):
+        """
+        Evaluates a single reading against a condition.
+        Returns ALERT_RAISED, ALERT_RESOLVED or None if no alert transition happened.
+        """
+        min_value = condition.get("minValue")
+        max_value = condition.get("maxValue")
+        if min_value is None and max_value is None:
+            return None
+        if not _is_number(value):
+            # A reading that is not a number neither starts nor ends a violation
+            return None
+
+        hysteresis = _number(condition.get("hysteresis"), DEFAULT_HYSTERESIS)
+        dwell = _number(condition.get("dwellSeconds"), DEFAULT_DWELL_SECONDS)
+        cooldown = _number(condition.get("cooldownSeconds"), DEFAULT_COOLDOWN_SECONDS)
+        now = self.clock() if now is None else now
+        key = (device_id, str(condition.get("_id")))
+
+        with self._lock:
+            entry = self._states.get(key)
+            violated = is_violation(value, min_value, max_value)
+
+            if entry is None:
+                if not violated:
+                    # Nothing to remember for a pair that has never been in violation
+                    return None
+                if len(self._states) >= self.max_pairs:
+                    self._evict(now)
+                entry = self._states[key] = AlertState()
+
+            if entry.state == STATE_OK:
+                if violated:
+                    entry.state = STATE_PENDING
+                    entry.since = now
+                    return self._maybe_raise(entry, now, dwell, cooldown)
+                return None
+
+            if entry.state == STATE_PENDING:
+                if not violated:
+                    # Violation did not last long enough, no alert was raised
+                    entry.state = STATE_OK
+                    return None
+                return self._maybe_raise(entry, now, dwell, cooldown)
+
+            # STATE_ALERTING: only clear once the value is back inside the hysteresis band
+            if is_cleared(value, min_value, max_value, hysteresis):
+                entry.state = STATE_OK
+                return ALERT_RESOLVED
+            return None
+
+    def _maybe_raise(self, entry: AlertState, now: float, dwell: float, cooldown: float):
+        """
+        Raises the alert once the dwell time has elapsed and the cooldown has expired.
+        """
+        if now - entry.since < dwell:
+            return None
+        if entry.last_alert is not None and now - entry.last_alert < cooldown:
+            # Stay pending; the alert is raised on the first reading after the cooldown expires
+            return None
+        entry.state = STATE_ALERTING
+        entry.last_alert = now
+        entry.cooldown = cooldown
+        return ALERT_RAISED
+
+    def _evict(self, now: float):
+        """
+        Drops states that are no longer in violation and whose cooldown has expired first, then
+        the oldest entry. Resolved states still in their cooldown are kept, so a new violation
+        cannot alert again right away.
+        """
+        idle = [
+            key for key, entry in self._states.items()
+            if entry.state == STATE_OK and (entry.last_alert is None or now - entry.last_alert >= entry.cooldown)
+        ]
+        for key in idle:
+            del self._states[key]
+        if len(self._states) >= self.max_pairs:
+            del self._states[next(iter(self._states))]
+        logging.debug(f"[AlertEngine] Evicted states, {len(self._states)} remaining.")
+
+    def get_state(self, device_id: str, condition_id) -> int:
+        """
+        Returns the current state for a (device, condition) pair.
+        """
+        entry = self._states.get((device_id, str(condition_id)))
+        return entry.state if entry else STATE_OK
+
+    def reset(self):
+        """
+        Clears all tracked states.
+        """
+        with self._lock:
+            self._states.clear()
+
+
+# Shared engine for the worker process
+alert_engine = AlertEngine()
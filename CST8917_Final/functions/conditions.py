@@ -1,18 +1,12 @@
 import logging
-import json
 import azure.functions as func
-from bson import ObjectId  # Import for handling ObjectId
+from config import json_utils
+from bson import ObjectId  # Import for parsing conditionId values
 from azure_services.cosmosdb_service import CosmosDBService
 from config.jwt_utils import authenticate_user
-from config.azure_config import get_azure_config  # Import for reading Azure configuration
-
-def json_serializer(obj):
-    """
-    Custom JSON serializer to handle ObjectId and other non-serializable types.
-    """
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    raise TypeError(f"Type {type(obj)} not serializable")
+from config.log_utils import log_event
+from config.http_utils import compressed_response
+from config.config_utils import get_config  # Import for reading the cached Azure configuration
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -26,7 +20,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     if not isinstance(user_id, str):  # Ensure user_id is a valid string
         logging.error("Authentication failed or invalid user_id.")
         return func.HttpResponse(
-            json.dumps({"error": "Unauthorized or invalid user_id"}), 
+            json_utils.dumps({"error": "Unauthorized or invalid user_id"}), 
             status_code=401, 
             mimetype="application/json"
         )
@@ -36,7 +30,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     try:
         logging.info("Parsing the request body.")
         req_body = req.get_json()  # Try to parse the JSON body
-        logging.debug(f"Request body parsed successfully: {req_body}")
+        log_event(logging.DEBUG, "Request body parsed successfully", route="conditions", body=req_body)
     except ValueError:
         logging.warning("No JSON body provided. Using an empty dictionary as request body.")
         req_body = {}  # If no JSON body is provided, use an empty dictionary
@@ -61,7 +55,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     else:
         logging.error(f"Unsupported HTTP method: {method}")
         return func.HttpResponse(
-            json.dumps({"error": "Method not allowed"}), 
+            json_utils.dumps({"error": "Method not allowed"}), 
             status_code=405, 
             mimetype="application/json"
         )
@@ -69,22 +63,18 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     # Serialize the response and return
     try:
         logging.info("Serializing the response.")
-        response_body = json.dumps(response, default=json_serializer)
-        logging.debug(f"Response serialized successfully: {response_body}")
+        response_body = json_utils.dumps(response)
+        log_event(logging.DEBUG, "Response serialized successfully", route="conditions", size=len(response_body))
     except Exception as e:
         logging.error(f"Error while serializing the response: {str(e)}")
         return func.HttpResponse(
-            json.dumps({"error": "Internal server error"}), 
+            json_utils.dumps({"error": "Internal server error"}), 
             status_code=500, 
             mimetype="application/json"
         )
 
     logging.info(f"Returning response with status_code={status_code}.")
-    return func.HttpResponse(
-        response_body, 
-        status_code=status_code, 
-        mimetype="application/json"
-    )
+    return compressed_response(req, response_body, status_code=status_code)
 
 
 def get_conditions(req_body, user_id):
@@ -93,7 +83,7 @@ def get_conditions(req_body, user_id):
     """
     logging.info(f"Fetching conditions for userId={user_id}.")
     cosmos_service = CosmosDBService()
-    config = get_azure_config()  # Load Azure configuration
+    config = get_config()  # Load Azure configuration
     collection_name = config["CONDITION_COLLECTION_NAME"]  # Get the Conditions collection name
 
     # Extract deviceId from the request body
@@ -108,7 +98,7 @@ def get_conditions(req_body, user_id):
     if device_id:
         query["deviceId"] = device_id
 
-    logging.debug(f"Query to be executed: {query}")
+    log_event(logging.DEBUG, "Query to be executed", route="get_conditions", query=query)
 
     try:
         # Fetch conditions from the specified collection
@@ -118,7 +108,7 @@ def get_conditions(req_body, user_id):
         logging.error(f"Error while fetching conditions: {str(e)}")
         return {"message": "Failed to fetch conditions"}, 500
 
-    logging.debug(f"Conditions fetched: {conditions}")
+    log_event(logging.DEBUG, "Conditions fetched", route="get_conditions", conditions=conditions)
     return {"conditions": conditions}, 200
 
 
@@ -127,7 +117,7 @@ def post_condition(req_body, user_id):
     Create one or multiple conditions. If deviceId is provided, verify the device exists.
     """
     cosmos_service = CosmosDBService()
-    config = get_azure_config()
+    config = get_config()
     collection_name = config["CONDITION_COLLECTION_NAME"]  # Read the collection name from azure_config
 
     # Normalize input to always be a list
@@ -162,6 +152,9 @@ def post_condition(req_body, user_id):
             "maxValue": condition_data.get("maxValue"),
             "exactValue": condition_data.get("exactValue"),
             "unit": condition_data.get("unit"),  # Add the Unit field
+            "hysteresis": condition_data.get("hysteresis"),  # Margin required to clear an alert
+            "dwellSeconds": condition_data.get("dwellSeconds"),  # Time a violation must last before alerting
+            "cooldownSeconds": condition_data.get("cooldownSeconds"),  # Minimum time between alerts
         }
 
         try:
@@ -184,7 +177,7 @@ def put_condition(req_body, user_id):
     """
     logging.info("Starting condition update process.")
     cosmos_service = CosmosDBService()
-    config = get_azure_config()
+    config = get_config()
     collection_name = config["CONDITION_COLLECTION_NAME"]  # Get the Conditions collection name
 
     # Validate the request body
@@ -202,7 +195,7 @@ def put_condition(req_body, user_id):
         logging.error(f"Invalid conditionId format: {str(e)}")
         return {"error": "Invalid conditionId format"}, 400
 
-    logging.info(f"Query to find the condition: {query}")
+    log_event(logging.INFO, "Query to find the condition", route="put_condition", query=query)
 
     # Prepare the fields to update
     update_fields = {key: value for key, value in req_body.items() if key not in ["conditionId", "type"]}
@@ -210,7 +203,7 @@ def put_condition(req_body, user_id):
         logging.error("No fields provided to update.")
         return {"message": "No fields to update provided"}, 400
 
-    logging.info(f"Fields to update: {update_fields}")
+    log_event(logging.INFO, "Fields to update", route="put_condition", fields=update_fields)
 
     try:
         # Perform the update
@@ -233,7 +226,7 @@ def delete_condition(req_body, user_id):
     """
     logging.info("Starting condition deletion process.")
     cosmos_service = CosmosDBService()
-    config = get_azure_config()
+    config = get_config()
     collection_name = config["CONDITION_COLLECTION_NAME"]  # Get the Conditions collection name
 
     # Validate the request body
@@ -251,7 +244,7 @@ def delete_condition(req_body, user_id):
         logging.error(f"Invalid conditionId format: {str(e)}")
         return {"error": "Invalid conditionId format"}, 400
 
-    logging.info(f"Query to delete the condition: {query}")
+    log_event(logging.INFO, "Query to delete the condition", route="delete_condition", query=query)
 
     try:
         # Perform the deletion
@@ -1,10 +1,15 @@
-import json
+import re
 import logging
-import datetime
 import azure.functions as func
+from config import json_utils
 from config.jwt_utils import authenticate_user
+from config.time_utils import utc_now, parse_datetime
+from config.http_utils import compressed_response, not_modified_for_version, versioned_headers, service_unavailable_response
 from azure_services.cosmosdb_service import CosmosDBService
 from azure_services.iot_hub_service import IoTHubService
+from azure_services.resilience import DependencyUnavailable
+from functions.telemetry_codec import read_telemetry, telemetry_count, last_reading_time
+from functions.device_state import STATE_FIELD, format_state
 
 def register_device(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing register_device request.")
@@ -19,7 +24,7 @@ def register_device(req: func.HttpRequest) -> func.HttpResponse:
         req_body = req.get_json()
     except ValueError:
         return func.HttpResponse(
-            json.dumps({"message": "Invalid JSON body"}), 
+            json_utils.dumps({"message": "Invalid JSON body"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -31,7 +36,7 @@ def register_device(req: func.HttpRequest) -> func.HttpResponse:
     location = req_body.get("location", {})
     if not device_id or not device_name or not sensor_type or not location.get("name"):
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -42,14 +47,17 @@ def register_device(req: func.HttpRequest) -> func.HttpResponse:
         result = iot_service.register_device_in_iot_hub(req_body)
         if "already exists" in result["message"]:
             return func.HttpResponse(
-                json.dumps({"message": "Device already exists in IoT Hub"}), 
+                json_utils.dumps({"message": "Device already exists in IoT Hub"}), 
                 status_code=409, 
                 mimetype="application/json"
             )
+    except DependencyUnavailable as e:
+        logging.warning(f"IoT Hub unavailable: {str(e)}")
+        return service_unavailable_response("IoT Hub is unavailable, please retry", e.retry_after)
     except Exception as e:
         logging.exception("Failed to register device in IoT Hub.")
         return func.HttpResponse(
-            json.dumps({"message": f"Failed to register device in IoT Hub: {str(e)}"}), 
+            json_utils.dumps({"message": f"Failed to register device in IoT Hub: {str(e)}"}), 
             status_code=500, 
             mimetype="application/json"
         )
@@ -59,7 +67,7 @@ def register_device(req: func.HttpRequest) -> func.HttpResponse:
     user = cosmos_service.find_document({"_id": user_id})
     if not user:
         return func.HttpResponse(
-            json.dumps({"message": "User not found"}), 
+            json_utils.dumps({"message": "User not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -74,22 +82,101 @@ def register_device(req: func.HttpRequest) -> func.HttpResponse:
             "longitude": location.get("longitude", ""),
             "latitude": location.get("latitude", "")
         },
-        "registrationDate": datetime.datetime.utcnow().isoformat(),  # Add registration date
+        "registrationDate": utc_now(),  # Add registration date (stored as a native date)
         "telemetryData": []  # Initialize with an empty telemetryData array
     }
 
     # Add the device to the user's Devices array
     result = cosmos_service.update_document(
         {"_id": user_id},
-        {"$push": {"Devices": device_object}}
+        {"$push": {"Devices": device_object}, "$inc": {"version": 1}}  # version backs the GET ETags
     )
     
     return func.HttpResponse(
-        json.dumps({"message": "Device registered successfully"}), 
+        json_utils.dumps({"message": "Device registered successfully"}), 
         status_code=201, 
         mimetype="application/json"
     )
 
+# Device fields returned by view=summary
+DEVICE_SUMMARY_FIELDS = [
+    "deviceId", "deviceName", "sensorType", "location", "registrationDate", "telemetryCount", "lastReadingTime"
+]
+# Fields computed from telemetryData and the compacted telemetryBuckets by the database
+# instead of returning the telemetry
+DEVICE_COMPUTED_FIELDS = {
+    "telemetryCount": {"$add": [
+        {"$size": {"$ifNull": ["$$d.telemetryData", []]}},
+        {"$sum": "$$d.telemetryBuckets.count"}
+    ]},
+    # Both arrays are in event_date order
+    "lastReadingTime": {"$max": [
+        {"$arrayElemAt": ["$$d.telemetryData.event_date", -1]},
+        {"$arrayElemAt": ["$$d.telemetryBuckets.end", -1]}
+    ]},
+}
+# Storage fields that are never returned to clients; the last state is returned by get_device_states
+HIDDEN_DEVICE_FIELDS = {"telemetryBuckets", STATE_FIELD}
+FIELD_NAME_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+
+def parse_device_fields(req: func.HttpRequest):
+    """
+    Returns the device fields requested with fields= or view=summary, None for full devices,
+    or raises ValueError for an invalid field list.
+    """
+    fields = req.params.get("fields")
+    view = req.params.get("view")
+    if view and view != "summary":
+        raise ValueError(f"Unknown view: {view}")
+    if not fields:
+        return list(DEVICE_SUMMARY_FIELDS) if view == "summary" else None
+    field_list = [field.strip() for field in fields.split(",") if field.strip()]
+    if not field_list or not all(FIELD_NAME_PATTERN.match(field) and field not in HIDDEN_DEVICE_FIELDS
+                                 for field in field_list):
+        raise ValueError("fields must be a comma separated list of device field names")
+    return field_list
+
+def build_device_fields_pipeline(user_id: str, fields: list, device_id: str = None, device_name: str = None) -> list:
+    """
+    Pipeline returning only the requested fields of the user's devices (plus the document version).
+    Telemetry counts and the last reading time are computed by the database.
+    """
+    devices = {"$ifNull": ["$Devices", []]}
+    conditions = []
+    if device_id:
+        conditions.append({"$eq": ["$$d.deviceId", device_id]})
+    if device_name:
+        conditions.append({"$eq": ["$$d.deviceName", device_name]})
+    if conditions:
+        devices = {"$filter": {"input": devices, "as": "d", "cond": {"$and": conditions}}}
+    return [
+        {"$match": {"_id": user_id}},
+        {"$project": {
+            "version": 1,
+            "Devices": {"$map": {
+                "input": devices,
+                "as": "d",
+                "in": {field: DEVICE_COMPUTED_FIELDS.get(field, f"$$d.{field}") for field in fields}
+            }}
+        }}
+    ]
+
+def select_device_fields(device: dict, fields: list) -> dict:
+    """
+    Python equivalent of build_device_fields_pipeline for devices that were already loaded.
+    """
+    computed = {
+        "telemetryCount": lambda: telemetry_count(device),
+        "lastReadingTime": lambda: last_reading_time(device),
+    }
+    result = {}
+    for field in fields:
+        if field in computed:
+            result[field] = computed[field]()
+        elif field in device:
+            result[field] = device[field]
+    return result
+
 def get_devices(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing get_devices request.")
     
@@ -98,12 +185,58 @@ def get_devices(req: func.HttpRequest) -> func.HttpResponse:
     if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
         return user_id
     
+    # Extract query parameters
+    device_id = req.params.get("deviceId")
+    device_name = req.params.get("deviceName")
+    telemetry_date = req.params.get("telemetryDate")
+    sensor_type = req.params.get("sensorType")
+    value_type = req.params.get("valueType")
+    value_min = req.params.get("valueMin")
+    value_max = req.params.get("valueMax")
+    telemetry_filters = telemetry_date or sensor_type or value_type or value_min or value_max
+    
+    try:
+        fields = parse_device_fields(req)
+        if telemetry_date:
+            telemetry_date = parse_datetime(telemetry_date)
+    except ValueError as e:
+        return func.HttpResponse(
+            json_utils.dumps({"message": str(e)}), 
+            status_code=400, 
+            mimetype="application/json"
+        )
+    
     # Fetch the user's devices from CosmosDB
     cosmos_service = CosmosDBService()
+    
+    # Unchanged polls are answered from the version field alone
+    not_modified = not_modified_for_version(req, lambda: cosmos_service.find_version({"_id": user_id}))
+    if not_modified:
+        return not_modified
+    
+    # Sparse fieldsets without telemetry filters are served by a database projection,
+    # so the telemetry history is never transferred
+    if fields and not telemetry_filters and "telemetryData" not in fields:
+        result = cosmos_service.aggregate(build_device_fields_pipeline(user_id, fields, device_id, device_name))
+        if not result:
+            return func.HttpResponse(
+                json_utils.dumps({"message": "User not found"}), 
+                status_code=404, 
+                mimetype="application/json"
+            )
+        devices = result[0].get("Devices", [])
+        if device_id and not devices:
+            return func.HttpResponse(
+                json_utils.dumps({"message": "Device not found"}), 
+                status_code=404, 
+                mimetype="application/json"
+            )
+        return compressed_response(req, json_utils.dumps(devices), headers=versioned_headers(req, result[0].get("version", 0)))
+    
     user = cosmos_service.find_document({"_id": user_id})
     if not user:
         return func.HttpResponse(
-            json.dumps({"message": "User not found"}), 
+            json_utils.dumps({"message": "User not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -111,15 +244,6 @@ def get_devices(req: func.HttpRequest) -> func.HttpResponse:
     # Get the devices array from the user document
     devices = user.get("Devices", [])
     
-    # Extract query parameters
-    device_id = req.params.get("deviceId")
-    device_name = req.params.get("deviceName")
-    telemetry_date = req.params.get("telemetryDate")
-    sensor_type = req.params.get("sensorType")
-    value_type = req.params.get("valueType")
-    value_min = req.params.get("valueMin")
-    value_max = req.params.get("valueMax")
-    
     # Filter devices based on query parameters
     filtered_devices = []
     for device in devices:
@@ -128,12 +252,11 @@ def get_devices(req: func.HttpRequest) -> func.HttpResponse:
         if device_name and device.get("deviceName") != device_name:
             continue
         
-        # Filter telemetry data
-        telemetry_data = device.get("telemetryData", [])
+        # Filter telemetry data; readings are kept in event_date order, so the date is found by
+        # binary search and only the compacted buckets around it are decoded
+        telemetry_data = read_telemetry(device, telemetry_date, telemetry_date) if telemetry_date else read_telemetry(device)
         matching_telemetry = []
         for telemetry in telemetry_data:
-            if telemetry_date and telemetry.get("event_date") != telemetry_date:
-                continue
             if sensor_type and not any(value.get("valueType") == sensor_type for value in telemetry.get("values", [])):
                 continue
             if value_type or value_min or value_max:
@@ -149,25 +272,55 @@ def get_devices(req: func.HttpRequest) -> func.HttpResponse:
             else:
                 matching_telemetry.append(telemetry)
         
-        if matching_telemetry:
-            device["telemetryData"] = matching_telemetry
-            filtered_devices.append(device)
-        elif not telemetry_date and not sensor_type and not value_type and not value_min and not value_max:
-            filtered_devices.append(device)
+        if matching_telemetry or not telemetry_filters:
+            # Build a new device object instead of modifying the loaded document
+            filtered_device = {key: value for key, value in device.items() if key not in HIDDEN_DEVICE_FIELDS}
+            filtered_device["telemetryData"] = matching_telemetry
+            filtered_devices.append(filtered_device)
     
     # If a specific deviceId is provided, return only that device
     if device_id and not filtered_devices:
         return func.HttpResponse(
-            json.dumps({"message": "Device not found"}), 
+            json_utils.dumps({"message": "Device not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
     
-    return func.HttpResponse(
-        json.dumps(filtered_devices), 
-        status_code=200, 
-        mimetype="application/json"
-    )
+    if fields:
+        filtered_devices = [select_device_fields(device, fields) for device in filtered_devices]
+    
+    return compressed_response(req, json_utils.dumps(filtered_devices), headers=versioned_headers(req, user.get("version", 0)))
+
+def get_device_states(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Returns the last known state of every device of the user, read without the telemetry.
+    """
+    logging.info("Processing get_device_states request.")
+    
+    # Authenticate the user
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
+        return user_id
+    
+    cosmos_service = CosmosDBService()
+    
+    # Unchanged polls are answered from the version field alone
+    not_modified = not_modified_for_version(req, lambda: cosmos_service.find_version({"_id": user_id}))
+    if not_modified:
+        return not_modified
+    
+    user = cosmos_service.find_document({"_id": user_id}, projection={
+        "version": 1, "Devices.deviceId": 1, "Devices.deviceName": 1, "Devices.sensorType": 1, f"Devices.{STATE_FIELD}": 1
+    })
+    if not user:
+        return func.HttpResponse(
+            json_utils.dumps({"message": "User not found"}), 
+            status_code=404, 
+            mimetype="application/json"
+        )
+    
+    states = [format_state(device) for device in user.get("Devices", [])]
+    return compressed_response(req, json_utils.dumps(states), headers=versioned_headers(req, user.get("version", 0)))
 
 def update_device(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing update_device request.")
@@ -182,7 +335,7 @@ def update_device(req: func.HttpRequest) -> func.HttpResponse:
         req_body = req.get_json()
     except ValueError:
         return func.HttpResponse(
-            json.dumps({"message": "Invalid JSON body"}), 
+            json_utils.dumps({"message": "Invalid JSON body"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -192,7 +345,13 @@ def update_device(req: func.HttpRequest) -> func.HttpResponse:
     update_data = req_body.get("update", {})
     if not device_id or not update_data:
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
+            status_code=400, 
+            mimetype="application/json"
+        )
+    if HIDDEN_DEVICE_FIELDS.intersection(update_data):
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Compacted telemetry and the last state cannot be updated"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -202,7 +361,7 @@ def update_device(req: func.HttpRequest) -> func.HttpResponse:
     user = cosmos_service.find_document({"_id": user_id})
     if not user:
         return func.HttpResponse(
-            json.dumps({"message": "User not found"}), 
+            json_utils.dumps({"message": "User not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -212,7 +371,7 @@ def update_device(req: func.HttpRequest) -> func.HttpResponse:
     device = next((d for d in devices if d["deviceId"] == device_id), None)
     if not device:
         return func.HttpResponse(
-            json.dumps({"message": "Device not found"}), 
+            json_utils.dumps({"message": "Device not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -220,17 +379,21 @@ def update_device(req: func.HttpRequest) -> func.HttpResponse:
     # Update the device in the user's Devices array
     result = cosmos_service.update_document(
         {"_id": user_id, "Devices.deviceId": device_id},
-        {"$set": {f"Devices.$.{key}": value for key, value in update_data.items()}}
+        {
+            "$set": {f"Devices.$.{key}": value for key, value in update_data.items()},
+            "$inc": {"version": 1}
+        }
     )
-    if result.modified_count == 0:
+    # The version is always incremented, so only a device removed meanwhile leaves the document unchanged
+    if result.matched_count == 0:
         return func.HttpResponse(
-            json.dumps({"message": "Device not updated"}), 
-            status_code=400, 
+            json_utils.dumps({"message": "Device not found"}), 
+            status_code=404, 
             mimetype="application/json"
         )
     
     return func.HttpResponse(
-        json.dumps({"message": "Device updated successfully"}), 
+        json_utils.dumps({"message": "Device updated successfully"}), 
         status_code=200, 
         mimetype="application/json"
     )
@@ -248,7 +411,7 @@ def delete_device(req: func.HttpRequest) -> func.HttpResponse:
         req_body = req.get_json()
     except ValueError:
         return func.HttpResponse(
-            json.dumps({"message": "Invalid JSON body"}), 
+            json_utils.dumps({"message": "Invalid JSON body"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -257,7 +420,7 @@ def delete_device(req: func.HttpRequest) -> func.HttpResponse:
     device_id = req_body.get("deviceId")
     if not device_id:
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -267,7 +430,7 @@ def delete_device(req: func.HttpRequest) -> func.HttpResponse:
     user = cosmos_service.find_document({"_id": user_id})
     if not user:
         return func.HttpResponse(
-            json.dumps({"message": "User not found"}), 
+            json_utils.dumps({"message": "User not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -277,7 +440,7 @@ def delete_device(req: func.HttpRequest) -> func.HttpResponse:
     device = next((d for d in devices if d["deviceId"] == device_id), None)
     if not device:
         return func.HttpResponse(
-            json.dumps({"message": "Device not found"}), 
+            json_utils.dumps({"message": "Device not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -286,28 +449,32 @@ def delete_device(req: func.HttpRequest) -> func.HttpResponse:
     try:
         iot_service = IoTHubService()
         iot_service.delete_device_from_iot_hub(device_id)
+    except DependencyUnavailable as e:
+        logging.warning(f"IoT Hub unavailable: {str(e)}")
+        return service_unavailable_response("IoT Hub is unavailable, please retry", e.retry_after)
     except Exception as e:
         logging.exception("Failed to delete device from IoT Hub.")
         return func.HttpResponse(
-            json.dumps({"message": f"Failed to delete device from IoT Hub: {str(e)}"}), 
+            json_utils.dumps({"message": f"Failed to delete device from IoT Hub: {str(e)}"}), 
             status_code=500, 
             mimetype="application/json"
         )
     
     # Remove the device from the user's Devices array
     result = cosmos_service.update_document(
-        {"_id": user_id},
-        {"$pull": {"Devices": {"deviceId": device_id}}}
+        {"_id": user_id, "Devices.deviceId": device_id},
+        {"$pull": {"Devices": {"deviceId": device_id}}, "$inc": {"version": 1}}
     )
-    if result.modified_count == 0:
+    # The version is always incremented, so only a device removed meanwhile leaves the document unchanged
+    if result.matched_count == 0:
         return func.HttpResponse(
-            json.dumps({"message": "Failed to remove device from user's Devices array"}), 
-            status_code=400, 
+            json_utils.dumps({"message": "Device not found"}), 
+            status_code=404, 
             mimetype="application/json"
         )
     
     return func.HttpResponse(
-        json.dumps({"message": "Device deleted successfully"}), 
+        json_utils.dumps({"message": "Device deleted successfully"}), 
         status_code=200, 
         mimetype="application/json"
     )
@@ -330,7 +497,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return delete_device(req)
     else:
         return func.HttpResponse(
-            json.dumps({"message": "Method not allowed"}), 
+            json_utils.dumps({"message": "Method not allowed"}), 
             status_code=405, 
             mimetype="application/json"
         )
@@ -0,0 +1,139 @@
+"""
+Last known state of a device: the newest value and time per valueType and the newest image,
+stored in the device's lastState field so dashboards can read current values without
+loading the telemetry history.
+
+    "lastState": {
+        "event_date": <newest reading>,
+        "values": {"<valueType>": {"event_date": ..., "eventId": ..., "value": ...}},
+        "image": {"event_date": ..., "eventId": ..., "url": ...}
+    }
+"""
+from urllib.parse import unquote
+
+STATE_FIELD = "lastState"
+
+def state_key(value_type: str) -> str:
+    """
+    Field name for a valueType; "." and a leading "$" cannot be used in field names, so they
+    are percent-encoded (as is "%", so the key can be decoded with unquote).
+    """
+    key = value_type.replace("%", "%25").replace(".", "%2E")
+    return "%24" + key[1:] if key.startswith("$") else key
+
+def state_entries(telemetry: dict) -> dict:
+    """
+    Returns {path below lastState: entry} for one reading. Every entry starts with its
+    event_date, so comparing two entries compares their times first.
+    """
+    event_date = telemetry.get("event_date")
+    event_id = telemetry.get("eventId")
+    entries = {"event_date": event_date}
+    for value in telemetry.get("values") or []:
+        if not isinstance(value, dict):
+            continue
+        value_type = value.get("valueType")
+        if isinstance(value_type, str) and value_type and value.get("value") is not None:
+            entries[f"values.{state_key(value_type)}"] = {"event_date": event_date, "eventId": event_id, "value": value["value"]}
+    if telemetry.get("image"):
+        entries["image"] = {"event_date": event_date, "eventId": event_id, "url": telemetry["image"]}
+    return entries
+
+def state_update(telemetry: dict, device_path: str = "Devices.$") -> dict:
+    """
+    $max operand that merges a reading into the device's last state, meant for the update that
+    stores the reading. Documents are compared field by field, so an entry is only replaced by
+    a newer reading even when concurrent requests are stored out of order.
+    """
+    return {f"{device_path}.{STATE_FIELD}.{path}": entry for path, entry in state_entries(telemetry).items()}
+
+def build_state(readings: list) -> dict:
+    """
+    Builds the last state from readings in event_date order, e.g. for devices stored before
+    last states existed.
+    """
+    state = {"values": {}}
+    for telemetry in readings:
+        for path, entry in state_entries(telemetry).items():
+            if path.startswith("values."):
+                state["values"][path[len("values."):]] = entry
+            else:
+                state[path] = entry
+    if len(state) == 1:
+        return {}
+    return state
+
+def state_paths(state: dict) -> dict:
+    """
+    Returns {path below lastState: entry} for a last state, the reverse of build_state.
+    """
+    paths = {path: state[path] for path in ("event_date", "image") if state.get(path) is not None}
+    paths.update({f"values.{key}": entry for key, entry in (state.get("values") or {}).items()})
+    return paths
+
+def merge_state_update(state: dict, device_path: str = "Devices.$") -> dict:
+    """
+    $max operand that merges a state built with build_state into the device's last state,
+    keeping the entries that are already newer.
+    """
+    return {f"{device_path}.{STATE_FIELD}.{path}": entry for path, entry in state_paths(state).items()}
+
+def state_repair(device: dict, telemetry: dict, remaining):
+    """
+    Returns (guard, set, unset) removing a reading from the device's last state, all with paths
+    below lastState. Only the entries that came from the reading are rebuilt from the remaining
+    readings (remaining() returns them in event_date order, and is only called when the reading
+    is part of the state) or unset when no reading is left for them. guard holds the conditions
+    under which those entries still are the reading's, so entries replaced by a concurrent
+    request are not overwritten.
+    """
+    state = device.get(STATE_FIELD) or {}
+    event_date = telemetry.get("event_date")
+    if not state or event_date is None:
+        return {}, {}, []
+    affected = [path for path, entry in state_paths(state).items() if isinstance(entry, dict) and entry.get("event_date") == event_date]
+    guard = {f"{path}.event_date": event_date for path in affected}
+    if state.get("event_date") == event_date:
+        affected.append("event_date")
+        guard["event_date"] = event_date
+    if not affected:
+        return {}, {}, []
+    entries = state_paths(build_state(remaining()))
+    updates = {path: entries[path] for path in affected if path in entries}
+    return guard, updates, [path for path in affected if path not in updates]
+
+def format_state(device: dict) -> dict:
+    """
+    Returns the device's last state as returned by the API, with the valueTypes decoded.
+    """
+    state = device.get(STATE_FIELD) or {}
+    return {
+        "deviceId": device.get("deviceId"),
+        "deviceName": device.get("deviceName"),
+        "sensorType": device.get("sensorType"),
+        "lastReadingTime": state.get("event_date"),
+        "values": {unquote(key): entry for key, entry in (state.get("values") or {}).items()},
+        "image": state.get("image"),
+    }
+
+def newest_reading(device: dict):
+    """
+    Returns the device's newest reading as recorded in its last state (the values and image
+    whose time is the newest reading time), or None if it has no readings.
+    """
+    state = device.get(STATE_FIELD) or {}
+    event_date = state.get("event_date")
+    if event_date is None:
+        return None
+    entries = {key: entry for key, entry in (state.get("values") or {}).items() if entry.get("event_date") == event_date}
+    image = state.get("image") or {}
+    latest = [*entries.values(), image] if image.get("event_date") == event_date else list(entries.values())
+    reading = {
+        "deviceId": device.get("deviceId"),
+        "eventId": next((entry.get("eventId") for entry in latest if entry.get("eventId")), None),
+        "event_date": event_date,
+        "values": [{"valueType": unquote(key), "value": entry.get("value")} for key, entry in entries.items()],
+    }
+    if image.get("event_date") == event_date:
+        reading["image"] = image.get("url")
+    return reading
@@ -0,0 +1,294 @@
+import io
+import os
+import csv
+import sys
+import uuid
+import logging
+import argparse
+from heapq import merge
+import azure.functions as func
+from config import json_utils
+from config.jwt_utils import authenticate_user
+from config.time_utils import parse_datetime, event_time, time_range
+from azure_services.cosmosdb_service import CosmosDBService
+from functions.telemetry_codec import decode_bucket
+
+try:
+    import pyarrow  # Optional: required for the parquet and arrow formats
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# format -> (content type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+# One row per reading value
+EXPORT_COLUMNS = ["deviceId", "eventId", "eventDate", "valueType", "value"]
+# Rows buffered per chunk; bounds the worker's memory regardless of the export size
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "50000"))
+# Documents fetched per database round trip
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+
+def build_export_pipelines(user_id: str, device_id: str = None, start=None, end=None):
+    """
+    Returns the (readings, buckets) pipelines for an export. Both unwind the user's devices so
+    the cursor yields one reading or one compacted bucket per document, in device and
+    event_date order.
+    """
+    pipelines = []
+    for field in ("telemetryData", "telemetryBuckets"):
+        pipeline = [
+            {"$match": {"_id": user_id}},
+            {"$project": {"Devices.deviceId": 1, f"Devices.{field}": 1}},
+            {"$unwind": {"path": "$Devices", "includeArrayIndex": "deviceIndex"}},
+        ]
+        if device_id:
+            pipeline.append({"$match": {"Devices.deviceId": device_id}})
+        pipeline.append({"$unwind": f"$Devices.{field}"})
+        if field == "telemetryData":
+            date_range = {}
+            if start is not None:
+                date_range["$gte"] = start
+            if end is not None:
+                date_range["$lte"] = end
+            if date_range:
+                pipeline.append({"$match": {"Devices.telemetryData.event_date": date_range}})
+        else:
+            # Buckets overlapping the range; readings outside it are dropped after decoding
+            if start is not None:
+                pipeline.append({"$match": {"Devices.telemetryBuckets.end": {"$gte": start}}})
+            if end is not None:
+                pipeline.append({"$match": {"Devices.telemetryBuckets.start": {"$lte": end}}})
+        pipeline.append({"$project": {"_id": 0, "deviceIndex": 1, "deviceId": "$Devices.deviceId", "item": f"$Devices.{field}"}})
+        pipelines.append(pipeline)
+    return pipelines
+
+def iter_readings(cosmos_service: CosmosDBService, user_id: str, device_id: str = None, start=None, end=None):
+    """
+    Yields (deviceId, telemetry) for every reading in the range, in device and event_date order.
+    Readings are streamed from two database cursors and merged, so only one compacted bucket
+    is decoded at a time.
+    """
+    readings_pipeline, buckets_pipeline = build_export_pipelines(user_id, device_id, start, end)
+
+    def plain():
+        for document in cosmos_service.aggregate_cursor(readings_pipeline, batch_size=EXPORT_BATCH_SIZE):
+            yield document["deviceIndex"], document["deviceId"], document["item"]
+
+    def compacted():
+        for document in cosmos_service.aggregate_cursor(buckets_pipeline, batch_size=EXPORT_BATCH_SIZE):
+            readings = decode_bucket(document["item"], document["deviceId"])
+            if start is not None or end is not None:
+                readings = time_range(readings, start, end)
+            for telemetry in readings:
+                yield document["deviceIndex"], document["deviceId"], telemetry
+
+    for _, reading_device_id, telemetry in merge(plain(), compacted(), key=lambda row: (row[0], event_time(row[2]))):
+        yield reading_device_id, telemetry
+
+def iter_column_chunks(readings, stats: dict = None):
+    """
+    Flattens readings into EXPORT_COLUMNS and yields them as dicts of column lists of at most
+    EXPORT_CHUNK_ROWS rows.
+    """
+    columns = {name: [] for name in EXPORT_COLUMNS}
+    rows = 0
+    for device_id, telemetry in readings:
+        event_date = parse_datetime(telemetry["event_date"])
+        for value in telemetry.get("values") or []:
+            columns["deviceId"].append(device_id)
+            columns["eventId"].append(telemetry.get("eventId"))
+            columns["eventDate"].append(event_date)
+            columns["valueType"].append(value.get("valueType"))
+            number = value.get("value")
+            columns["value"].append(float(number) if isinstance(number, (int, float)) and not isinstance(number, bool) else None)
+            rows += 1
+            if rows % EXPORT_CHUNK_ROWS == 0:
+                yield columns
+                columns = {name: [] for name in EXPORT_COLUMNS}
+    if stats is not None:
+        stats["rows"] = rows
+    if columns["deviceId"] or not rows:
+        yield columns
+
+def write_csv(chunks):
+    """
+    Yields the CSV encoding of the column chunks, one block of bytes per chunk.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for columns in chunks:
+        columns["eventDate"] = [event_date.isoformat() for event_date in columns["eventDate"]]
+        writer.writerows(zip(*(columns[name] for name in EXPORT_COLUMNS)))
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+class _ChunkSink:
+    """
+    Write-only file object that collects what pyarrow writes so it can be yielded as chunks.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def write_arrow(chunks, export_format: str):
+    """
+    Yields a Parquet file (one row group per chunk) or an Arrow IPC stream (one record batch
+    per chunk) built from the column chunks.
+    """
+    schema = pyarrow.schema([
+        ("deviceId", pyarrow.string()),
+        ("eventId", pyarrow.string()),
+        ("eventDate", pyarrow.timestamp("ms", tz="UTC")),
+        ("valueType", pyarrow.string()),
+        ("value", pyarrow.float64()),
+    ])
+    sink = _ChunkSink()
+    output = pyarrow.PythonFile(sink, mode="w")
+    if export_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(output, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(output, schema)
+    for columns in chunks:
+        writer.write_batch(pyarrow.RecordBatch.from_pydict(columns, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+def export_chunks(cosmos_service: CosmosDBService, user_id: str, export_format: str, device_id: str = None,
+                  start=None, end=None, stats: dict = None):
+    """
+    Yields the export file as byte chunks. stats["rows"] is set once the export is complete.
+    """
+    chunks = iter_column_chunks(iter_readings(cosmos_service, user_id, device_id, start, end), stats)
+    if export_format == "csv":
+        return write_csv(chunks)
+    return write_arrow(chunks, export_format)
+
+def export_telemetry(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Exports the user's telemetry (optionally one device and a date range) to Blob Storage as
+    CSV, Parquet or Arrow and returns a download URL. The file is uploaded while it is built.
+    """
+    logging.info("Processing export_telemetry request.")
+
+    # Authenticate the user
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # If authentication fails, return the error response
+        return user_id
+
+    export_format = req.params.get("format", "csv").lower()
+    if export_format not in EXPORT_FORMATS:
+        return func.HttpResponse(
+            json_utils.dumps({"message": f"format must be one of: {', '.join(EXPORT_FORMATS)}"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    if export_format != "csv" and pyarrow is None:
+        return func.HttpResponse(
+            json_utils.dumps({"message": f"The {export_format} format is not available on this server"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    device_id = req.params.get("deviceId")
+    try:
+        start_date = parse_datetime(req.params["startDate"]) if req.params.get("startDate") else None
+        end_date = parse_datetime(req.params["endDate"]) if req.params.get("endDate") else None
+    except ValueError as e:
+        return func.HttpResponse(
+            json_utils.dumps({"message": f"Invalid date: {str(e)}"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    cosmos_service = CosmosDBService()
+    query = {"_id": user_id, "Devices.deviceId": device_id} if device_id else {"_id": user_id}
+    if not cosmos_service.find_document(query, projection={"_id": 1}):
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Device not found" if device_id else "User not found"}),
+            status_code=404,
+            mimetype="application/json"
+        )
+
+    content_type, extension = EXPORT_FORMATS[export_format]
+    blob_name = f"exports/{user_id}/{uuid.uuid4()}.{extension}"
+    stats = {}
+    try:
+        from azure_services.blob_storage_service import BlobStorageService
+        chunks = export_chunks(cosmos_service, user_id, export_format, device_id, start_date, end_date, stats)
+        url = BlobStorageService().upload_stream(chunks, blob_name, content_type)
+    except Exception as e:
+        logging.exception(f"Failed to export telemetry for user_id={user_id}: {str(e)}")
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Failed to export telemetry"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+
+    logging.info(f"Exported {stats.get('rows', 0)} telemetry rows to {blob_name}.")
+    return func.HttpResponse(
+        json_utils.dumps({"message": "Export created", "format": export_format, "rows": stats.get("rows", 0), "url": url}),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def main():
+    """
+    Command line export to a local file, e.g.
+        python -m functions.export_functions --user-id <id> --format parquet --output telemetry.parquet
+    """
+    parser = argparse.ArgumentParser(description="Export telemetry as CSV, Parquet or Arrow.")
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--device-id")
+    parser.add_argument("--start", type=parse_datetime, help="ISO 8601 start date")
+    parser.add_argument("--end", type=parse_datetime, help="ISO 8601 end date")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--output", help="Output file (default: standard output)")
+    args = parser.parse_args()
+    if args.format != "csv" and pyarrow is None:
+        parser.error(f"the {args.format} format requires pyarrow")
+
+    stats = {}
+    chunks = export_chunks(CosmosDBService(), args.user_id, args.format, args.device_id, args.start, args.end, stats)
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+    print(f"Exported {stats.get('rows', 0)} rows.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
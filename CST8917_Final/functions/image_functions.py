@@ -1,5 +1,5 @@
 import logging
-import json
+from config import json_utils
 from azure_services.cognitive_serivce import analyze_image_for_fire
 from azure_services.eventtopic_service import forward_event
 
@@ -7,7 +7,7 @@ def main(event: str):
     logging.info("Blob Storage event received.")
     
     # Parse the Event Grid event
-    event_data = json.loads(event)
+    event_data = json_utils.loads(event)
     blob_url = event_data["data"]["url"]  # Get the blob URL from the event
     logging.info(f"Blob URL: {blob_url}")
     
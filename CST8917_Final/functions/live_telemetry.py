@@ -0,0 +1,362 @@
+"""
+Live telemetry for dashboards, as Server-Sent Events.
+
+New readings are collected once per worker in a TelemetryHub and handed to every subscriber of
+the reading's user. The hub is fed by a change stream on the users collection, which sees the
+readings stored by every worker, or, where change streams are not available, by post_telemetry
+publishing the readings it stores itself (subscribers then only receive the readings of their
+own worker).
+
+Function responses are not streamed, so GET /telemetry/live waits until readings arrive (or
+LIVE_TELEMETRY_WAIT_SECONDS pass) and returns them as an event stream. EventSource reconnects
+by itself and sends the id of the last event it received, so the next request continues where
+the previous one ended, without reading the database. Event ids are made of the reading's time
+and eventId, so a reconnect served by another worker continues from the same reading, or gets a
+reset event when that worker only started receiving readings after it. Waiting requests are
+coroutines, so they do not hold worker threads.
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+import azure.functions as func
+from config import json_utils
+from config.jwt_utils import authenticate_user
+from config.time_utils import utc_now
+from config.http_utils import service_unavailable_response
+from config.metrics_utils import increment, register_gauge
+from azure_services.cosmosdb_service import CosmosDBService
+from functions.device_state import STATE_FIELD, newest_reading
+
+# auto uses a change stream when the database supports one; change_stream or broadcast force a source
+LIVE_TELEMETRY_SOURCE = os.environ.get("LIVE_TELEMETRY_SOURCE", "auto").lower()
+# Longest time a subscription request waits for new readings
+LIVE_TELEMETRY_WAIT_SECONDS = float(os.environ.get("LIVE_TELEMETRY_WAIT_SECONDS", "25"))
+# Recent readings kept for all subscribers; a subscriber further behind is told to reload
+LIVE_TELEMETRY_BUFFER = int(os.environ.get("LIVE_TELEMETRY_BUFFER", "2000"))
+# Readings returned per response; the rest follow on the next request
+LIVE_TELEMETRY_MAX_EVENTS = int(os.environ.get("LIVE_TELEMETRY_MAX_EVENTS", "200"))
+# Requests waiting at the same time; each one is woken up for every new reading
+LIVE_TELEMETRY_MAX_SUBSCRIBERS = int(os.environ.get("LIVE_TELEMETRY_MAX_SUBSCRIBERS", "500"))
+# Delay before EventSource reconnects, sent as the stream's retry field
+LIVE_TELEMETRY_RETRY_MS = int(os.environ.get("LIVE_TELEMETRY_RETRY_MS", "500"))
+# Devices whose newest reading time is remembered to recognise new readings in change events
+MAX_TRACKED_DEVICES = 100000
+
+SOURCE_CHANGE_STREAM = "change_stream"
+SOURCE_BROADCAST = "broadcast"
+
+
+def reading_time(reading: dict) -> int:
+    return int(reading["event_date"].timestamp() * 1000)
+
+
+def reading_event_id(reading: dict) -> str:
+    """
+    Event id of a reading, the same on every worker: its time in epoch ms and its eventId.
+    """
+    return f"{reading_time(reading)}-{reading.get('eventId') or ''}"
+
+
+class TelemetryHub:
+    """
+    Recent readings of all users, in one bounded ring shared by the subscribers of the worker.
+    A reading is stored once however many subscribers receive it, and a subscriber only keeps
+    its position (the event id of the last reading it received), so slow subscribers cannot
+    make the worker buffer more. A subscriber whose next reading already left the ring gets a
+    reset event instead.
+    """
+
+    def __init__(self, size: int = LIVE_TELEMETRY_BUFFER):
+        self.readings = deque(maxlen=size)  # (sequence, user_id, reading)
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.waiters = set()  # (loop, asyncio.Event) of the waiting requests
+        self.evicted = {}  # user_id -> time (epoch ms) of the user's newest reading dropped from the ring
+        self.newest = {}  # device_id -> event_date of the newest reading published from a change
+        self.started_at = utc_now()
+        self.fed_since = None  # Time (epoch ms) the hub started receiving the readings stored by requests
+        self.subscribers = 0
+
+    def publish(self, user_id: str, reading: dict, source: str):
+        with self.lock:
+            if len(self.readings) == self.readings.maxlen:
+                _, owner, evicted = self.readings[0]
+                self.evicted[owner] = max(self.evicted.get(owner, 0), reading_time(evicted))
+            self.sequence += 1
+            self.readings.append((self.sequence, user_id, reading))
+            waiters = list(self.waiters)
+        # Readings are published from request and change stream threads, waiters wait on event loops
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # The waiter's loop was closed
+                pass
+        increment("live_readings_published_total", source=source)
+
+    def publish_devices(self, user_id: str, devices: list):
+        """
+        Publishes the newest reading of every device whose last state changed since it was
+        last seen. Readings older than the hub are not published.
+        """
+        for device in devices:
+            reading = newest_reading(device)
+            if reading is None:
+                continue
+            device_id = reading["deviceId"]
+            if reading["event_date"] <= self.newest.get(device_id, self.started_at):
+                continue
+            if device_id not in self.newest and len(self.newest) >= MAX_TRACKED_DEVICES:
+                del self.newest[next(iter(self.newest))]
+            self.newest[device_id] = reading["event_date"]
+            self.publish(user_id, reading, SOURCE_CHANGE_STREAM)
+
+    def start_feed(self):
+        """
+        Records that the hub receives the readings stored from now on. Readings stored before
+        were never in the ring, so a subscriber continuing from an older reading is reset.
+        """
+        with self.lock:
+            if self.fed_since is None:
+                self.fed_since = int(utc_now().timestamp() * 1000)
+
+    def subscribe(self) -> bool:
+        """
+        Takes a subscriber slot, or returns False when all are in use.
+        """
+        with self.lock:
+            if self.subscribers >= LIVE_TELEMETRY_MAX_SUBSCRIBERS:
+                return False
+            self.subscribers += 1
+        return True
+
+    def unsubscribe(self):
+        with self.lock:
+            self.subscribers -= 1
+
+    def _position(self, last_event_id: str):
+        """
+        Returns (sequence, time, valid) for a Last-Event-ID. The sequence is that of the reading
+        in this worker's ring, or None when the ring does not hold it (it was published before
+        this worker started or left the ring); readings newer than its time then follow it.
+        Must be called with the lock held.
+        """
+        if not last_event_id:
+            return self.sequence, None, True
+        time_ms, _, event_id = last_event_id.partition("-")
+        if not time_ms.isdigit():
+            return self.sequence, None, False
+        if event_id:
+            for sequence, _, reading in reversed(self.readings):
+                if reading.get("eventId") == event_id:
+                    return sequence, int(time_ms), True
+        return None, int(time_ms), True
+
+    def _collect(self, user_id: str, after: int, after_time: int, device_id: str, limit: int):
+        """
+        Returns the user's readings after the position and the id to continue from.
+        Must be called with the lock held.
+        """
+        matched = []
+        for sequence, owner, reading in self.readings:
+            if after is not None and sequence <= after or after is None and reading_time(reading) <= after_time:
+                continue
+            if owner != user_id or device_id and reading.get("deviceId") != device_id:
+                continue
+            matched.append(reading)
+            if len(matched) >= limit:
+                return matched, reading_event_id(reading)
+        if matched:
+            return matched, reading_event_id(matched[-1])
+        # Nothing for the user, so the next request starts after the newest reading of any user
+        return matched, reading_event_id(self.readings[-1][2]) if self.readings else None
+
+    async def read(self, user_id: str, last_event_id: str = None, timeout: float = 0, device_id: str = None,
+                   limit: int = LIVE_TELEMETRY_MAX_EVENTS):
+        """
+        Waits up to timeout seconds for readings of the user after the given event id (from
+        now on if None). Returns (readings, reset, position): up to limit readings, whether
+        readings of the user were dropped from the ring or the id was invalid, and the event id
+        to continue from (None to keep the client's).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        waiter = (loop, asyncio.Event())
+        with self.lock:
+            after, after_time, valid = self._position(last_event_id)
+            # Readings after a position outside the ring may have been dropped from it, or have
+            # been stored before the hub was fed (e.g. the client was served by another worker)
+            reset = not valid or after is None and after_time is not None and (
+                self.evicted.get(user_id, 0) > after_time or self.fed_since is None or after_time < self.fed_since)
+        try:
+            while True:
+                waiter[1].clear()
+                with self.lock:
+                    # Registered before collecting, so a reading published meanwhile wakes the waiter
+                    self.waiters.add(waiter)
+                    readings, position = self._collect(user_id, after, after_time, device_id, limit)
+                    if not readings:
+                        # The next scan only needs the readings published from now on
+                        after = self.sequence
+                remaining = deadline - loop.time()
+                if readings or reset or remaining <= 0:
+                    return readings, reset, position or last_event_id
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+
+
+# Shared hub for the worker process
+hub = TelemetryHub()
+register_gauge("live_subscribers", lambda: {(): hub.subscribers})
+
+_source = None
+_source_lock = threading.Lock()
+
+
+def open_change_stream(resume_after=None):
+    """
+    Watches the users collection. Only the device ids and last states of the changed document
+    are looked up, so change events stay small however much telemetry a user has.
+    """
+    cosmos_service = CosmosDBService()
+    collection = cosmos_service.db[cosmos_service.default_collection_name]
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+        {"$project": {"documentKey": 1, "fullDocument.Devices.deviceId": 1, f"fullDocument.Devices.{STATE_FIELD}": 1}},
+    ]
+    return collection.watch(pipeline, full_document="updateLookup", resume_after=resume_after)
+
+
+def _watch(stream):
+    """
+    Publishes the readings seen by the change stream, reopening it after the last change seen
+    when it fails.
+    """
+    while True:
+        try:
+            with stream:
+                for change in stream:
+                    document = change.get("fullDocument")
+                    if document:
+                        hub.publish_devices(change["documentKey"]["_id"], document.get("Devices") or [])
+        except Exception as e:
+            logging.warning(f"[live_telemetry] Change stream interrupted: {str(e)}")
+        resume_token = stream.resume_token
+        while True:
+            time.sleep(1)
+            try:
+                stream = open_change_stream(resume_token)
+                break
+            except Exception as e:
+                logging.warning(f"[live_telemetry] Could not reopen the change stream: {str(e)}")
+
+
+def ensure_source() -> str:
+    """
+    Starts feeding the hub on the first subscription and returns the source in use.
+    """
+    global _source
+    if _source is None:
+        with _source_lock:
+            if _source is None:
+                _source = _start_source()
+                # Once the stream is open or post_telemetry broadcasts, every new reading reaches the hub
+                hub.start_feed()
+    return _source
+
+
+def _start_source() -> str:
+    if LIVE_TELEMETRY_SOURCE == SOURCE_BROADCAST:
+        return SOURCE_BROADCAST
+    try:
+        stream = open_change_stream()
+    except Exception as e:
+        # Change streams need a replica set (or Cosmos DB with change streams enabled)
+        log = logging.error if LIVE_TELEMETRY_SOURCE == SOURCE_CHANGE_STREAM else logging.info
+        log(f"[live_telemetry] Change streams unavailable, using in-process broadcast: {str(e)}")
+        return SOURCE_BROADCAST
+    threading.Thread(target=_watch, args=(stream,), name="live-telemetry", daemon=True).start()
+    logging.info("[live_telemetry] Following the users collection with a change stream.")
+    return SOURCE_CHANGE_STREAM
+
+
+def publish_stored_reading(user_id: str, device_id: str, telemetry: dict):
+    """
+    Called by post_telemetry once a reading is stored. Only used when the hub has subscribers
+    and no change stream, which would report the reading itself.
+    """
+    if _source != SOURCE_BROADCAST:
+        return
+    reading = {"deviceId": device_id, "eventId": telemetry["eventId"], "event_date": telemetry["event_date"],
+               "values": telemetry["values"]}
+    if telemetry.get("image"):
+        reading["image"] = telemetry["image"]
+    hub.publish(user_id, reading, SOURCE_BROADCAST)
+
+
+def format_events(readings: list, reset: bool, position: str) -> bytes:
+    """
+    Formats readings as an event stream. The stream ends with the id of the position, so the
+    Last-Event-ID of the next request skips the readings of other users.
+    """
+    parts = [f"retry: {LIVE_TELEMETRY_RETRY_MS}\n\n".encode()]
+    if reset:
+        parts.append(b'event: reset\ndata: {"message":"Readings were missed, reload the telemetry"}\n\n')
+    event_id = None
+    for reading in readings:
+        event_id = reading_event_id(reading)
+        parts.append(f"id: {event_id}\nevent: telemetry\ndata: ".encode() + json_utils.dumps(reading) + b"\n\n")
+    if position and position != event_id:
+        parts.append(f"id: {position}\n\n".encode())
+    return b"".join(parts)
+
+
+async def stream_telemetry(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("Processing stream_telemetry request.")
+
+    # Authenticate the user
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
+        return user_id
+
+    device_id = req.params.get("deviceId")
+    last_event_id = req.headers.get("Last-Event-ID") or req.params.get("lastEventId")
+    try:
+        wait = float(req.params.get("wait", LIVE_TELEMETRY_WAIT_SECONDS))
+    except ValueError:
+        wait = math.nan
+    if not math.isfinite(wait):
+        return func.HttpResponse(
+            json_utils.dumps({"message": "wait must be a number of seconds"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    wait = min(max(wait, 0.0), LIVE_TELEMETRY_WAIT_SECONDS)
+
+    if not hub.subscribe():
+        increment("live_subscribers_rejected_total")
+        return service_unavailable_response("Too many live subscribers, please retry")
+    try:
+        if _source is None:
+            # Opening the change stream is a database round trip, kept off the event loop
+            await asyncio.to_thread(ensure_source)
+        readings, reset, position = await hub.read(user_id, last_event_id, wait, device_id)
+    finally:
+        hub.unsubscribe()
+
+    if reset:
+        increment("live_resets_total")
+    return func.HttpResponse(
+        format_events(readings, reset, position),
+        status_code=200,
+        headers={"Cache-Control": "no-cache"},
+        mimetype="text/event-stream"
+    )
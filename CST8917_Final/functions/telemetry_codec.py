@@ -0,0 +1,319 @@
+"""
+Compact storage for telemetry history.
+
+Recent readings stay in a device's telemetryData array as written by post_telemetry. Older
+readings are moved into telemetryBuckets, each holding up to TELEMETRY_BUCKET_SIZE readings
+encoded column by column:
+
+    header      format version (1 byte), number of readings (varint)
+    timestamps  first time in epoch ms, first delta, then delta-of-deltas (zigzag varints)
+    event ids   16 raw bytes per reading
+    counts      number of values per reading (varint)
+    type codes  index into the bucket's valueTypes list << 1 | 1 if the value was an int (varint)
+    values      per value type, either the delta from the previous value scaled to integers
+                (zigzag varint) when every value of the type in the bucket has at most
+                MAX_DECIMAL_PLACES decimals, or float64 bits XORed with the previous value;
+                0 if unchanged, otherwise (xor >> trailing zeros) << 6 | trailing zeros (varint)
+
+The decimal places used per type are stored in the bucket's valueScales list (None for XOR).
+Bucket documents also store start, end and count so range queries only decode the buckets
+they need. read_telemetry merges both parts, so handlers never see the encoding.
+"""
+import os
+import math
+import uuid
+import struct
+import datetime
+from heapq import merge
+from bisect import bisect_left, bisect_right
+from config.time_utils import event_time, parse_datetime, time_range
+
+FORMAT_VERSION = 1
+# Readings per encoded bucket
+TELEMETRY_BUCKET_SIZE = int(os.environ.get("TELEMETRY_BUCKET_SIZE", "500"))
+# Newest readings of each device that always stay uncompressed
+TELEMETRY_HOT_READINGS = int(os.environ.get("TELEMETRY_HOT_READINGS", "200"))
+
+READING_FIELDS = {"deviceId", "eventId", "event_date", "values"}
+VALUE_FIELDS = {"valueType", "value"}
+MAX_EXACT_INT = 2 ** 53
+MAX_DECIMAL_PLACES = 6
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MILLISECOND = datetime.timedelta(milliseconds=1)
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+def _write_varints(out: bytearray, values):
+    for value in values:
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+def _read_varints(data: bytes, pos: int, count: int):
+    """
+    Reads count varints starting at pos. Returns (values, next position).
+    """
+    values = []
+    append = values.append
+    for _ in range(count):
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values, pos
+
+def _decimal_places(numbers: list):
+    """
+    Returns the fewest decimal places (up to MAX_DECIMAL_PLACES) at which every number
+    round-trips exactly through a scaled integer, or None if there is no such scale.
+    """
+    if any(number == 0 and math.copysign(1.0, number) < 0 for number in numbers):
+        return None  # -0.0 would come back as 0.0
+    for places in range(MAX_DECIMAL_PLACES + 1):
+        factor = 10 ** places
+        try:
+            if all(round(number * factor) / factor == number for number in numbers):
+                return places
+        except (OverflowError, ValueError):
+            return None
+    return None
+
+def is_compactable(telemetry: dict, device_id: str) -> bool:
+    """
+    Returns True if the reading can be encoded without losing anything. Readings with extra
+    fields (such as an image URL), non-numeric values or string dates stay uncompressed.
+    """
+    if telemetry.keys() != READING_FIELDS or telemetry["deviceId"] != device_id:
+        return False
+    event_date = telemetry["event_date"]
+    if not isinstance(event_date, datetime.datetime) or event_date.tzinfo is None or event_date.microsecond % 1000:
+        return False
+    try:
+        if str(uuid.UUID(telemetry["eventId"])) != telemetry["eventId"]:
+            return False
+    except (TypeError, ValueError, AttributeError):
+        return False
+    values = telemetry["values"]
+    if not isinstance(values, list):
+        return False
+    for value in values:
+        if not isinstance(value, dict) or value.keys() != VALUE_FIELDS or not isinstance(value["valueType"], str):
+            return False
+        number = value["value"]
+        if isinstance(number, bool) or not isinstance(number, (int, float)):
+            return False
+        if isinstance(number, int) and abs(number) > MAX_EXACT_INT:
+            return False
+    return True
+
+def encode_bucket(readings: list) -> dict:
+    """
+    Encodes readings (in event_date order, all accepted by is_compactable) into a bucket document.
+    """
+    value_types = []
+    type_ids = {}
+    codes = []
+    numbers = []
+    for telemetry in readings:
+        for value in telemetry["values"]:
+            type_id = type_ids.get(value["valueType"])
+            if type_id is None:
+                type_id = type_ids[value["valueType"]] = len(value_types)
+                value_types.append(value["valueType"])
+            codes.append(type_id << 1 | isinstance(value["value"], int))
+            numbers.append(value["value"])
+
+    scales = [_decimal_places([number for code, number in zip(codes, numbers) if code >> 1 == type_id])
+              for type_id in range(len(value_types))]
+
+    times = [(telemetry["event_date"] - EPOCH) // MILLISECOND for telemetry in readings]
+    deltas = [b - a for a, b in zip(times, times[1:])]
+    time_column = [times[0]] + deltas[:1] + [b - a for a, b in zip(deltas, deltas[1:])]
+
+    # Convert all values to their float64 bit patterns in one pass
+    count = len(numbers)
+    bits = struct.unpack(f"<{count}Q", struct.pack(f"<{count}d", *numbers))
+    previous = [0] * len(value_types)
+    packed = []
+    for code, number, value_bits in zip(codes, numbers, bits):
+        type_id = code >> 1
+        if scales[type_id] is not None:
+            scaled = round(number * 10 ** scales[type_id])
+            packed.append(_zigzag(scaled - previous[type_id]))
+            previous[type_id] = scaled
+            continue
+        xor = value_bits ^ previous[type_id]
+        previous[type_id] = value_bits
+        if xor:
+            trailing = (xor & -xor).bit_length() - 1
+            packed.append((xor >> trailing) << 6 | trailing)
+        else:
+            packed.append(0)
+
+    data = bytearray([FORMAT_VERSION])
+    _write_varints(data, [len(readings)])
+    _write_varints(data, map(_zigzag, time_column))
+    data += b"".join(uuid.UUID(telemetry["eventId"]).bytes for telemetry in readings)
+    _write_varints(data, [len(telemetry["values"]) for telemetry in readings])
+    _write_varints(data, codes)
+    _write_varints(data, packed)
+    return {
+        "start": readings[0]["event_date"],
+        "end": readings[-1]["event_date"],
+        "count": len(readings),
+        "valueTypes": value_types,
+        "valueScales": scales,
+        "data": bytes(data),
+    }
+
+def decode_bucket(bucket: dict, device_id: str) -> list:
+    """
+    Decodes a bucket document back into telemetry readings.
+    """
+    data = bucket["data"]
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported telemetry bucket format: {data[0]}")
+    (reading_count,), pos = _read_varints(data, 1, 1)
+    if not reading_count:
+        return []
+
+    time_column, pos = _read_varints(data, pos, reading_count)
+    times = [_unzigzag(time_column[0])]
+    delta = 0
+    for index, value in enumerate(time_column[1:]):
+        delta = _unzigzag(value) if index == 0 else delta + _unzigzag(value)
+        times.append(times[-1] + delta)
+
+    id_bytes = data[pos:pos + 16 * reading_count]
+    pos += 16 * reading_count
+    counts, pos = _read_varints(data, pos, reading_count)
+    value_count = sum(counts)
+    codes, pos = _read_varints(data, pos, value_count)
+    packed, pos = _read_varints(data, pos, value_count)
+
+    scales = bucket["valueScales"]
+    previous = [0] * len(scales)
+    bits = []
+    scaled = {}
+    for index, (code, value) in enumerate(zip(codes, packed)):
+        type_id = code >> 1
+        if scales[type_id] is not None:
+            previous[type_id] += _unzigzag(value)
+            scaled[index] = previous[type_id] / 10 ** scales[type_id]
+            bits.append(0)
+            continue
+        if value:
+            previous[type_id] ^= (value >> 6) << (value & 63)
+        bits.append(previous[type_id])
+    # Convert all XOR encoded bit patterns back to floats in one pass
+    numbers = list(struct.unpack(f"<{value_count}d", struct.pack(f"<{value_count}Q", *bits)))
+    for index, number in scaled.items():
+        numbers[index] = number
+
+    value_types = bucket["valueTypes"]
+    readings = []
+    position = 0
+    for index, count in enumerate(counts):
+        values = []
+        for code, number in zip(codes[position:position + count], numbers[position:position + count]):
+            values.append({"valueType": value_types[code >> 1], "value": int(number) if code & 1 else number})
+        position += count
+        readings.append({
+            "deviceId": device_id,
+            "eventId": str(uuid.UUID(bytes=bytes(id_bytes[16 * index:16 * index + 16]))),
+            "event_date": EPOCH + times[index] * MILLISECOND,
+            "values": values,
+        })
+    return readings
+
+def read_telemetry(device: dict, start: datetime.datetime = None, end: datetime.datetime = None) -> list:
+    """
+    Returns the device's readings within [start, end] in event_date order, decoding only the
+    buckets that overlap the range.
+    """
+    raw = device.get("telemetryData") or []
+    buckets = device.get("telemetryBuckets") or []
+    if start is not None or end is not None:
+        raw = time_range(raw, start, end)
+    if not buckets:
+        return raw
+    low = bisect_left(buckets, start, key=lambda bucket: bucket["end"]) if start is not None else 0
+    high = bisect_right(buckets, end, key=lambda bucket: bucket["start"]) if end is not None else len(buckets)
+    decoded = []
+    for bucket in buckets[low:high]:
+        decoded.extend(decode_bucket(bucket, device.get("deviceId")))
+    if start is not None or end is not None:
+        decoded = time_range(decoded, start, end)
+    return list(merge(decoded, raw, key=event_time))
+
+def expand_device(device: dict, start: datetime.datetime = None, end: datetime.datetime = None) -> dict:
+    """
+    Returns the device as clients see it: telemetryData holds every reading (within the range)
+    and the encoded buckets are left out. The stored document is not modified.
+    """
+    if "telemetryBuckets" not in device and start is None and end is None:
+        return device
+    expanded = {key: value for key, value in device.items() if key != "telemetryBuckets"}
+    expanded["telemetryData"] = read_telemetry(device, start, end)
+    return expanded
+
+def telemetry_count(device: dict) -> int:
+    return len(device.get("telemetryData") or []) + sum(bucket["count"] for bucket in device.get("telemetryBuckets") or [])
+
+def last_reading_time(device: dict):
+    candidates = []
+    if device.get("telemetryData"):
+        candidates.append(device["telemetryData"][-1]["event_date"])
+    if device.get("telemetryBuckets"):
+        candidates.append(device["telemetryBuckets"][-1]["end"])
+    return max(candidates, key=parse_datetime) if candidates else None
+
+def compact_device(device: dict):
+    """
+    Moves the device's older compactable readings into full buckets.
+    Returns (remaining telemetryData, new buckets), or None if there is nothing to compact.
+    """
+    telemetry_data = device.get("telemetryData") or []
+    cold = telemetry_data[:max(len(telemetry_data) - TELEMETRY_HOT_READINGS, 0)]
+    eligible = [telemetry for telemetry in cold if is_compactable(telemetry, device.get("deviceId"))]
+    full = len(eligible) // TELEMETRY_BUCKET_SIZE * TELEMETRY_BUCKET_SIZE
+    if not full:
+        return None
+    moved = eligible[:full]
+    moved_ids = {id(telemetry) for telemetry in moved}
+    remaining = [telemetry for telemetry in telemetry_data if id(telemetry) not in moved_ids]
+    buckets = [encode_bucket(moved[i:i + TELEMETRY_BUCKET_SIZE]) for i in range(0, full, TELEMETRY_BUCKET_SIZE)]
+    return remaining, buckets
+
+def remove_compacted_reading(device: dict, event_id: str):
+    """
+    Removes a reading stored in the device's buckets.
+    Returns (index of the bucket holding it, the re-encoded bucket or None if no reading is
+    left in it, the removed reading), or None if no bucket holds the reading.
+    """
+    try:
+        id_bytes = uuid.UUID(event_id).bytes
+    except (TypeError, ValueError, AttributeError):
+        return None
+    buckets = device.get("telemetryBuckets") or []
+    for index, bucket in enumerate(buckets):
+        # Only buckets whose raw bytes contain the id are decoded
+        if id_bytes not in bucket["data"]:
+            continue
+        readings = decode_bucket(bucket, device.get("deviceId"))
+        removed = next((telemetry for telemetry in readings if telemetry["eventId"] == event_id), None)
+        if removed is None:
+            continue
+        remaining = [telemetry for telemetry in readings if telemetry is not removed]
+        return index, encode_bucket(remaining) if remaining else None, removed
+    return None
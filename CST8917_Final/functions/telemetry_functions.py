@@ -1,14 +1,23 @@
 import uuid
-import datetime
-import json
 import logging
 import azure.functions as func
+from config import json_utils
 from azure_services.cosmosdb_service import CosmosDBService
 from azure_services.iot_hub_service import IoTHubService
 from azure_services.blob_storage_service import BlobStorageService
 from azure_services.notification_service import NotificationService
+from functions.alert_engine import alert_engine, ALERT_RAISED, ALERT_RESOLVED
+from functions.telemetry_codec import read_telemetry, remove_compacted_reading
+from functions.device_state import STATE_FIELD, state_update, state_repair
+from functions.live_telemetry import publish_stored_reading
+from config.log_utils import log_event
 #from azure_services.communication_service import CommunicationService
-from config.jwt_utils import decode_token, authenticate_user, get_azure_config
+from config.jwt_utils import authenticate_user
+from config.config_utils import get_config
+from config.time_utils import utc_now, parse_datetime
+from config.http_utils import compressed_response, not_modified_for_version, versioned_headers
+from config.trace_utils import traced
+from config.fanout_utils import submit
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -38,7 +47,7 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
 
         # Parse values from JSON string to Python object
         if values:
-            values = json.loads(values)  # Convert JSON string to Python object
+            values = json_utils.loads(values)  # Convert JSON string to Python object
             if not isinstance(values, list):  # Ensure values is a list
                 values = [values]
     except Exception as e:
@@ -47,9 +56,9 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     
     # Validate required fields
     if not device_id or not values:
-        logging.error(f"Missing required fields: deviceId={device_id}, values={values}")
+        log_event(logging.ERROR, "Missing required fields", route="post_telemetry", deviceId=device_id, values=values)
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields or invalid data"}), 
+            json_utils.dumps({"message": "Missing required fields or invalid data"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -58,7 +67,7 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     telemetry_data = {
         "deviceId": device_id,
         "eventId": str(uuid.uuid4()),  # Generate a unique event ID
-        "event_date": datetime.datetime.now(datetime.timezone.utc).isoformat(),  # Current system date in ISO format with timezone
+        "event_date": utc_now(),  # Current UTC time, stored as a native date
         "values": values,  # List of key-value pairs
     }
     
@@ -77,7 +86,7 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as e:
         logging.exception(f"Error while querying CosmosDB for deviceId={device_id}: {str(e)}")
         return func.HttpResponse(
-            json.dumps({"message": "Error while querying database"}), 
+            json_utils.dumps({"message": "Error while querying database"}), 
             status_code=500, 
             mimetype="application/json"
         )
@@ -85,7 +94,7 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     if not user:
         logging.error(f"Device with deviceId={device_id} not found in any user's Devices list.")
         return func.HttpResponse(
-            json.dumps({"message": "Device not found in CosmosDB"}), 
+            json_utils.dumps({"message": "Device not found in CosmosDB"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -97,13 +106,19 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     if not device:
         logging.error(f"Device with deviceId={device_id} not found in user's Devices list.")
         return func.HttpResponse("Device not found in user's Devices list", status_code=404)
-    
+
+    # Once the device is known, the condition lookup and the image upload (with its vision
+    # analysis) are independent: the lookup runs on the shared pool while this thread uploads.
+    # Both finish before the reading is stored, so a failed request stores nothing. Alert states,
+    # notifications and the event only follow a stored reading, so they never describe a lost one.
+    conditions = submit(find_conditions, device_id, values)
+
     # If an image is provided, upload it to Azure Blob Storage
     if image:
         try:
             blob_service = BlobStorageService()
             file_extension = image.filename.split(".")[-1]  # Extract file extension
-            event_date = telemetry_data["event_date"]  # Use event_date for the filename
+            event_date = telemetry_data["event_date"].isoformat()  # Use event_date for the filename
             blob_filename = f"{event_date.replace(':', '').replace('-', '').replace('.', '')}_{device_id}.{file_extension}"
             blob_path = f"{user['_id']}/{blob_filename}"  # Use user_id for the directory
             image_url = blob_service.upload_image(image.read(), blob_path)  # Read image bytes and upload
@@ -112,9 +127,9 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
             logging.exception("Failed to upload image to Blob Storage.")
             return func.HttpResponse(f"Failed to upload image: {str(e)}", status_code=500)
     
-    # Check conditions for telemetry values
+    # Wait for the condition lookup
     try:
-        check_conditions(device_id, values)
+        checks = conditions.result()
     except Exception as e:
         logging.exception("Failed to check conditions for telemetry values.")
         return func.HttpResponse(f"Failed to check conditions: {str(e)}", status_code=500)
@@ -122,13 +137,16 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     # Update the telemetryData array for the device
     try:
         result = cosmos_service.update_document(
-            {"_id": user["_id"], "Devices.deviceId": device_id},
-            {"$push": {"Devices.$.telemetryData": telemetry_data}}
+            {"_id": user["_id"], "Devices": {"$elemMatch": {"deviceId": device_id}}},
+            # $sort keeps telemetryData in event_date order even when concurrent requests append out of order
+            {"$push": {"Devices.$.telemetryData": {"$each": [telemetry_data], "$sort": {"event_date": 1}}},
+             "$max": state_update(telemetry_data),  # Last state, updated in the same write
+             "$inc": {"version": 1}}  # version backs the GET ETags
         )
         if result.modified_count == 0:
             logging.error(f"Failed to update telemetry data for deviceId={device_id}.")
             return func.HttpResponse(
-                json.dumps({"message": "Failed to add telemetry data to the device"}), 
+                json_utils.dumps({"message": "Failed to add telemetry data to the device"}), 
                 status_code=400, 
                 mimetype="application/json"
             )
@@ -136,6 +154,15 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
         logging.exception(f"Error while updating telemetry data for deviceId={device_id}: {str(e)}")
         return func.HttpResponse(f"Error while updating telemetry data: {str(e)}", status_code=500)
     
+    # Alerts for the stored reading; the reading is stored, so failures are only logged
+    try:
+        apply_conditions(device_id, checks, user["_id"])
+    except Exception as e:
+        logging.exception(f"Failed to evaluate conditions for deviceId={device_id}: {str(e)}")
+    
+    # Live subscribers of this worker, when no change stream reports the reading
+    publish_stored_reading(user["_id"], device_id, telemetry_data)
+    
     # IoT Hub: Send telemetry data to the event topic
     try:
         iot_service = IoTHubService()
@@ -146,7 +173,7 @@ def post_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     
     logging.info(f"Telemetry data successfully added for deviceId={device_id}.")
     return func.HttpResponse(
-        json.dumps({"message": "Telemetry data added successfully"}), 
+        json_utils.dumps({"message": "Telemetry data added successfully"}), 
         status_code=201, 
         mimetype="application/json"
     )
@@ -167,12 +194,33 @@ def get_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     start_date = req.params.get("startDate")  # Start date for the date range
     end_date = req.params.get("endDate")      # End date for the date range
 
+    # Parse the dates once instead of for every telemetry entry
+    try:
+        event_date = parse_datetime(event_date) if event_date else None
+        start_date = parse_datetime(start_date) if start_date else None
+        end_date = parse_datetime(end_date) if end_date else None
+    except ValueError as e:
+        return func.HttpResponse(
+            json_utils.dumps({"message": f"Invalid date: {str(e)}"}), 
+            status_code=400, 
+            mimetype="application/json"
+        )
+    if event_date:
+        start_date = max(start_date, event_date) if start_date else event_date
+        end_date = min(end_date, event_date) if end_date else event_date
+
     # Retrieve the user's devices
     cosmos_service = CosmosDBService()
+    
+    # Unchanged polls are answered from the version field alone
+    not_modified = not_modified_for_version(req, lambda: cosmos_service.find_version({"_id": user_id}))
+    if not_modified:
+        return not_modified
+    
     user = cosmos_service.find_document({"_id": user_id})
     if not user:
         return func.HttpResponse(
-            json.dumps({"message": "User not found"}), 
+            json_utils.dumps({"message": "User not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
@@ -185,13 +233,14 @@ def get_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     device = next((d for d in user_devices if d["deviceId"] == device_id), None)
     if not device:
         return func.HttpResponse(
-            json.dumps({"message": "Device not found"}), 
+            json_utils.dumps({"message": "Device not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
 
-    # Filter telemetry data
-    telemetry_data = device.get("telemetryData", [])
+    # Filter telemetry data; only the compacted buckets overlapping the range are decoded and
+    # the range is found by binary search since readings are kept in event_date order
+    telemetry_data = read_telemetry(device, start_date, end_date)
     filtered_data = []
 
     for telemetry in telemetry_data:
@@ -201,25 +250,11 @@ def get_telemetry(req: func.HttpRequest) -> func.HttpResponse:
         if sensor_type:
             if not any(value.get("valueType") == sensor_type for value in telemetry.get("values", [])):
                 continue
-        if event_date and telemetry.get("event_date") != event_date:
-            continue
-        if start_date or end_date:
-            event_date = telemetry.get("event_date")
-            if event_date:
-                event_datetime = datetime.datetime.fromisoformat(event_date)
-                if start_date and event_datetime < datetime.datetime.fromisoformat(start_date):
-                    continue
-                if end_date and event_datetime > datetime.datetime.fromisoformat(end_date):
-                    continue
         
         filtered_data.append(telemetry)
 
     # Return the filtered telemetry data
-    return func.HttpResponse(
-        json.dumps(filtered_data), 
-        status_code=200, 
-        mimetype="application/json"
-    )
+    return compressed_response(req, json_utils.dumps(filtered_data), headers=versioned_headers(req, user.get("version", 0)))
 
 def delete_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing delete_telemetry request.")
@@ -239,7 +274,7 @@ def delete_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     event_id = req_body.get("eventId")
     if not event_id:
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -260,42 +295,102 @@ def delete_telemetry(req: func.HttpRequest) -> func.HttpResponse:
         for telemetry in telemetry_data:
             if telemetry.get("eventId") == event_id:
                 # Telemetri verisini sil
-                result = cosmos_service.update_document(
-                    {"_id": user["_id"], "Devices.deviceId": device["deviceId"]},
-                    {"$pull": {"Devices.$.telemetryData": {"eventId": event_id}}}
-                )
+                result = cosmos_service.update_document(*state_repair_update(
+                    user["_id"], device, telemetry,
+                    {"$pull": {"Devices.$.telemetryData": {"eventId": event_id}}, "$inc": {"version": 1}}
+                ))
                 if result.modified_count > 0:
                     return func.HttpResponse(
-                        json.dumps({"message": "Telemetry data deleted successfully"}), 
+                        json_utils.dumps({"message": "Telemetry data deleted successfully"}), 
                         status_code=200, 
                         mimetype="application/json"
                     )
-                else:
-                    return func.HttpResponse(
-                        json.dumps({"message": "Failed to delete telemetry data"}), 
-                        status_code=400, 
-                        mimetype="application/json"
-                    )
+                return func.HttpResponse(
+                    json_utils.dumps({"message": "Telemetry data changed during the delete, please retry"}), 
+                    status_code=409, 
+                    mimetype="application/json"
+                )
+
+    # Older readings are stored in compacted buckets; the bucket holding the reading is re-encoded
+    for device in user_devices:
+        removal = remove_compacted_reading(device, event_id)
+        if removal is None:
+            continue
+        index, bucket, telemetry = removal
+        old_bucket = device["telemetryBuckets"][index]
+        if bucket is None:
+            update = {"$pull": {"Devices.$.telemetryBuckets": {"start": old_bucket["start"], "count": old_bucket["count"]}}}
+        else:
+            update = {"$set": {f"Devices.$.telemetryBuckets.{index}": bucket}}
+        update["$inc"] = {"version": 1}
+        query, update = state_repair_update(user["_id"], device, telemetry, update)
+        # Deletes re-encode the bucket and the compaction only appends buckets, so an unchanged
+        # start and count at the same position mean the bucket is still the one decoded
+        query["Devices"]["$elemMatch"].update({
+            f"telemetryBuckets.{index}.start": old_bucket["start"],
+            f"telemetryBuckets.{index}.count": old_bucket["count"],
+        })
+        result = cosmos_service.update_document(query, update)
+        if result.modified_count > 0:
+            return func.HttpResponse(
+                json_utils.dumps({"message": "Telemetry data deleted successfully"}), 
+                status_code=200, 
+                mimetype="application/json"
+            )
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Telemetry data changed during the delete, please retry"}), 
+            status_code=409, 
+            mimetype="application/json"
+        )
     
     return func.HttpResponse(
-        json.dumps({"message": "Telemetry data not found"}), 
+        json_utils.dumps({"message": "Telemetry data not found"}), 
         status_code=404, 
         mimetype="application/json"
     )
 
-def check_conditions(device_id: str, values: list):
+def state_repair_update(user_id: str, device: dict, telemetry: dict, update: dict):
+    """
+    Returns the (query, update) deleting a reading of the device with the given update, extended
+    to rebuild the last state entries that came from the reading. The query only requires those
+    entries to be unchanged, so concurrent readings of other valueTypes or devices do not
+    conflict with the delete.
+    """
+    guard, updates, unset = state_repair(device, telemetry, lambda: [
+        reading for reading in read_telemetry(device) if reading.get("eventId") != telemetry.get("eventId")
+    ])
+    device_query = {"deviceId": device["deviceId"], **{f"{STATE_FIELD}.{path}": value for path, value in guard.items()}}
+    if updates:
+        update.setdefault("$set", {}).update({f"Devices.$.{STATE_FIELD}.{path}": entry for path, entry in updates.items()})
+    if unset:
+        update["$unset"] = {f"Devices.$.{STATE_FIELD}.{path}": "" for path in unset}
+    return {"_id": user_id, "Devices": {"$elemMatch": device_query}}, update
+
+@traced("conditions.check")
+def check_conditions(device_id: str, values: list, user_id: str = None):
     """
     Check telemetry values against conditions in the Conditions collection.
+    Alerts are raised through the alert engine, so a notification is sent only when a
+    (device, condition) pair changes state rather than for every reading out of range.
+    """
+    apply_conditions(device_id, find_conditions(device_id, values), user_id)
+
+@traced("conditions.find")
+def find_conditions(device_id: str, values: list) -> list:
+    """
+    Returns the (condition, valueType, value) checks that apply to the telemetry values.
+    Only reads the Conditions collection, so it can run before the reading is stored.
     """
     logging.info(f"Starting condition check for deviceId={device_id}.")
     cosmos_service = CosmosDBService()
-    config = get_azure_config()
+    config = get_config()
     collection_name = config["CONDITION_COLLECTION_NAME"]  # Read the Conditions collection name
 
     logging.debug(f"Using collection: {collection_name}")
 
+    checks = []
     for value in values:
-        logging.debug(f"Processing value: {value}")
+        log_event(logging.DEBUG, "Processing value", route="check_conditions", value=value)
         value_type = value.get("valueType")
         value_data = value.get("value")
 
@@ -319,26 +414,43 @@ def check_conditions(device_id: str, values: list):
             logging.info(f"No conditions found for valueType={value_type}.")
             continue
 
-        for condition in conditions:
-            logging.debug(f"Evaluating condition: {condition}")
-            min_value = condition.get("minValue")
-            max_value = condition.get("maxValue")
-
-            # Compare the value with the condition's min and max values
-            if min_value is not None:
-                logging.debug(f"Checking if value {value_data} < minValue {min_value}.")
-                if value_data < min_value:
-                    logging.warning(
-                        f"Value {value_data} for {value_type} is below the minimum threshold ({min_value})."
-                    )
+        checks.extend((condition, value_type, value_data) for condition in conditions)
+    return checks
 
-            if max_value is not None:
-                logging.debug(f"Checking if value {value_data} > maxValue {max_value}.")
-                if value_data > max_value:
-                    logging.warning(
-                        f"Value {value_data} for {value_type} is above the maximum threshold ({max_value})."
-                    )
+def apply_conditions(device_id: str, checks: list, user_id: str = None):
+    """
+    Feeds the checks returned by find_conditions to the alert engine and notifies the user of
+    every state change. Called once the reading is stored, so a failed request changes no alert
+    state and sends no notification.
+    """
+    for condition, value_type, value_data in checks:
+        log_event(logging.DEBUG, "Evaluating condition", route="check_conditions", condition_id=condition.get("_id"))
+        transition = alert_engine.evaluate(device_id, condition, value_data)
+        if transition:
+            send_alert(transition, device_id, user_id, condition, value_type, value_data)
 
     logging.info(f"Condition check completed for deviceId={device_id}.")
 
+def send_alert(transition: str, device_id: str, user_id: str, condition: dict, value_type: str, value_data):
+    """
+    Sends a notification for an alert state transition. Notification failures are logged
+    and never fail the telemetry request.
+    """
+    min_value = condition.get("minValue")
+    max_value = condition.get("maxValue")
+    if transition == ALERT_RAISED:
+        message = (
+            f"Device {device_id}: {value_type} value {value_data} is outside the allowed range "
+            f"({min_value} - {max_value})."
+        )
+        logging.warning(message)
+    elif transition == ALERT_RESOLVED:
+        message = f"Device {device_id}: {value_type} value {value_data} is back within the allowed range."
+        logging.info(message)
+    else:
+        return
 
+    try:
+        NotificationService.trigger_notification(user_id, message)
+    except Exception as e:
+        logging.exception(f"Failed to send {transition} notification for deviceId={device_id}: {str(e)}")
@@ -1,10 +1,28 @@
-import json
 import logging
 import uuid
 import azure.functions as func
-from config.jwt_utils import create_token, decode_token
-from config.password_utils import hash_password, verify_password
+from config import json_utils
+from config.jwt_utils import create_token, create_refresh_token, get_token_user_id, authenticate_user, REFRESH_TOKEN_TYPE
+from config.password_utils import hash_password, verify_password, needs_rehash, PasswordPoolBusy
+from config.log_utils import log_event
+from config.http_utils import compressed_response, not_modified_for_version, versioned_headers
+from config.time_utils import parse_datetime
 from azure_services.cosmosdb_service import CosmosDBService
+from functions.telemetry_codec import expand_device
+from functions.device_state import STATE_FIELD
+
+# Fields used by the get_users $match stage and by the login and telemetry lookups
+USER_INDEXES = [
+    [("type", 1)],
+    [("email", 1)],
+    [("Devices.deviceId", 1)],
+    [("Devices.deviceName", 1)],
+    [("Devices.telemetryData.event_date", 1)],
+]
+
+def ensure_user_indexes(cosmos_service: CosmosDBService):
+    for keys in USER_INDEXES:
+        cosmos_service.ensure_index(keys)
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -16,6 +34,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
       PATCH  -> update_password (no authorization required)
       DELETE -> delete_user (authorization required)
       LOGIN  -> login_user (no authorization required)
+      REFRESH -> refresh_token (refresh token required)
       ADMIN  -> create_admin_user (no authorization required)
       USERS  -> get_users (authorization required, admin only)
     """
@@ -32,6 +51,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return delete_user(req)
     elif method == "LOGIN":
         return login_user(req)
+    elif method == "REFRESH":
+        return refresh_token(req)
     elif method == "ADMIN":
         return create_admin_user(req)
     elif method == "USERS":
@@ -39,6 +60,17 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     else:
         return func.HttpResponse("Method not allowed", status_code=405)
 
+def password_busy_response() -> func.HttpResponse:
+    """
+    Response returned when the password worker pool is saturated.
+    """
+    return func.HttpResponse(
+        json_utils.dumps({"message": "Service busy, please retry"}), 
+        status_code=503, 
+        headers={"Retry-After": "1"},
+        mimetype="application/json"
+    )
+
 def create_user(req: func.HttpRequest, user_type: str = "user") -> func.HttpResponse:
     logging.info(f"Processing create_user request with userType={user_type}.")
     try:
@@ -58,13 +90,16 @@ def create_user(req: func.HttpRequest, user_type: str = "user") -> func.HttpResp
 
     if not first_name or not last_name or not email or not password:
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
             status_code=400, 
             mimetype="application/json"
         )
     
     # Hash the provided password
-    hashed_pw = hash_password(password)
+    try:
+        hashed_pw = hash_password(password)
+    except PasswordPoolBusy:
+        return password_busy_response()
     
     # Prepare the user document according to the specified structure.
     user_doc = {
@@ -75,8 +110,8 @@ def create_user(req: func.HttpRequest, user_type: str = "user") -> func.HttpResp
         "email": email,
         "password": hashed_pw,
         "phone": phone,            # Optional phone field
-        "authToken": None,         # Default authentication token is None
         "Devices": [],             # Devices list (each device will have a telemetryData array)
+        "version": 1,              # Incremented on every write that changes what GET handlers return
         "type": user_type          # Adding userType (default: "user")
     }
     
@@ -84,16 +119,16 @@ def create_user(req: func.HttpRequest, user_type: str = "user") -> func.HttpResp
     # Insert the user document into Cosmos DB
     insert_result = cosmos_service.insert_document(user_doc)
     
-    # Generate an authentication token for the new user using userId as payload
+    # Tokens are stateless, so nothing else is written to the user document
     token = create_token(user_id)
-    # Update the document with the generated token
-    cosmos_service.update_document(
-        {"_id": user_id, "type": user_type}, 
-        {"$set": {"authToken": token}}  # Use $set operator to update the authToken field
-    )
+    refresh = create_refresh_token(user_id)
     
-    response_body = {"message": f"{user_type.capitalize()} created successfully", "token": token}
-    return func.HttpResponse(json.dumps(response_body), status_code=201, mimetype="application/json")
+    response_body = {
+        "message": f"{user_type.capitalize()} created successfully",
+        "token": token,
+        "refreshToken": refresh
+    }
+    return func.HttpResponse(json_utils.dumps(response_body), status_code=201, mimetype="application/json")
 
 def create_admin_user(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing create_admin_user request.")
@@ -102,42 +137,25 @@ def create_admin_user(req: func.HttpRequest) -> func.HttpResponse:
 def get_user(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing get_user request.")
     
-    # Check for Authorization header
-    auth_header = req.headers.get("Authorization")
-    if not auth_header:
-        logging.error("Authorization header is missing.")
-        return func.HttpResponse(
-            json.dumps({"message": "Unauthorized"}), 
-            status_code=401, 
-            mimetype="application/json"
-        )
-    
-    # Extract token from the Authorization header
-    token = auth_header.split("Bearer ")[-1]
-    logging.info(f"Extracted token: {token}")
-    
-    # Decode the token
-    payload = decode_token(token)
-    if not payload:
-        logging.error("Token decoding failed or token is invalid.")
-        return func.HttpResponse("Invalid token", status_code=401)
-    
-    # Extract user_id from the token payload
-    user_id = payload.get("user_id")
-    if not user_id:
-        logging.error("Token payload does not contain user_id.")
-        return func.HttpResponse("Invalid token payload: user_id missing", status_code=401)
-    
-    logging.info(f"Decoded user_id from token: {user_id}")
+    # Authenticate the user
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
+        return user_id
     
     # Query CosmosDB for the user document
     cosmos_service = CosmosDBService()
     try:
-        user = cosmos_service.find_document({"_id": user_id})
+        # Unchanged polls are answered from the version field alone
+        not_modified = not_modified_for_version(req, lambda: cosmos_service.find_version({"_id": user_id}))
+        if not_modified:
+            return not_modified
+        
+        # The last state is a storage field, returned by get_device_states only
+        user = cosmos_service.find_document({"_id": user_id}, projection={f"Devices.{STATE_FIELD}": 0})
         if not user:
             logging.error(f"User not found in CosmosDB for user_id: {user_id}")
             return func.HttpResponse(
-                json.dumps({"message": "User not found"}), 
+                json_utils.dumps({"message": "User not found"}), 
                 status_code=404, 
                 mimetype="application/json"
             )
@@ -145,28 +163,28 @@ def get_user(req: func.HttpRequest) -> func.HttpResponse:
         logging.exception(f"Error while querying CosmosDB for user_id: {user_id}")
         return func.HttpResponse(f"Error querying database: {str(e)}", status_code=500)
     
-    logging.info(f"User found in CosmosDB: {user}")
+    log_event(logging.INFO, "User found in CosmosDB", route="get_user", user_id=user_id, user=user)
     
-    # Remove sensitive information and convert _id to string for JSON serialization
+    # Remove sensitive information; json_utils serializes ObjectId values
     user.pop("password", None)
-    user["_id"] = str(user["_id"])
-    logging.info(f"Final user object to return: {user}")
+    # Decode compacted telemetry so clients always receive plain telemetryData
+    user["Devices"] = [expand_device(device) for device in user.get("Devices", [])]
+    log_event(logging.DEBUG, "Final user object to return", route="get_user", devices=user.get("Devices"))
     
-    return func.HttpResponse(json.dumps(user), status_code=200, mimetype="application/json")
+    return func.HttpResponse(
+        json_utils.dumps(user), 
+        status_code=200, 
+        headers=versioned_headers(req, user.get("version", 0)), 
+        mimetype="application/json"
+    )
 
 def update_user_put(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing update_user_put request.")
     # This function requires authorization.
-    auth_header = req.headers.get("Authorization")
-    if not auth_header:
-        return func.HttpResponse("Authorization header missing", status_code=401)
-    
-    token = auth_header.split("Bearer ")[-1]
-    payload = decode_token(token)
-    if not payload:
-        return func.HttpResponse("Invalid token", status_code=401)
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
+        return user_id
     
-    user_id = payload.get("user_id")
     try:
         req_body = req.get_json()
     except ValueError:
@@ -185,21 +203,22 @@ def update_user_put(req: func.HttpRequest) -> func.HttpResponse:
     
     if not update_data:
         return func.HttpResponse(
-            json.dumps({"message": "No update data provided"}), 
+            json_utils.dumps({"message": "No update data provided"}), 
             status_code=400, 
             mimetype="application/json"
         )
     
-    # Wrap update_data with $set operator
-    update_query = {"$set": update_data}
+    # Wrap update_data with $set operator and bump the version used for GET ETags
+    update_query = {"$set": update_data, "$inc": {"version": 1}}
     
     cosmos_service = CosmosDBService()
     try:
         result = cosmos_service.update_document({"_id": user_id}, update_query)
-        if result.modified_count == 0:
+        # The version is always incremented, so only a missing user leaves the document unchanged
+        if result.matched_count == 0:
             return func.HttpResponse(
-                json.dumps({"message": "User not updated"}), 
-                status_code=400, 
+                json_utils.dumps({"message": "User not found"}), 
+                status_code=404, 
                 mimetype="application/json"
             )
     except Exception as e:
@@ -207,7 +226,7 @@ def update_user_put(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(f"Error updating user: {str(e)}", status_code=500)
     
     return func.HttpResponse(
-        json.dumps({"message": "User updated successfully"}), 
+        json_utils.dumps({"message": "User updated successfully"}), 
         status_code=200, 
         mimetype="application/json"
     )
@@ -226,7 +245,7 @@ def update_password(req: func.HttpRequest) -> func.HttpResponse:
     new_password = req_body.get("newPassword")
     if not email or not old_password or not new_password:
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
             status_code=400, 
             mimetype="application/json"
         )
@@ -237,49 +256,46 @@ def update_password(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse("User not found", status_code=404)
     
     stored_password = user.get("password")
-    # Verify the provided old password with the stored hashed password
-    if not verify_password(old_password, stored_password):
-        return func.HttpResponse(
-            json.dumps({"message": "Old password does not match"}), 
-            status_code=401, 
-            mimetype="application/json"
-        )
-    
-    # Hash the new password and update the user document
-    hashed_new_pw = hash_password(new_password)
-    result = cosmos_service.update_document({"email": email}, {"password": hashed_new_pw})
+    try:
+        # Verify the provided old password with the stored hashed password
+        if not verify_password(old_password, stored_password):
+            return func.HttpResponse(
+                json_utils.dumps({"message": "Old password does not match"}), 
+                status_code=401, 
+                mimetype="application/json"
+            )
+        
+        # Hash the new password and update the user document
+        hashed_new_pw = hash_password(new_password)
+    except PasswordPoolBusy:
+        return password_busy_response()
+    result = cosmos_service.update_document({"email": email}, {"$set": {"password": hashed_new_pw}})
     if result.modified_count == 0:
         return func.HttpResponse("Password not updated", status_code=400)
     
     return func.HttpResponse(
-        json.dumps({"message": "Password updated successfully"}), 
+        json_utils.dumps({"message": "Password updated successfully"}), 
         status_code=200, 
         mimetype="application/json"
     )
 
 def delete_user(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Processing delete_user request.")
-    auth_header = req.headers.get("Authorization")
-    if not auth_header:
-        return func.HttpResponse("Authorization header missing", status_code=401)
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
+        return user_id
     
-    token = auth_header.split("Bearer ")[-1]
-    payload = decode_token(token)
-    if not payload:
-        return func.HttpResponse("Invalid token", status_code=401)
-    
-    user_id = payload.get("user_id")
     cosmos_service = CosmosDBService()
     result = cosmos_service.delete_document({"_id": user_id})
     if result.deleted_count == 0:
         return func.HttpResponse(
-            json.dumps({"message": "User not deleted"}), 
+            json_utils.dumps({"message": "User not deleted"}), 
             status_code=400, 
             mimetype="application/json"
         )
     
     return func.HttpResponse(
-        json.dumps({"message": "User deleted successfully"}), 
+        json_utils.dumps({"message": "User deleted successfully"}), 
         status_code=200, 
         mimetype="application/json"
     )
@@ -298,77 +314,248 @@ def login_user(req: func.HttpRequest) -> func.HttpResponse:
     password = req_body.get("password")
     if not email or not password:
         return func.HttpResponse(
-            json.dumps({"message": "Missing required fields"}), 
+            json_utils.dumps({"message": "Missing required fields"}), 
             status_code=400, 
             mimetype="application/json"
         )
     
-    # Retrieve the user from CosmosDB
+    # Retrieve only the fields needed to verify the password
     cosmos_service = CosmosDBService()
-    user = cosmos_service.find_document({"email": email})
+    user = cosmos_service.find_document({"email": email}, projection={"userId": 1, "password": 1})
     if not user:
         return func.HttpResponse(
-            json.dumps({"message": "User not found"}), 
+            json_utils.dumps({"message": "User not found"}), 
             status_code=404, 
             mimetype="application/json"
         )
     
     # Verify the password
     stored_password = user.get("password")
-    if not verify_password(password, stored_password):
-        return func.HttpResponse(
-            json.dumps({"message": "Invalid email or password"}), 
-            status_code=401, 
-            mimetype="application/json"
-        )
+    try:
+        if not verify_password(password, stored_password):
+            return func.HttpResponse(
+                json_utils.dumps({"message": "Invalid email or password"}), 
+                status_code=401, 
+                mimetype="application/json"
+            )
+    except PasswordPoolBusy:
+        return password_busy_response()
     
-    # Generate a new token
+    # Generate new access and refresh tokens
     user_id = user.get("userId")
     new_token = create_token(user_id)
+    new_refresh_token = create_refresh_token(user_id)
+    
+    # Rehash the password if the bcrypt cost factor has changed since it was stored
+    if needs_rehash(stored_password):
+        try:
+            cosmos_service.update_document(
+                {"_id": user_id},
+                {"$set": {"password": hash_password(password)}}
+            )
+        except Exception as e:
+            # The login itself succeeded; the rehash is retried on the next login
+            logging.warning(f"Failed to rehash password for user_id={user_id}: {str(e)}")
     
-    # Update the token in the user's document
-    update_result = cosmos_service.update_document(
-        {"_id": user_id},
-        {"$set": {"authToken": new_token}}  # Added $set operator
-    )
-    #if update_result.modified_count == 0:
-    #    return func.HttpResponse("Failed to update user token", status_code=500)
-    
-    # Return the new token as a response
-    response_body = {"message": "Login successful", "token": new_token}
-    return func.HttpResponse(json.dumps(response_body), status_code=200, mimetype="application/json")
+    # Return the new tokens as a response
+    response_body = {"message": "Login successful", "token": new_token, "refreshToken": new_refresh_token}
+    return func.HttpResponse(json_utils.dumps(response_body), status_code=200, mimetype="application/json")
 
-def get_users(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("Processing get_users request.")
-    
-    # Check for Authorization header
-    auth_header = req.headers.get("Authorization")
-    if not auth_header:
-        logging.error("Authorization header is missing.")
-        return func.HttpResponse("Authorization header missing", status_code=401)
+def refresh_token(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Issues a new access token from a refresh token. The refresh token is validated from its
+    signature and claims only, so no database access is needed.
+    """
+    logging.info("Processing refresh_token request.")
     
-    # Extract token from the Authorization header
-    token = auth_header.split("Bearer ")[-1]
-    logging.info(f"Extracted token: {token}")
+    try:
+        req_body = req.get_json()
+    except ValueError:
+        return func.HttpResponse("Invalid JSON body", status_code=400)
     
-    # Decode the token
-    payload = decode_token(token)
-    if not payload:
-        logging.error("Token decoding failed or token is invalid.")
-        return func.HttpResponse("Invalid token", status_code=401)
+    token = req_body.get("refreshToken")
+    if not token:
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Missing required fields"}), 
+            status_code=400, 
+            mimetype="application/json"
+        )
     
-    # Extract user_id from the token payload
-    user_id = payload.get("user_id")
+    user_id = get_token_user_id(token, token_type=REFRESH_TOKEN_TYPE)
     if not user_id:
-        logging.error("Token payload does not contain user_id.")
-        return func.HttpResponse("Invalid token payload: user_id missing", status_code=401)
+        return func.HttpResponse(
+            json_utils.dumps({"message": "Invalid or expired refresh token"}), 
+            status_code=401, 
+            mimetype="application/json"
+        )
+    
+    response_body = {"message": "Token refreshed", "token": create_token(user_id)}
+    return func.HttpResponse(json_utils.dumps(response_body), status_code=200, mimetype="application/json")
+
+def build_users_pipeline(user_type=None, device_name=None, device_id=None, telemetry_date=None,
+                         sensor_type=None, value_type=None, value_min=None, value_max=None) -> list:
+    """
+    Builds the aggregation pipeline for get_users.
+    $match selects users on indexed fields first, $filter trims each user's devices, telemetry
+    and compacted buckets to the entries that can match, and the password and the devices' last
+    state are removed by the database.
+    """
+    match = {"type": user_type if user_type else {"$in": ["user", "admin"]}}  # Default to both user and admin types
+    pipeline = [{"$match": match}]
+    
+    if not (device_name or device_id or telemetry_date or sensor_type or value_type
+            or value_min is not None or value_max is not None):
+        pipeline.append({"$project": {"password": 0, f"Devices.{STATE_FIELD}": 0}})
+        return pipeline
+    
+    # Conditions on a single reading value, used both as a query and as an expression
+    value_query = {}
+    value_exprs = []
+    if value_type:
+        value_query["valueType"] = value_type
+        value_exprs.append({"$eq": ["$$v.valueType", value_type]})
+    value_range = {}
+    if value_min is not None:
+        value_range["$gte"] = value_min
+        value_exprs.append({"$gte": ["$$v.value", value_min]})
+    if value_max is not None:
+        value_range["$lte"] = value_max
+        value_exprs.append({"$lte": ["$$v.value", value_max]})
+    if value_range:
+        value_query["value"] = value_range
+        # Aggregation comparisons order values across types (strings sort above numbers), while
+        # the query only compares numbers with numbers
+        value_exprs.append({"$isNumber": "$$v.value"})
+    
+    # Conditions on a telemetry entry
+    telemetry_query = []
+    telemetry_exprs = []
+    if telemetry_date:
+        telemetry_query.append({"event_date": telemetry_date})
+        telemetry_exprs.append({"$eq": ["$$t.event_date", telemetry_date]})
+    if sensor_type:
+        telemetry_query.append({"values": {"$elemMatch": {"valueType": sensor_type}}})
+        telemetry_exprs.append({"$in": [sensor_type, {"$ifNull": ["$$t.values.valueType", []]}]})
+    if value_query:
+        telemetry_query.append({"values": {"$elemMatch": value_query}})
+        telemetry_exprs.append({"$gt": [{"$size": {"$filter": {
+            "input": {"$ifNull": ["$$t.values", []]},
+            "as": "v",
+            "cond": {"$and": value_exprs}
+        }}}, 0]})
+    
+    # Conditions on a device; a device only matches if at least one telemetry entry matches
+    device_query = {}
+    device_exprs = []
+    if device_name:
+        device_query["deviceName"] = device_name
+        device_exprs.append({"$eq": ["$$d.deviceName", device_name]})
+    if device_id:
+        device_query["deviceId"] = device_id
+        device_exprs.append({"$eq": ["$$d.deviceId", device_id]})
+    # Compacted telemetry is filtered after decoding (see filter_compacted_telemetry); the
+    # database only keeps the buckets whose metadata (time range and valueTypes) can match
+    bucket_query = {}
+    bucket_exprs = []
+    if telemetry_date:
+        bucket_query.update({"start": {"$lte": telemetry_date}, "end": {"$gte": telemetry_date}})
+        bucket_exprs += [{"$lte": ["$$b.start", telemetry_date]}, {"$gte": ["$$b.end", telemetry_date]}]
+    bucket_types = [value for value in dict.fromkeys([sensor_type, value_type]) if value]
+    if bucket_types:
+        bucket_query["valueTypes"] = {"$all": bucket_types}
+        bucket_exprs += [{"$in": [value, {"$ifNull": ["$$b.valueTypes", []]}]} for value in bucket_types]
+    bucket_match = {"telemetryBuckets": {"$elemMatch": bucket_query}} if bucket_query else {"telemetryBuckets.0": {"$exists": True}}
+    if telemetry_query:
+        device_query["$or"] = [{"telemetryData": {"$elemMatch": {"$and": telemetry_query}}}, bucket_match]
+    else:
+        device_query["$or"] = [{"telemetryData.0": {"$exists": True}}, bucket_match]
+    device_exprs.append({"$or": [
+        {"$gt": [{"$size": "$$d.telemetryData"}, 0]},
+        {"$gt": [{"$size": "$$d.telemetryBuckets"}, 0]}
+    ]})
+    
+    match["Devices"] = {"$elemMatch": device_query}
+    pipeline.append({"$addFields": {"Devices": {"$filter": {
+        "input": {"$map": {
+            "input": {"$ifNull": ["$Devices", []]},
+            "as": "d",
+            "in": {"$mergeObjects": ["$$d", {
+                "telemetryData": {"$filter": {
+                    "input": {"$ifNull": ["$$d.telemetryData", []]},
+                    "as": "t",
+                    "cond": {"$and": telemetry_exprs}
+                }},
+                "telemetryBuckets": {"$filter": {
+                    "input": {"$ifNull": ["$$d.telemetryBuckets", []]},
+                    "as": "b",
+                    "cond": {"$and": bucket_exprs}
+                }}
+            }]}
+        }},
+        "as": "d",
+        "cond": {"$and": device_exprs}
+    }}}})
+    pipeline.append({"$project": {"password": 0, f"Devices.{STATE_FIELD}": 0}})
+    return pipeline
+
+def telemetry_matches(telemetry: dict, telemetry_date=None, sensor_type=None, value_type=None,
+                      value_min=None, value_max=None) -> bool:
+    """
+    Python equivalent of the telemetry conditions in build_users_pipeline.
+    """
+    values = telemetry.get("values") or []
+    if telemetry_date and telemetry.get("event_date") != telemetry_date:
+        return False
+    if sensor_type and not any(value.get("valueType") == sensor_type for value in values):
+        return False
+    if value_type or value_min is not None or value_max is not None:
+        ranged = value_min is not None or value_max is not None
+        return any(
+            (not value_type or value.get("valueType") == value_type)
+            and (not ranged or (isinstance(value.get("value"), (int, float)) and not isinstance(value.get("value"), bool)))
+            and (value_min is None or value.get("value") >= value_min)
+            and (value_max is None or value.get("value") <= value_max)
+            for value in values
+        )
+    return True
+
+def filter_compacted_telemetry(users: list, filtered: bool, telemetry_date=None, **conditions) -> list:
+    """
+    Decodes the compacted telemetry of the users returned by build_users_pipeline and applies
+    the telemetry conditions to it, which the database cannot do for encoded buckets.
+    With device or telemetry filters, devices and users left without telemetry are dropped.
+    """
+    result = []
+    for user in users:
+        devices = []
+        for device in user.get("Devices", []):
+            if "telemetryBuckets" in device:
+                device = expand_device(device, telemetry_date, telemetry_date) if telemetry_date else expand_device(device)
+                if filtered:
+                    device["telemetryData"] = [
+                        telemetry for telemetry in device["telemetryData"]
+                        if telemetry_matches(telemetry, telemetry_date, **conditions)
+                    ]
+            if filtered and not device.get("telemetryData"):
+                continue
+            devices.append(device)
+        if filtered and not devices:
+            continue
+        result.append(dict(user, Devices=devices))
+    return result
+
+def get_users(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("Processing get_users request.")
     
-    logging.info(f"Decoded user_id from token: {user_id}")
+    # Authenticate the user
+    user_id = authenticate_user(req)
+    if isinstance(user_id, func.HttpResponse):  # Check if authentication failed
+        return user_id
     
     # Query CosmosDB for the admin user
     cosmos_service = CosmosDBService()
     try:
-        admin_user = cosmos_service.find_document({"_id": user_id, "type": "admin"})
+        admin_user = cosmos_service.find_document({"_id": user_id, "type": "admin"}, projection={"_id": 1})
         if not admin_user:
             logging.error(f"User with user_id: {user_id} is not an admin.")
             return func.HttpResponse("Access denied: Only admins can access this resource", status_code=403)
@@ -376,78 +563,55 @@ def get_users(req: func.HttpRequest) -> func.HttpResponse:
         logging.exception(f"Error while querying CosmosDB for admin user_id: {user_id}")
         return func.HttpResponse(f"Error querying database: {str(e)}", status_code=500)
     
-    logging.info(f"Admin user verified: {admin_user}")
+    log_event(logging.INFO, "Admin user verified", route="get_users", user_id=user_id)
     
-    # Build the query based on query parameters
-    query = {}
-    user_type = req.params.get("userType")
-    device_name = req.params.get("deviceName")
-    device_id = req.params.get("deviceId")
-    telemetry_date = req.params.get("telemetryDate")
-    sensor_type = req.params.get("sensorType")
-    value_type = req.params.get("valueType")
+    # Build the pipeline based on query parameters
     value_min = req.params.get("valueMin")
     value_max = req.params.get("valueMax")
+    try:
+        value_min = float(value_min) if value_min else None
+        value_max = float(value_max) if value_max else None
+    except ValueError:
+        return func.HttpResponse(
+            json_utils.dumps({"message": "valueMin and valueMax must be numbers"}), 
+            status_code=400, 
+            mimetype="application/json"
+        )
+    telemetry_date = req.params.get("telemetryDate")
+    try:
+        telemetry_date = parse_datetime(telemetry_date) if telemetry_date else None
+    except ValueError:
+        return func.HttpResponse(
+            json_utils.dumps({"message": "telemetryDate must be an ISO 8601 date"}), 
+            status_code=400, 
+            mimetype="application/json"
+        )
     
-    if user_type:
-        query["type"] = user_type
-    else:
-        query["type"] = {"$in": ["user", "admin"]}  # Default to both user and admin types
+    conditions = {
+        "sensor_type": req.params.get("sensorType"),
+        "value_type": req.params.get("valueType"),
+        "value_min": value_min,
+        "value_max": value_max,
+    }
+    device_name = req.params.get("deviceName")
+    device_id = req.params.get("deviceId")
+    pipeline = build_users_pipeline(
+        user_type=req.params.get("userType"),
+        device_name=device_name,
+        device_id=device_id,
+        telemetry_date=telemetry_date,
+        **conditions
+    )
+    filtered = bool(device_name or device_id or telemetry_date or conditions["sensor_type"] or conditions["value_type"]
+                    or value_min is not None or value_max is not None)
     
-    # Query CosmosDB for users
+    # Query CosmosDB for users; filtering happens in the database
     try:
-        users = cosmos_service.find_documents(query)
-        filtered_users = []
-        for user in users:
-            # Filter by device and telemetry information
-            if device_name or device_id or telemetry_date or sensor_type or value_type or value_min or value_max:
-                devices = user.get("Devices", [])
-                matching_devices = []
-                for device in devices:
-                    if device_name and device.get("deviceName") != device_name:
-                        continue
-                    if device_id and device.get("deviceId") != device_id:
-                        continue
-                    
-                    # Filter telemetry data
-                    telemetry_data = device.get("telemetryData", [])
-                    matching_telemetry = []
-                    for telemetry in telemetry_data:
-                        if telemetry_date and telemetry.get("event_date") != telemetry_date:
-                            continue
-                        if sensor_type and not any(value.get("valueType") == sensor_type for value in telemetry.get("values", [])):
-                            continue
-                        if value_type or value_min or value_max:
-                            for value in telemetry.get("values", []):
-                                if value_type and value.get("valueType") != value_type:
-                                    continue
-                                if value_min and value.get("value") < float(value_min):
-                                    continue
-                                if value_max and value.get("value") > float(value_max):
-                                    continue
-                                matching_telemetry.append(telemetry)
-                                break
-                        else:
-                            matching_telemetry.append(telemetry)
-                    
-                    if matching_telemetry:
-                        device["telemetryData"] = matching_telemetry
-                        matching_devices.append(device)
-                
-                if matching_devices:
-                    user["Devices"] = matching_devices
-                    filtered_users.append(user)
-            else:
-                filtered_users.append(user)
-        
-        # Remove sensitive information and convert _id to string for JSON serialization
-        for user in filtered_users:
-            user.pop("password", None)
-            user["_id"] = str(user["_id"])
+        ensure_user_indexes(cosmos_service)
+        filtered_users = filter_compacted_telemetry(cosmos_service.aggregate(pipeline), filtered, telemetry_date, **conditions)
         logging.info(f"Total users found: {len(filtered_users)}")
     except Exception as e:
         logging.exception("Error while querying CosmosDB for users.")
         return func.HttpResponse(f"Error querying database: {str(e)}", status_code=500)
     
-    return func.HttpResponse(json.dumps(filtered_users), status_code=200, mimetype="application/json")
-
+    return compressed_response(req, json_utils.dumps(filtered_users))
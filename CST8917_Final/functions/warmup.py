@@ -0,0 +1,65 @@
+import time
+import logging
+import importlib
+
+# Handler modules imported ahead of the first request
+HANDLER_MODULES = [
+    "functions.user_functions",
+    "functions.device_functions",
+    "functions.telemetry_functions",
+    "functions.conditions",
+]
+
+def _ping_mongo():
+    from azure_services.cosmosdb_service import get_mongo_client
+    get_mongo_client().admin.command("ping")  # Opens the first pooled connection
+
+def _blob_client():
+    from azure_services.blob_storage_service import get_blob_service_client
+    get_blob_service_client()
+
+def _eventgrid_client():
+    from azure_services.eventtopic_service import get_eventgrid_client
+    get_eventgrid_client()
+
+def _iot_registry():
+    from azure_services.iot_hub_service import get_registry_manager
+    get_registry_manager()
+
+def _vision_client():
+    from azure_services.cognitive_serivce import get_vision_client
+    get_vision_client()
+
+def _config():
+    from config.config_utils import get_config
+    get_config()
+
+def _handlers():
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+
+WARMUP_STEPS = [
+    ("config", _config),
+    ("handlers", _handlers),
+    ("cosmosdb", _ping_mongo),
+    ("blob", _blob_client),
+    ("eventgrid", _eventgrid_client),
+    ("iothub", _iot_registry),
+    ("vision", _vision_client),
+]
+
+def warm_up() -> dict:
+    """
+    Imports the handler modules and creates the shared SDK clients and pools.
+    Returns the duration of each step in milliseconds, or the error if a step failed.
+    """
+    results = {}
+    for name, step in WARMUP_STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+            results[name] = round((time.perf_counter() - start) * 1000, 2)
+        except Exception as e:
+            logging.warning(f"[warm_up] Step {name} failed: {str(e)}")
+            results[name] = f"error: {str(e)}"
+    return results
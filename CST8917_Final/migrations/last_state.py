@@ -0,0 +1,67 @@
+"""
+One-off migration adding the last state to devices stored before post_telemetry maintained it.
+
+Builds each device's lastState from its telemetry (including compacted buckets) and merges it
+into the stored one with $max. Devices that already have a (possibly partial) last state, e.g.
+from readings stored since the deploy, only get their older or missing entries completed and
+newer entries are kept, so the script can be run again safely.
+
+Usage (from the CST8917_Final directory):
+    python migrations/last_state.py --dry-run
+    python migrations/last_state.py
+"""
+import os
+import sys
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azure_services.cosmosdb_service import CosmosDBService
+from functions.telemetry_codec import read_telemetry
+from functions.device_state import build_state, merge_state_update
+
+def migrate(cosmos_service: CosmosDBService, dry_run: bool = False) -> dict:
+    """
+    Merges the last state built from the telemetry into every device. Each device is updated on
+    its own with $max, so readings stored by requests during the migration are never
+    overwritten and no update conflicts with them.
+    """
+    stats = {"scanned": 0, "migrated": 0, "unchanged": 0, "failed": 0}
+    collection = cosmos_service.db[cosmos_service.default_collection_name]
+    projection = {"Devices.deviceId": 1, "Devices.telemetryData": 1, "Devices.telemetryBuckets": 1}
+    for user in collection.find({"Devices.0": {"$exists": True}}, projection):
+        stats["scanned"] += 1
+        for device in user["Devices"]:
+            try:
+                state = build_state(read_telemetry(device))
+            except (KeyError, ValueError) as e:
+                logging.error(f"[last_state] Could not read device {device.get('deviceId')} of user {user['_id']}: {str(e)}")
+                stats["failed"] += 1
+                continue
+            if not state:
+                stats["unchanged"] += 1
+                continue
+            if dry_run:
+                stats["migrated"] += 1
+                continue
+            query = {"_id": user["_id"], "Devices.deviceId": device["deviceId"]}
+            result = cosmos_service.update_document(query, {"$max": merge_state_update(state)})
+            if not result.modified_count:
+                stats["unchanged"] += 1
+                continue
+            cosmos_service.update_document({"_id": user["_id"]}, {"$inc": {"version": 1}})  # version backs the GET ETags
+            stats["migrated"] += 1
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the last known state to devices stored without one.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stats = migrate(CosmosDBService(), dry_run=args.dry_run)
+    print(" ".join(f"{key}={value}" for key, value in stats.items()))
+
+if __name__ == "__main__":
+    main()
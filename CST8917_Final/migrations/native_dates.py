@@ -0,0 +1,83 @@
+"""
+One-off migration to native BSON dates.
+
+Converts the event_date of every telemetry entry and the registrationDate of every device
+from ISO strings to dates, and sorts each telemetryData array by event_date so range
+queries can use binary search. Documents that are already migrated are left untouched,
+so the script can be run again safely.
+
+Usage (from the CST8917_Final directory):
+    python migrations/native_dates.py --dry-run
+    python migrations/native_dates.py
+"""
+import os
+import sys
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.time_utils import parse_datetime, event_time
+from azure_services.cosmosdb_service import CosmosDBService
+
+def migrate_devices(devices: list) -> bool:
+    """
+    Converts the dates of the given devices in place. Returns True if anything changed.
+    """
+    changed = False
+    for device in devices:
+        if isinstance(device.get("registrationDate"), str):
+            device["registrationDate"] = parse_datetime(device["registrationDate"])
+            changed = True
+        telemetry_data = device.get("telemetryData") or []
+        for telemetry in telemetry_data:
+            if isinstance(telemetry.get("event_date"), str):
+                telemetry["event_date"] = parse_datetime(telemetry["event_date"])
+                changed = True
+        if any(event_time(a) > event_time(b) for a, b in zip(telemetry_data, telemetry_data[1:])):
+            telemetry_data.sort(key=event_time)
+            changed = True
+    return changed
+
+def migrate(cosmos_service: CosmosDBService, dry_run: bool = False) -> dict:
+    """
+    Migrates every user document. Each update is conditional on the document version, so a
+    document written by a request during the migration is skipped and reported instead of
+    being overwritten.
+    """
+    stats = {"scanned": 0, "migrated": 0, "conflicts": 0, "failed": 0}
+    collection = cosmos_service.db[cosmos_service.default_collection_name]
+    for user in collection.find({"Devices.0": {"$exists": True}}, {"Devices": 1, "version": 1}):
+        stats["scanned"] += 1
+        try:
+            if not migrate_devices(user["Devices"]):
+                continue
+        except (KeyError, ValueError) as e:
+            logging.error(f"[native_dates] Could not migrate user {user['_id']}: {str(e)}")
+            stats["failed"] += 1
+            continue
+        if dry_run:
+            stats["migrated"] += 1
+            continue
+        result = cosmos_service.update_document(
+            {"_id": user["_id"], "version": user.get("version")},
+            {"$set": {"Devices": user["Devices"]}, "$inc": {"version": 1}}
+        )
+        if result.modified_count:
+            stats["migrated"] += 1
+        else:
+            logging.warning(f"[native_dates] User {user['_id']} changed during the migration, run again to retry.")
+            stats["conflicts"] += 1
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert stored telemetry and device dates to native dates.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stats = migrate(CosmosDBService(), dry_run=args.dry_run)
+    print(" ".join(f"{key}={value}" for key, value in stats.items()))
+
+if __name__ == "__main__":
+    main()
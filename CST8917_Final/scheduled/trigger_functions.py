@@ -1,19 +1,20 @@
 import os
-import datetime
 import logging
-from azure.storage.blob import BlobServiceClient
-from config.azure_config import get_azure_config
+from config.config_utils import get_config
+from config.time_utils import utc_now, parse_datetime
 from azure_services.cosmosdb_service import CosmosDBService
+from azure_services.blob_storage_service import get_blob_service_client
+
+# Users fetched per batch by the compaction, so their telemetry is never loaded all at once
+COMPACTION_BATCH_SIZE = int(os.environ.get("COMPACTION_BATCH_SIZE", "20"))
 
 def scheduled_cleanup(timer_info):
     try:
         # Load configuration
-        config = get_azure_config()
+        config = get_config()
 
-        # Initialize BlobServiceClient using the connection string from config
-        blob_service_client = BlobServiceClient.from_connection_string(
-            config["BLOB_STORAGE_CONNECTION_STRING"]
-        )
+        # Reuse the worker's BlobServiceClient
+        blob_service_client = get_blob_service_client()
         container_name = config["BLOB_CONTAINER_NAME"]
         container_client = blob_service_client.get_container_client(container_name)
 
@@ -21,7 +22,7 @@ def scheduled_cleanup(timer_info):
         cosmos_service = CosmosDBService()
 
         # Get current UTC time
-        now = datetime.datetime.utcnow()
+        now = utc_now()
 
         # Query all users from the CosmosDB collection
         users = cosmos_service.find_documents({})
@@ -29,7 +30,7 @@ def scheduled_cleanup(timer_info):
         for user in users:
             updated_images = []
             for image in user.get("uploadedImages", []):
-                upload_date = datetime.datetime.fromisoformat(image["uploadDate"])
+                upload_date = parse_datetime(image["uploadDate"])  # ISO string or native date
                 age = now - upload_date
 
                 # Check if image is older than 1 day
@@ -46,15 +47,75 @@ def scheduled_cleanup(timer_info):
                 else:
                     updated_images.append(image)
 
-            # Update user document with only fresh images
-            cosmos_service.update_document(
-                {"_id": user["_id"]},
-                {"$set": {"uploadedImages": updated_images}}
-            )
+            # Update user document with only fresh images; users without expired images keep
+            # their version, so their ETags stay valid
+            if len(updated_images) != len(user.get("uploadedImages", [])):
+                cosmos_service.update_document(
+                    {"_id": user["_id"]},
+                    {"$set": {"uploadedImages": updated_images}, "$inc": {"version": 1}}
+                )
 
     except Exception as e:
         logging.error(f"[Cleanup Error] {str(e)}")
 
+def scheduled_compaction(timer_info):
+    """
+    Moves older telemetry of every device into compact encoded buckets.
+    Users are read one batch at a time. Each device is updated on its own: the compacted
+    readings are pulled by eventId and the buckets pushed in one update, so readings stored
+    meanwhile do not prevent it. A device whose compacted readings were deleted meanwhile is
+    left for the next run.
+    """
+    from functions.telemetry_codec import compact_device, TELEMETRY_BUCKET_SIZE, TELEMETRY_HOT_READINGS
+    try:
+        cosmos_service = CosmosDBService()
+
+        # Only users with at least one device holding enough readings for a full bucket
+        min_readings = TELEMETRY_HOT_READINGS + TELEMETRY_BUCKET_SIZE
+        users = cosmos_service.aggregate_cursor([
+            {"$match": {f"Devices.telemetryData.{min_readings - 1}": {"$exists": True}}},
+            {"$project": {"Devices.deviceId": 1, "Devices.telemetryData": 1}},
+        ], batch_size=COMPACTION_BATCH_SIZE)
+
+        compacted = 0
+        for user in users:
+            for device in user.get("Devices", []):
+                result = compact_device(device)
+                if result is None:
+                    continue
+                remaining, buckets = result
+                kept = {id(telemetry) for telemetry in remaining}
+                moved_ids = [telemetry["eventId"] for telemetry in device["telemetryData"] if id(telemetry) not in kept]
+                update = cosmos_service.update_document(
+                    {"_id": user["_id"], "Devices": {"$elemMatch": {
+                        "deviceId": device["deviceId"], "telemetryData.eventId": {"$all": moved_ids}
+                    }}},
+                    {
+                        "$pull": {"Devices.$.telemetryData": {"eventId": {"$in": moved_ids}}},
+                        "$push": {"Devices.$.telemetryBuckets": {"$each": buckets}},
+                        "$inc": {"version": 1}
+                    }
+                )
+                if not update.modified_count:
+                    logging.info(f"[Compaction] Telemetry of device {device['deviceId']} changed during compaction, skipped until the next run.")
+                    continue
+                compacted += sum(bucket["count"] for bucket in buckets)
+        logging.info(f"[Compaction] Compacted {compacted} telemetry readings.")
+
+    except Exception as e:
+        logging.error(f"[Compaction Error] {str(e)}")
+
+def scheduled_deferred_events(timer_info):
+    """
+    Sends the events deferred while Event Grid was unavailable, oldest first.
+    """
+    from azure_services.eventtopic_service import replay_deferred_events
+    try:
+        delivered = replay_deferred_events()
+        logging.info(f"[DeferredEvents] Sent {delivered} deferred events.")
+    except Exception as e:
+        logging.error(f"[DeferredEvents Error] {str(e)}")
+
 def handle_error(error: Exception, context: dict = None):
     source = context.get("source", "Unknown")
     logging.exception(f"Error in {source}: {str(error)}")
\ No newline at end of file